@@ -0,0 +1,877 @@
+"""In-memory stand-in for the slice of Motor's API that server.py uses.
+
+Selected with STORAGE_BACKEND=memory. Documents live in per-collection
+dicts and every operation completes synchronously inside its coroutine,
+so handlers run exactly as they do against MongoDB minus the network.
+This lets the whole API be exercised in-process by the ASGI test client,
+and handler CPU cost be profiled apart from database latency.
+
+Supported: the query operators, update operators (including pipeline
+updates), aggregation stages and expressions the server issues, unique
+and partial unique indexes, and a text index approximation. Anything
+else raises NotImplementedError rather than silently misbehaving.
+Command listeners are not invoked.
+"""
+import re
+from datetime import date, datetime, timezone
+from enum import Enum
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+MISSING = object()
+
+
+# Values are stored the way BSON would round-trip them: datetimes as naive
+# UTC with millisecond precision, enums as their values
+def normalize(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+def clone(value: Any) -> Any:
+    # Stored leaves are immutable, so only containers need copying; far
+    # cheaper than copy.deepcopy on large result sets
+    if isinstance(value, dict):
+        return {key: clone(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [clone(item) for item in value]
+    return value
+
+
+# BSON comparison order across types
+def type_rank(value: Any) -> int:
+    if value is None or value is MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+
+def sort_key(value: Any) -> Tuple[int, Any]:
+    rank = type_rank(value)
+    if rank == 1:
+        return (rank, 0)
+    if rank in (4, 5):
+        return (rank, repr(value))
+    return (rank, value)
+
+
+def comparable(a: Any, b: Any) -> bool:
+    return type_rank(a) == type_rank(b) and type_rank(a) != 1
+
+
+def hashable(value: Any) -> Any:
+    if isinstance(value, dict):
+        return tuple((key, hashable(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(hashable(item) for item in value)
+    return value
+
+
+# Paths
+def get_path(document: Any, path: str) -> Any:
+    """Value at a dotted path, or MISSING; arrays are not expanded."""
+    current = document
+    for part in path.split("."):
+        if isinstance(current, dict) and part in current:
+            current = current[part]
+        elif isinstance(current, list) and part.isdigit() and int(part) < len(current):
+            current = current[int(part)]
+        else:
+            return MISSING
+    return current
+
+
+def path_values(document: Any, path: str) -> List[Any]:
+    """Every value a query on path can see, expanding arrays along the way."""
+    head, _, rest = path.partition(".")
+    if isinstance(document, list):
+        found = []
+        for item in document:
+            found.extend(path_values(item, path))
+        if head.isdigit() and int(head) < len(document):
+            found.extend(path_values(document[int(head)], rest) if rest else [document[int(head)]])
+        return found
+    if not isinstance(document, dict) or head not in document:
+        return []
+    value = document[head]
+    if not rest:
+        return [value, *value] if isinstance(value, list) else [value]
+    return path_values(value, rest)
+
+
+def set_path(document: Dict[str, Any], path: str, value: Any):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def unset_path(document: Dict[str, Any], path: str):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(parts[-1], None)
+
+
+# Queries
+BSON_TYPES: Dict[str, Callable[[Any], bool]] = {
+    "string": lambda value: isinstance(value, str),
+    "date": lambda value: isinstance(value, datetime),
+    "bool": lambda value: isinstance(value, bool),
+    "double": lambda value: isinstance(value, float),
+    "int": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    "object": lambda value: isinstance(value, dict),
+    "array": lambda value: isinstance(value, list),
+    "null": lambda value: value is None,
+    "objectId": lambda value: isinstance(value, ObjectId),
+}
+
+
+def values_equal(value: Any, expected: Any) -> bool:
+    if expected is None:
+        return value is None
+    return type_rank(value) == type_rank(expected) and value == expected
+
+
+def match_operator(values: List[Any], operator: str, argument: Any) -> bool:
+    if operator == "$eq":
+        return match_value(values, argument)
+    if operator == "$ne":
+        return not match_value(values, argument)
+    if operator == "$in":
+        return any(match_value(values, item) for item in argument)
+    if operator == "$nin":
+        return not any(match_value(values, item) for item in argument)
+    if operator == "$exists":
+        return bool(values) == bool(argument)
+    if operator == "$type":
+        return any(BSON_TYPES[argument](value) for value in values)
+    if operator in ("$gt", "$gte", "$lt", "$lte"):
+        compare = {
+            "$gt": lambda a, b: a > b,
+            "$gte": lambda a, b: a >= b,
+            "$lt": lambda a, b: a < b,
+            "$lte": lambda a, b: a <= b,
+        }[operator]
+        return any(comparable(value, argument) and compare(value, argument) for value in values)
+    raise NotImplementedError(f"memory backend does not support query operator {operator}")
+
+
+def match_value(values: List[Any], expected: Any) -> bool:
+    # A null query also matches documents where the field is missing
+    if expected is None and not values:
+        return True
+    return any(values_equal(value, expected) for value in values)
+
+
+def matches(document: Dict[str, Any], query: Dict[str, Any]) -> bool:
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches(document, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(document, clause) for clause in condition):
+                return False
+        elif key == "$nor":
+            if any(matches(document, clause) for clause in condition):
+                return False
+        elif key == "$text":
+            continue  # scored and filtered by the collection's text index
+        elif key.startswith("$"):
+            raise NotImplementedError(f"memory backend does not support query operator {key}")
+        else:
+            values = path_values(document, key)
+            if isinstance(condition, dict) and condition and all(name.startswith("$") for name in condition):
+                if not all(match_operator(values, operator, argument) for operator, argument in condition.items()):
+                    return False
+            elif not match_value(values, condition):
+                return False
+    return True
+
+
+def equality_fields(query: Dict[str, Any]) -> Dict[str, Any]:
+    """The fields an upsert seeds the new document with."""
+    fields: Dict[str, Any] = {}
+    for key, condition in query.items():
+        if key == "$and":
+            for clause in condition:
+                fields.update(equality_fields(clause))
+        elif not key.startswith("$"):
+            if isinstance(condition, dict) and any(name.startswith("$") for name in condition):
+                if "$eq" in condition:
+                    fields[key] = condition["$eq"]
+            else:
+                fields[key] = condition
+    return fields
+
+
+# Aggregation expressions
+def evaluate(expression: Any, document: Dict[str, Any]) -> Any:
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = get_path(document, expression[1:])
+        return None if value is MISSING else value
+    if isinstance(expression, list):
+        return [evaluate(item, document) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) == 1:
+        operator, argument = next(iter(expression.items()))
+        if operator.startswith("$"):
+            return evaluate_operator(operator, argument, document)
+    return {key: evaluate(value, document) for key, value in expression.items()}
+
+
+def evaluate_operator(operator: str, argument: Any, document: Dict[str, Any]) -> Any:
+    if operator == "$literal":
+        return argument
+    if operator == "$switch":
+        for branch in argument["branches"]:
+            if evaluate(branch["case"], document):
+                return evaluate(branch["then"], document)
+        return evaluate(argument["default"], document)
+    if operator == "$cond":
+        if isinstance(argument, dict):
+            argument = [argument["if"], argument["then"], argument["else"]]
+        condition, then, otherwise = argument
+        return evaluate(then if evaluate(condition, document) else otherwise, document)
+    if operator == "$dateToString":
+        value = evaluate(argument["date"], document)
+        return value.strftime(argument.get("format", "%Y-%m-%dT%H:%M:%S.%LZ").replace("%L", "000")) if value else None
+    if operator in ("$hour", "$dayOfWeek", "$year", "$month", "$dayOfMonth", "$minute"):
+        value = evaluate(argument, document)
+        if value is None:
+            return None
+        return {
+            "$hour": value.hour,
+            "$dayOfWeek": value.isoweekday() % 7 + 1,
+            "$year": value.year,
+            "$month": value.month,
+            "$dayOfMonth": value.day,
+            "$minute": value.minute,
+        }[operator]
+
+    values = [evaluate(item, document) for item in (argument if isinstance(argument, list) else [argument])]
+    if operator == "$add":
+        return None if any(value is None for value in values) else sum(values)
+    if operator == "$subtract":
+        return values[0] - values[1]
+    if operator == "$multiply":
+        result = 1
+        for value in values:
+            result *= value
+        return result
+    if operator == "$divide":
+        return values[0] / values[1]
+    if operator in ("$max", "$min"):
+        present = [value for value in values if value is not None]
+        if not present:
+            return None
+        return (max if operator == "$max" else min)(present, key=sort_key)
+    if operator in ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte"):
+        left, right = (sort_key(value) for value in values)
+        return {
+            "$eq": left == right,
+            "$ne": left != right,
+            "$gt": left > right,
+            "$gte": left >= right,
+            "$lt": left < right,
+            "$lte": left <= right,
+        }[operator]
+    if operator == "$and":
+        return all(values)
+    if operator == "$or":
+        return any(values)
+    if operator == "$not":
+        return not values[0]
+    if operator == "$ifNull":
+        return next((value for value in values if value is not None), None)
+    raise NotImplementedError(f"memory backend does not support expression {operator}")
+
+
+def accumulate(operator: str, argument: Any, documents: List[Dict[str, Any]]) -> Any:
+    values = [evaluate(argument, document) for document in documents]
+    if operator == "$sum":
+        return sum(value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool))
+    if operator == "$avg":
+        numbers = [value for value in values if isinstance(value, (int, float))]
+        return sum(numbers) / len(numbers) if numbers else None
+    if operator == "$first":
+        return values[0] if values else None
+    if operator == "$last":
+        return values[-1] if values else None
+    if operator in ("$max", "$min"):
+        present = [value for value in values if value is not None]
+        return (max if operator == "$max" else min)(present, key=sort_key) if present else None
+    if operator == "$push":
+        return values
+    if operator == "$addToSet":
+        unique: List[Any] = []
+        for value in values:
+            if value not in unique:
+                unique.append(value)
+        return unique
+    raise NotImplementedError(f"memory backend does not support accumulator {operator}")
+
+
+# Sorting and projection
+def normalize_sort(spec: Any, direction: Optional[int] = None) -> List[Tuple[str, Any]]:
+    if isinstance(spec, str):
+        return [(spec, direction if direction is not None else 1)]
+    if isinstance(spec, dict):
+        return list(spec.items())
+    return [tuple(item) for item in spec]
+
+
+def sort_documents(documents: List[Dict[str, Any]], spec: List[Tuple[str, Any]], scores: Dict[int, float]):
+    # Stable sorts applied last key first give a multi-key sort
+    for field, direction in reversed(spec):
+        if isinstance(direction, dict):
+            documents.sort(key=lambda document: scores.get(id(document), 0.0), reverse=True)
+        else:
+            documents.sort(key=lambda document: sort_key(first_value(document, field)), reverse=direction == -1)
+
+
+def first_value(document: Dict[str, Any], field: str) -> Any:
+    value = get_path(document, field)
+    return None if value is MISSING else value
+
+
+def project(document: Dict[str, Any], projection: Optional[Dict[str, Any]], score: Optional[float]) -> Dict[str, Any]:
+    if not projection:
+        return clone(document)
+    meta = {field for field, spec in projection.items() if isinstance(spec, dict)}
+    fields = {field: spec for field, spec in projection.items() if field not in meta}
+    include_id = fields.pop("_id", 1)
+    inclusive = any(fields.values()) if fields else False
+    if inclusive:
+        result: Dict[str, Any] = {}
+        if include_id and "_id" in document:
+            result["_id"] = document["_id"]
+        for field in fields:
+            include_path(result, document, field.split("."))
+        result = clone(result)
+    else:
+        result = clone(document)
+        for field in fields:
+            unset_path(result, field)
+        if not include_id:
+            result.pop("_id", None)
+    for field in meta:
+        result[field] = score or 0.0
+    return result
+
+
+def include_path(target: Dict[str, Any], source: Any, parts: List[str]):
+    head, rest = parts[0], parts[1:]
+    if not isinstance(source, dict) or head not in source:
+        return
+    value = source[head]
+    if not rest:
+        target[head] = value
+    elif isinstance(value, list):
+        items = target.setdefault(head, [{} for _ in value])
+        for item_target, item in zip(items, value):
+            if isinstance(item, dict):
+                include_path(item_target, item, rest)
+    elif isinstance(value, dict):
+        include_path(target.setdefault(head, {}), value, rest)
+
+
+# Updates
+def apply_update(document: Dict[str, Any], update: Any, inserting: bool):
+    if isinstance(update, list):
+        for stage in update:
+            (name, spec), = stage.items()
+            if name in ("$set", "$addFields"):
+                values = {field: evaluate(expression, document) for field, expression in spec.items()}
+                for field, value in values.items():
+                    set_path(document, field, value)
+            elif name in ("$unset", "$project") and isinstance(spec, (list, str)):
+                for field in [spec] if isinstance(spec, str) else spec:
+                    unset_path(document, field)
+            else:
+                raise NotImplementedError(f"memory backend does not support pipeline stage {name} in updates")
+        return
+
+    for operator, fields in update.items():
+        for field, value in fields.items():
+            current = get_path(document, field)
+            if operator == "$set":
+                set_path(document, field, clone(value))
+            elif operator == "$setOnInsert":
+                if inserting:
+                    set_path(document, field, clone(value))
+            elif operator == "$inc":
+                set_path(document, field, (0 if current is MISSING else current) + value)
+            elif operator == "$max":
+                if current is MISSING or sort_key(value) > sort_key(current):
+                    set_path(document, field, value)
+            elif operator == "$min":
+                if current is MISSING or sort_key(value) < sort_key(current):
+                    set_path(document, field, value)
+            elif operator == "$unset":
+                unset_path(document, field)
+            elif operator == "$push":
+                if current is MISSING:
+                    set_path(document, field, [value])
+                else:
+                    current.append(value)
+            elif operator == "$addToSet":
+                values = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                if current is MISSING:
+                    current = []
+                    set_path(document, field, current)
+                for item in values:
+                    if item not in current:
+                        current.append(clone(item))
+            else:
+                raise NotImplementedError(f"memory backend does not support update operator {operator}")
+
+
+# Text search: lowercase word tokens with a crude plural strip stand in for stemming
+def tokens(text: Any) -> List[str]:
+    if isinstance(text, list):
+        return [token for item in text for token in tokens(item)]
+    if not isinstance(text, str):
+        return []
+    return [word[:-1] if len(word) > 3 and word.endswith("s") else word for word in re.findall(r"[a-z0-9]+", text.lower())]
+
+
+class Results:
+    def __init__(self, **fields):
+        self.acknowledged = True
+        self.__dict__.update(fields)
+
+
+class MemoryCursor:
+    def __init__(self, collection: "MemoryCollection", query: Dict[str, Any], projection: Optional[Dict[str, Any]]):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.sort_spec: List[Tuple[str, Any]] = []
+        self.skip_count = 0
+        self.limit_count = 0
+
+    def sort(self, key: Any, direction: Optional[int] = None) -> "MemoryCursor":
+        self.sort_spec = normalize_sort(key, direction)
+        return self
+
+    def skip(self, count: int) -> "MemoryCursor":
+        self.skip_count = count
+        return self
+
+    def limit(self, count: int) -> "MemoryCursor":
+        self.limit_count = count
+        return self
+
+    def results(self) -> List[Dict[str, Any]]:
+        documents, scores = self.collection.select(self.query)
+        if self.sort_spec:
+            sort_documents(documents, self.sort_spec, scores)
+        documents = documents[self.skip_count:]
+        if self.limit_count:
+            documents = documents[:self.limit_count]
+        return [project(document, self.projection, scores.get(id(document))) for document in documents]
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        results = self.results()
+        return results[:length] if length else results
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.results():
+            yield document
+
+
+class MemoryAggregationCursor:
+    def __init__(self, collection: "MemoryCollection", pipeline: List[Dict[str, Any]]):
+        self.collection = collection
+        self.pipeline = normalize(pipeline)
+
+    def results(self) -> List[Dict[str, Any]]:
+        documents: Optional[List[Dict[str, Any]]] = None
+        scores: Dict[int, float] = {}
+        for stage in self.pipeline:
+            (name, spec), = stage.items()
+            if name == "$match":
+                if documents is None:
+                    documents, scores = self.collection.select(spec)
+                else:
+                    documents = [document for document in documents if matches(document, spec)]
+                continue
+            if documents is None:
+                documents, scores = self.collection.select({})
+            if name == "$group":
+                groups: Dict[Any, List[Dict[str, Any]]] = {}
+                keys: Dict[Any, Any] = {}
+                for document in documents:
+                    key = evaluate(spec["_id"], document)
+                    groups.setdefault(hashable(key), []).append(document)
+                    keys.setdefault(hashable(key), key)
+                documents = [
+                    {
+                        "_id": keys[group_key],
+                        **{
+                            field: accumulate(*next(iter(accumulator.items())), members)
+                            for field, accumulator in spec.items()
+                            if field != "_id"
+                        }
+                    }
+                    for group_key, members in groups.items()
+                ]
+            elif name == "$sort":
+                documents = list(documents)
+                sort_documents(documents, normalize_sort(spec), scores)
+            elif name == "$limit":
+                documents = documents[:spec]
+            elif name == "$skip":
+                documents = documents[spec:]
+            elif name in ("$project", "$addFields", "$set"):
+                if name == "$project" and all(value in (0, 1, True, False) for value in spec.values()):
+                    documents = [project(document, spec, None) for document in documents]
+                else:
+                    documents = [
+                        {**(document if name != "$project" else {"_id": document.get("_id")}),
+                         **{field: evaluate(expression, document) for field, expression in spec.items()}}
+                        for document in documents
+                    ]
+            elif name == "$count":
+                documents = [{spec: len(documents)}] if documents else []
+            else:
+                raise NotImplementedError(f"memory backend does not support aggregation stage {name}")
+        return clone(documents or [])
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        results = self.results()
+        return results[:length] if length else results
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.results():
+            yield document
+
+
+class MemoryCollection:
+    def __init__(self, database: "MemoryDatabase", name: str):
+        self.database = database
+        self.name = name
+        self.documents: Dict[Any, Dict[str, Any]] = {}
+        # name -> {"fields": [...], "partial": filter or None, "entries": {key: _id}}
+        self.unique_indexes: Dict[str, Dict[str, Any]] = {}
+        self.index_names: set = {"_id_"}
+        self.text_weights: Dict[str, float] = {}
+
+    # Indexes
+    async def create_indexes(self, indexes) -> List[str]:
+        names = []
+        for index in indexes:
+            spec = index.document
+            keys = list(spec["key"].items())
+            self.index_names.add(spec["name"])
+            names.append(spec["name"])
+            if any(direction == "text" for _, direction in keys):
+                weights = spec.get("weights", {})
+                self.text_weights = {field: float(weights.get(field, 1)) for field, direction in keys if direction == "text"}
+            if spec.get("unique") and spec["name"] not in self.unique_indexes:
+                entry = {
+                    "fields": [field for field, _ in keys],
+                    "partial": spec.get("partialFilterExpression"),
+                    "entries": {}
+                }
+                for document in self.documents.values():
+                    key = self.index_key(entry, document)
+                    if key is not None:
+                        if key in entry["entries"]:
+                            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {spec['name']}", 11000)
+                        entry["entries"][key] = document["_id"]
+                self.unique_indexes[spec["name"]] = entry
+        return names
+
+    async def create_index(self, keys, **kwargs) -> str:
+        from pymongo import IndexModel
+        return (await self.create_indexes([IndexModel(keys, **kwargs)]))[0]
+
+    async def drop_index(self, name: str):
+        if name not in self.index_names:
+            raise OperationFailure(f"index not found with name [{name}]", 27)
+        self.index_names.discard(name)
+        self.unique_indexes.pop(name, None)
+
+    def index_key(self, index: Dict[str, Any], document: Dict[str, Any]) -> Optional[tuple]:
+        if index["partial"] and not matches(document, index["partial"]):
+            return None
+        return tuple(hashable(first_value(document, field)) for field in index["fields"])
+
+    def check_unique(self, document: Dict[str, Any], replacing: Optional[Dict[str, Any]] = None):
+        if replacing is None and document["_id"] in self.documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_", 11000)
+        for name, index in self.unique_indexes.items():
+            key = self.index_key(index, document)
+            if key is not None and index["entries"].get(key, document["_id"]) != document["_id"]:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {name}", 11000)
+
+    def store(self, document: Dict[str, Any], previous: Optional[Dict[str, Any]] = None):
+        self.check_unique(document, previous)
+        if previous is not None:
+            self.unindex(previous)
+        self.documents[document["_id"]] = document
+        for index in self.unique_indexes.values():
+            key = self.index_key(index, document)
+            if key is not None:
+                index["entries"][key] = document["_id"]
+
+    def unindex(self, document: Dict[str, Any]):
+        for index in self.unique_indexes.values():
+            key = self.index_key(index, document)
+            if key is not None and index["entries"].get(key) == document["_id"]:
+                del index["entries"][key]
+
+    # Selection
+    def select(self, query: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Dict[int, float]]:
+        query = normalize(query)
+        scores: Dict[int, float] = {}
+        if "_id" in query and not isinstance(query["_id"], dict):
+            document = self.documents.get(query["_id"])
+            candidates: Iterator[Dict[str, Any]] = iter([document] if document else [])
+        else:
+            candidates = iter(self.documents.values())
+        selected = [document for document in candidates if matches(document, query)]
+        if "$text" in query:
+            terms = set(tokens(query["$text"]["$search"]))
+            scored = []
+            for document in selected:
+                score = sum(
+                    weight * sum(1 for token in tokens(first_value(document, field)) if token in terms)
+                    for field, weight in self.text_weights.items()
+                )
+                if score:
+                    scores[id(document)] = score
+                    scored.append(document)
+            selected = scored
+        return selected, scores
+
+    # Reads
+    def find(self, filter: Optional[Dict[str, Any]] = None, projection: Optional[Dict[str, Any]] = None, **kwargs) -> MemoryCursor:
+        cursor = MemoryCursor(self, filter or {}, projection)
+        if kwargs.get("sort"):
+            cursor.sort(kwargs["sort"])
+        if kwargs.get("limit"):
+            cursor.limit(kwargs["limit"])
+        return cursor
+
+    async def find_one(self, filter: Optional[Dict[str, Any]] = None, projection: Optional[Dict[str, Any]] = None, **kwargs) -> Optional[Dict[str, Any]]:
+        results = self.find(filter, projection, sort=kwargs.get("sort")).limit(1).results()
+        return results[0] if results else None
+
+    async def count_documents(self, filter: Dict[str, Any], **kwargs) -> int:
+        return len(self.select(filter)[0])
+
+    async def estimated_document_count(self, **kwargs) -> int:
+        return len(self.documents)
+
+    async def distinct(self, key: str, filter: Optional[Dict[str, Any]] = None) -> List[Any]:
+        values: List[Any] = []
+        for document in self.select(filter or {})[0]:
+            for value in path_values(document, key):
+                if not isinstance(value, list) and value not in values:
+                    values.append(value)
+        return values
+
+    def aggregate(self, pipeline: List[Dict[str, Any]], **kwargs) -> MemoryAggregationCursor:
+        return MemoryAggregationCursor(self, pipeline)
+
+    # Writes
+    def insert_document(self, document: Dict[str, Any]):
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        self.store(normalize(document))
+
+    async def insert_one(self, document: Dict[str, Any], **kwargs):
+        self.insert_document(document)
+        return Results(inserted_id=document["_id"])
+
+    async def insert_many(self, documents: List[Dict[str, Any]], ordered: bool = True, **kwargs):
+        inserted, errors = [], []
+        for index, document in enumerate(documents):
+            try:
+                self.insert_document(document)
+                inserted.append(document["_id"])
+            except DuplicateKeyError as exc:
+                errors.append({"index": index, "code": 11000, "errmsg": str(exc), "op": document})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(inserted), "writeConcernErrors": []})
+        return Results(inserted_ids=inserted)
+
+    def update_documents(self, filter: Dict[str, Any], update: Any, upsert: bool, many: bool, replace: bool = False):
+        update = normalize(update)
+        matched = self.select(filter)[0]
+        if not many:
+            matched = matched[:1]
+        modified = 0
+        for document in matched:
+            updated = clone(document)
+            if replace:
+                updated = {"_id": document["_id"], **clone(update)}
+            else:
+                apply_update(updated, update, inserting=False)
+            if updated != document:
+                self.store(updated, previous=document)
+                modified += 1
+        upserted_id = None
+        if not matched and upsert:
+            created = normalize(equality_fields(filter))
+            if replace:
+                created = {**({"_id": created["_id"]} if "_id" in created else {}), **clone(update)}
+            else:
+                apply_update(created, update, inserting=True)
+            created.setdefault("_id", ObjectId())
+            self.store(created)
+            upserted_id = created["_id"]
+        return Results(matched_count=len(matched), modified_count=modified, upserted_id=upserted_id), matched
+
+    async def update_one(self, filter: Dict[str, Any], update: Any, upsert: bool = False, **kwargs):
+        return self.update_documents(filter, update, upsert, many=False)[0]
+
+    async def update_many(self, filter: Dict[str, Any], update: Any, upsert: bool = False, **kwargs):
+        return self.update_documents(filter, update, upsert, many=True)[0]
+
+    async def replace_one(self, filter: Dict[str, Any], replacement: Dict[str, Any], upsert: bool = False, **kwargs):
+        return self.update_documents(filter, replacement, upsert, many=False, replace=True)[0]
+
+    async def find_one_and_update(self, filter: Dict[str, Any], update: Any, projection=None, upsert: bool = False, return_document: bool = False, **kwargs):
+        # return_document follows pymongo's ReturnDocument: False is BEFORE, True is AFTER
+        before = await self.find_one(filter, sort=kwargs.get("sort"))
+        result, _ = self.update_documents({"_id": before["_id"]} if before else filter, update, upsert, many=False)
+        if return_document:
+            target = before["_id"] if before else result.upserted_id
+            return await self.find_one({"_id": target}, projection) if target is not None else None
+        return project(before, projection, None) if before else None
+
+    async def delete_one(self, filter: Dict[str, Any], **kwargs):
+        return await self.delete_documents(filter, many=False)
+
+    async def delete_many(self, filter: Dict[str, Any], **kwargs):
+        return await self.delete_documents(filter, many=True)
+
+    async def delete_documents(self, filter: Dict[str, Any], many: bool):
+        matched = self.select(filter)[0]
+        if not many:
+            matched = matched[:1]
+        for document in matched:
+            self.unindex(document)
+            del self.documents[document["_id"]]
+        return Results(deleted_count=len(matched))
+
+    async def bulk_write(self, requests: List[Any], ordered: bool = True, **kwargs):
+        counts = {"inserted_count": 0, "matched_count": 0, "modified_count": 0, "deleted_count": 0, "upserted_count": 0}
+        errors = []
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self.insert_document(request._doc)
+                    counts["inserted_count"] += 1
+                elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+                    result, _ = self.update_documents(
+                        request._filter,
+                        request._doc,
+                        request._upsert,
+                        many=isinstance(request, UpdateMany),
+                        replace=isinstance(request, ReplaceOne)
+                    )
+                    counts["matched_count"] += result.matched_count
+                    counts["modified_count"] += result.modified_count
+                    counts["upserted_count"] += result.upserted_id is not None
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    result = await self.delete_documents(request._filter, many=isinstance(request, DeleteMany))
+                    counts["deleted_count"] += result.deleted_count
+                else:
+                    raise NotImplementedError(f"memory backend does not support {type(request).__name__} in bulk_write")
+            except DuplicateKeyError as exc:
+                errors.append({"index": index, "code": 11000, "errmsg": str(exc)})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": [], **counts})
+        return Results(**counts)
+
+
+class MemoryDatabase:
+    def __init__(self, client: "MemoryClient", name: str):
+        self.client = client
+        self.name = name
+        self.collections: Dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self, name)
+        return self.collections[name]
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def command(self, command: Any, *args, **kwargs) -> Dict[str, Any]:
+        name = command if isinstance(command, str) else next(iter(command))
+        if name in ("ping", "hello", "isMaster", "ismaster"):
+            return {"ok": 1.0}
+        raise OperationFailure(f"memory backend does not support command {name}", 59)
+
+    async def drop_collection(self, name: str):
+        self.collections.pop(name, None)
+
+    async def list_collection_names(self) -> List[str]:
+        return [name for name, collection in self.collections.items() if collection.documents]
+
+
+class MemoryClient:
+    def __init__(self, *args, **kwargs):
+        self.databases: Dict[str, MemoryDatabase] = {}
+        self.admin = MemoryDatabase(self, "admin")
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase(self, name)
+        return self.databases[name]
+
+    async def drop_database(self, name: str):
+        self.databases.pop(name, None)
+
+    def close(self):
+        pass
@@ -0,0 +1,332 @@
+"""Query plan regression check.
+
+Seeds a throwaway database through the API, drives every route in-process
+with a pymongo command listener attached, then re-runs each distinct query
+shape under explain("executionStats"). A shape fails when a filtered query
+scans the whole collection, when the server sorts in memory, or when it
+examines far more documents than it returns.
+
+    MONGO_URL=mongodb://localhost:27017 python query_plan_check.py
+
+Exits non-zero when any query fails, so it can gate CI.
+"""
+import json
+import os
+import random
+import sys
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from pymongo import MongoClient, monitoring
+
+PLAN_CHECK_DB = os.environ.get('PLAN_CHECK_DB', 'query_plan_check')
+# Examined/returned ratio above which a query counts as unselective; tiny
+# scans are ignored because the planner is free to do anything on them
+MAX_EXAMINED_RATIO = float(os.environ.get('PLAN_CHECK_MAX_RATIO', '10'))
+MIN_EXAMINED_DOCS = int(os.environ.get('PLAN_CHECK_MIN_EXAMINED', '100'))
+
+SEED_PRODUCTS = int(os.environ.get('PLAN_CHECK_PRODUCTS', '150'))
+SEED_CUSTOMERS = int(os.environ.get('PLAN_CHECK_CUSTOMERS', '300'))
+SEED_SALES = int(os.environ.get('PLAN_CHECK_SALES', '4000'))
+SEED_DAYS = 30
+
+READ_COMMANDS = {"find", "aggregate", "count", "distinct", "findAndModify"}
+WRITE_COMMANDS = {"update", "delete"}
+# Session and routing fields the driver adds that explain must not see
+DRIVER_FIELDS = {"lsid", "txnNumber", "autocommit", "startTransaction", "$db", "$clusterTime", "$readPreference"}
+
+
+def shape(value: Any) -> Any:
+    """The query with literal values blanked out, so repeats of one query collapse together."""
+    if isinstance(value, dict):
+        return {key: shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [shape(item) for item in value[:1]]
+    return "?"
+
+
+class QueryRecorder(monitoring.CommandListener):
+    """Keeps the first example of every query shape the API sends to the check database."""
+
+    def __init__(self, database: str):
+        self.database = database
+        self.enabled = False
+        self.label = ""
+        self.queries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if not self.enabled or event.database_name != self.database:
+            return
+        if event.command_name not in READ_COMMANDS | WRITE_COMMANDS:
+            return
+        command = {key: value for key, value in event.command.items() if key not in DRIVER_FIELDS}
+        for explainable in split_statements(event.command_name, command):
+            key = json.dumps([event.command_name, shape(explainable)], sort_keys=True, default=str)
+            with self._lock:
+                self.queries.setdefault(key, {
+                    "command_name": event.command_name,
+                    "collection": explainable[event.command_name],
+                    "command": explainable,
+                    "route": self.label
+                })
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def split_statements(command_name: str, command: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Explain takes one update/delete statement at a time; bulk writes carry many."""
+    if command_name == "update":
+        for statement in command.get("updates", []):
+            yield {"update": command["update"], "updates": [statement]}
+    elif command_name == "delete":
+        for statement in command.get("deletes", []):
+            yield {"delete": command["delete"], "deletes": [statement]}
+    elif command_name == "aggregate":
+        # $merge/$out stages cannot run under executionStats; the read side is what matters
+        pipeline = [stage for stage in command["pipeline"] if not {"$merge", "$out"} & set(stage)]
+        yield {**command, "pipeline": pipeline}
+    else:
+        yield command
+
+
+def query_filter(command_name: str, command: Dict[str, Any]) -> Dict[str, Any]:
+    if command_name == "find":
+        return command.get("filter", {})
+    if command_name in ("count", "distinct", "findAndModify"):
+        return command.get("query", {})
+    if command_name == "update":
+        return command["updates"][0].get("q", {})
+    if command_name == "delete":
+        return command["deletes"][0].get("q", {})
+    pipeline = command.get("pipeline", [])
+    return pipeline[0].get("$match", {}) if pipeline else {}
+
+
+def walk_plan(node: Any) -> Iterator[Dict[str, Any]]:
+    """Every dict in an explain document, skipping plans the optimizer rejected."""
+    if isinstance(node, dict):
+        yield node
+        for key, value in node.items():
+            if key not in ("rejectedPlans", "allPlansExecution"):
+                yield from walk_plan(value)
+    elif isinstance(node, list):
+        for item in node:
+            yield from walk_plan(item)
+
+
+def check_plan(query: Dict[str, Any], explain: Dict[str, Any]) -> List[str]:
+    command_name = query["command_name"]
+    nodes = list(walk_plan(explain))
+    stages = {node["stage"] for node in nodes if isinstance(node.get("stage"), str)}
+    problems = []
+
+    # An unfiltered listing reads everything by design; a filtered one must not
+    if "COLLSCAN" in stages and query_filter(command_name, query["command"]):
+        problems.append("collection scan")
+    # Relevance order only exists once the text stage has scored its matches,
+    # so no index can supply a textScore sort; any other SORT is a missing index
+    if any(
+        node.get("stage") == "SORT"
+        and not any(isinstance(key, dict) and "$meta" in key for key in node.get("sortPattern", {}).values())
+        for node in nodes
+    ):
+        problems.append("in-memory sort")
+
+    if command_name in READ_COMMANDS:
+        stats = next((node for node in nodes if "totalDocsExamined" in node and "nReturned" in node), None)
+        if stats:
+            examined, returned = stats["totalDocsExamined"], stats["nReturned"]
+            if examined >= MIN_EXAMINED_DOCS and examined > max(returned, 1) * MAX_EXAMINED_RATIO:
+                problems.append(f"examined {examined} docs to return {returned}")
+    return problems
+
+
+def explain_queries(database, queries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    results = []
+    for query in queries:
+        try:
+            explain = database.command({"explain": query["command"], "verbosity": "executionStats"})
+            problems = check_plan(query, explain)
+        except Exception as exc:
+            problems = [f"explain failed: {exc}"]
+        results.append({**query, "problems": problems})
+    return results
+
+
+def seed(client) -> Dict[str, Any]:
+    """Populate the catalog, people and a month of sales through the API itself."""
+    rng = random.Random(7)
+    categories = ["donuts", "tacos", "kolaches", "croissants", "coffee", "beverages"]
+    products = []
+    for index in range(SEED_PRODUCTS):
+        price = round(rng.uniform(1, 12), 2)
+        response = client.post("/api/products", json={
+            "name": f"Item {index}",
+            "category": categories[index % len(categories)],
+            "price": price,
+            "cost": round(price * rng.uniform(0.2, 0.6), 2)
+        })
+        response.raise_for_status()
+        products.append(response.json())
+    for product in products[:SEED_PRODUCTS // 2]:
+        client.put(f"/api/inventory/{product['id']}", json={"quantity": rng.randint(0, 80)}).raise_for_status()
+
+    customers = [f"Customer {index}" for index in range(SEED_CUSTOMERS)]
+    for name in customers:
+        client.post("/api/customers", json={"name": name}).raise_for_status()
+    employees = [
+        client.post("/api/employees", json={"name": f"Employee {index}", "role": "cashier"}).json()
+        for index in range(10)
+    ]
+
+    now = datetime.now(timezone.utc)
+    queued = []
+    for sequence in range(SEED_SALES):
+        lines = [
+            {"product_id": product["id"], "quantity": rng.randint(1, 4), "price": product["price"]}
+            for product in rng.sample(products, rng.randint(1, 3))
+        ]
+        queued.append({
+            "client_sale_id": str(uuid.uuid4()),
+            "sequence": sequence,
+            "timestamp": (now - timedelta(minutes=rng.randint(1, SEED_DAYS * 24 * 60))).isoformat(),
+            "items": lines,
+            "total_amount": round(sum(line["price"] * line["quantity"] for line in lines), 2),
+            "customer_name": rng.choice(customers) if rng.random() < 0.4 else None,
+            "employee_id": rng.choice(employees)["id"]
+        })
+    for start in range(0, len(queued), 1000):
+        client.post("/api/sync", json={"register_id": "seed", "sales": queued[start:start + 1000]}).raise_for_status()
+
+    ingredients = [
+        client.post("/api/ingredients", json={"name": name, "unit": unit, "min_threshold": 500}).json()
+        for name, unit in [("Flour", "g"), ("Sugar", "g"), ("Oil", "ml"), ("Filling", "g"), ("Eggs", "each")]
+    ]
+    recipe_units = {"g": "lb", "ml": "cup", "each": "each"}
+    for ingredient in ingredients:
+        client.put(f"/api/ingredients/{ingredient['id']}/stock", json={"quantity": 50000}).raise_for_status()
+    for product in products[:20]:
+        client.put(f"/api/products/{product['id']}/recipe", json={
+            "yield_quantity": 12,
+            "lines": [
+                {"ingredient_id": ingredient["id"], "quantity": rng.randint(1, 4), "unit": recipe_units[ingredient["unit"]]}
+                for ingredient in rng.sample(ingredients, 3)
+            ]
+        }).raise_for_status()
+
+    return {"products": products, "employees": employees, "customers": customers, "ingredients": ingredients}
+
+
+def scenario(seeded: Dict[str, Any]) -> List[Tuple[str, str, Optional[Dict[str, Any]]]]:
+    """Every route, in an order where each request has the data it needs."""
+    product = seeded["products"][0]
+    doomed = seeded["products"][-1]
+    employee = seeded["employees"][0]
+    now = datetime.now(timezone.utc)
+    week_ago = quote((now - timedelta(days=7)).isoformat())
+    steps = [
+        ("GET", "/api/products", None),
+        ("GET", "/api/products?category=donuts", None),
+        ("GET", "/api/products/search?q=item", None),
+        ("GET", "/api/products/search?available=true&max_price=6&sort=price", None),
+        ("GET", f"/api/products/{product['id']}", None),
+        ("PUT", f"/api/products/{product['id']}", {"price": product["price"]}),
+        ("GET", "/api/inventory", None),
+        ("GET", f"/api/inventory/{product['id']}", None),
+        ("PUT", f"/api/inventory/{product['id']}", {"quantity": 40}),
+        ("POST", f"/api/inventory/{product['id']}/lots", {"quantity": 12, "expiry_date": (now + timedelta(hours=6)).isoformat()}),
+        ("GET", f"/api/inventory/{product['id']}/lots", None),
+        ("GET", "/api/inventory/expiring", None),
+        ("GET", "/api/inventory/alerts/low-stock", None),
+        ("GET", "/api/ingredients", None),
+        ("GET", "/api/ingredients/stock?status=low_stock", None),
+        ("PUT", f"/api/ingredients/{seeded['ingredients'][0]['id']}/stock", {"quantity": 20, "unit": "kg"}),
+        ("GET", f"/api/products/{product['id']}/recipe", None),
+        ("GET", "/api/inventory/forecast?refresh=true", None),
+        ("POST", "/api/inventory/forecast/apply", None),
+        ("POST", "/api/sales", {
+            "items": [{"product_id": product["id"], "quantity": 2, "price": product["price"]}],
+            "total_amount": round(product["price"] * 2, 2),
+            "customer_name": seeded["customers"][0],
+            "employee_id": employee["id"]
+        }),
+        ("POST", "/api/sync", {"register_id": "plan-check", "since_token": None, "sales": []}),
+        ("GET", "/api/sales", None),
+        ("GET", f"/api/sales?start={week_ago}", None),
+        ("GET", "/api/sales/analytics/daily", None),
+        ("GET", "/api/sales/analytics/category", None),
+        ("POST", f"/api/analytics/margin/rebuild?start={week_ago}", None),
+        ("GET", "/api/employees", None),
+        ("POST", "/api/shifts/clock-in", {"employee_id": employee["id"]}),
+        ("GET", "/api/shifts", None),
+        ("GET", "/api/analytics/labor", None),
+        ("GET", "/api/customers", None),
+        ("GET", "/api/dashboard/overview", None),
+        ("GET", "/api/stores", None),
+        ("GET", "/api/jobs", None),
+        ("DELETE", f"/api/products/{doomed['id']}", None),
+    ]
+    steps += [("GET", f"/api/analytics/margin?group_by={group}&start={week_ago}", None)
+              for group in ("product", "category", "hour", "employee")]
+    steps += [("POST", f"/api/jobs/{name}/run", None)
+              for name in ("rollup_compaction", "daily_close", "sales_archival", "forecast_refresh", "expiry_sweep",
+                           "customer_scoring", "sale_replay")]
+    yesterday = (now - timedelta(days=1)).date().isoformat()
+    steps += [("GET", f"/api/reports/daily/{yesterday}", None), ("GET", f"/api/reports/daily/{yesterday}?format=csv", None)]
+    steps += [("GET", "/api/customers/segments", None), ("GET", "/api/customers/segments?segment=champions", None)]
+    steps += [("GET", "/api/analytics/heatmap", None), ("GET", f"/api/analytics/heatmap?product_id={seeded['products'][0]['id']}", None),
+              ("GET", "/api/analytics/heatmap?category=donuts", None), ("GET", "/api/analytics/heatmap/peaks", None)]
+    steps += [("GET", "/api/production/queue", None)]
+    return steps
+
+
+def run_check() -> List[Dict[str, Any]]:
+    """Seed, drive the API and explain what it sent; returns one result per query shape."""
+    os.environ['DB_NAME'] = PLAN_CHECK_DB
+    os.environ['SCHEDULER_ENABLED'] = 'false'
+    from fastapi.testclient import TestClient
+    import server
+
+    direct = MongoClient(os.environ['MONGO_URL'])
+    direct.drop_database(PLAN_CHECK_DB)
+    recorder = QueryRecorder(PLAN_CHECK_DB)
+    server.app.state.db_event_listeners = [recorder]
+    try:
+        with TestClient(server.app) as client:
+            seeded = seed(client)
+            recorder.enabled = True
+            for method, path, body in scenario(seeded):
+                recorder.label = f"{method} {path.split('?')[0]}"
+                response = client.request(method, path, json=body)
+                if response.status_code >= 400:
+                    raise RuntimeError(f"{recorder.label} returned {response.status_code}: {response.text}")
+            recorder.enabled = False
+        return explain_queries(direct[PLAN_CHECK_DB], list(recorder.queries.values()))
+    finally:
+        server.app.state.db_event_listeners = None
+        direct.drop_database(PLAN_CHECK_DB)
+        direct.close()
+
+
+def main() -> int:
+    results = run_check()
+    failures = [result for result in results if result["problems"]]
+    for result in results:
+        status = "FAIL" if result["problems"] else "ok"
+        print(f"{status:4} {result['command_name']:13} {result['collection']:18} {result['route']}")
+        for problem in result["problems"]:
+            print(f"       {problem}: {json.dumps(query_filter(result['command_name'], result['command']), default=str)}")
+    print(f"\n{len(results)} query shapes explained, {len(failures)} failing")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
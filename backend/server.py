@@ -1,26 +1,101 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
+from starlette.datastructures import Headers, MutableHeaders
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, DeleteOne, IndexModel, ReplaceOne, UpdateMany, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+import asyncio
+import csv
+import hmac
+import importlib.util
+import io
+import ipaddress
+import math
 import os
+import socket
+import sys
+import threading
+import time
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Awaitable, Callable, Type
 import uuid
-from datetime import datetime, timezone
+import base64
+import json
+import zlib
+from datetime import date, datetime, timedelta, timezone
 from enum import Enum
+from zoneinfo import ZoneInfo
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# MongoDB connection, opened by the lifespan handler rather than at import
+client: Any = None
+db: Any = None
+
+# STORAGE_BACKEND=memory swaps Motor for the in-process stand-in in memory_db.py,
+# which implements the same collection API for the queries this module sends
+def connect_db(event_listeners: Optional[list] = None):
+    global client, db
+    if os.environ.get('STORAGE_BACKEND', 'mongo') == 'memory':
+        from memory_db import MemoryClient
+        client = MemoryClient()
+    else:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'], event_listeners=event_listeners or [])
+    db = client[os.environ['DB_NAME']]
+
+# Every location-scoped document carries a store_id; requests that don't name a store use this one
+DEFAULT_STORE_ID = os.environ.get('DEFAULT_STORE_ID', 'main')
+
+# Phase timings from the last startup, served at /api/health/startup
+startup_report: Dict[str, Any] = {"ready": False}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    phases: Dict[str, float] = {}
+
+    async def timed(name: str, awaitable: Awaitable[Any]):
+        phase_started = time.perf_counter()
+        await awaitable
+        phases[name] = round((time.perf_counter() - phase_started) * 1000, 1)
+
+    # Tooling such as query_plan_check.py attaches pymongo command listeners here
+    listeners = list(getattr(app.state, 'db_event_listeners', None) or [])
+    if PROFILING_TOKEN:
+        listeners.append(ProfileCommandListener())
+    connect_db(listeners)
+    # Independent startup work runs concurrently so the worker is ready sooner
+    await asyncio.gather(
+        timed("connect", client.admin.command("ping")),
+        timed("indexes", ensure_indexes()),
+        timed("warm_caches", warm_caches())
+    )
+    if os.environ.get('SCHEDULER_ENABLED', 'true').lower() == 'true':
+        scheduler.start()
+
+    startup_report.update(
+        ready=True,
+        started_at=datetime.now(timezone.utc),
+        phases_ms=phases,
+        total_ms=round((time.perf_counter() - started) * 1000, 1)
+    )
+    logger.info("Startup finished in %.1f ms %s", startup_report["total_ms"], phases)
+    yield
+
+    startup_report["ready"] = False
+    await scheduler.stop()
+    client.close()
 
 # Create the main app without a prefix
-app = FastAPI(title="Marq' E Donuts Management System")
+app = FastAPI(title="Marq' E Donuts Management System", lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -45,6 +120,51 @@ class EmployeeRole(str, Enum):
     BAKER = "baker"
     PREP_COOK = "prep_cook"
 
+class MarginGroupBy(str, Enum):
+    PRODUCT = "product"
+    CATEGORY = "category"
+    HOUR = "hour"
+    EMPLOYEE = "employee"
+
+class IngredientUnit(str, Enum):
+    GRAM = "g"
+    MILLILITER = "ml"
+    EACH = "each"
+
+class ProductSort(str, Enum):
+    RELEVANCE = "relevance"
+    NAME = "name"
+    PRICE = "price"
+    PREP_TIME = "prep_time"
+    CREATED_AT = "created_at"
+
+class SortOrder(str, Enum):
+    ASC = "asc"
+    DESC = "desc"
+
+class ReportFormat(str, Enum):
+    JSON = "json"
+    CSV = "csv"
+
+class ProfileFormat(str, Enum):
+    JSON = "json"
+    COLLAPSED = "collapsed"  # folded stacks for flamegraph.pl or speedscope
+
+class ProductionStatus(str, Enum):
+    LATE = "late"  # stock runs out before a batch started now would be ready
+    START_NOW = "start_now"
+    UPCOMING = "upcoming"
+    RESTOCK = "restock"  # below threshold with no recent sales
+
+class CustomerSegment(str, Enum):
+    CHAMPIONS = "champions"
+    LOYAL = "loyal"
+    NEW = "new"
+    PROMISING = "promising"
+    NEEDS_ATTENTION = "needs_attention"
+    AT_RISK = "at_risk"
+    HIBERNATING = "hibernating"
+
 # Data Models
 class Product(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -82,8 +202,19 @@ class ProductUpdate(BaseModel):
     is_available: Optional[bool] = None
     image_url: Optional[str] = None
 
+class Store(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    address: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class StoreCreate(BaseModel):
+    name: str
+    address: Optional[str] = None
+
 class InventoryItem(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    store_id: str = DEFAULT_STORE_ID
     product_id: str
     quantity: int
     min_threshold: int = 10
@@ -91,23 +222,84 @@ class InventoryItem(BaseModel):
     status: StockStatus
     last_restocked: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     expiry_date: Optional[datetime] = None
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class InventoryUpdate(BaseModel):
     quantity: Optional[int] = None
     min_threshold: Optional[int] = None
     max_capacity: Optional[int] = None
 
+class InventoryLot(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    store_id: str = DEFAULT_STORE_ID
+    product_id: str
+    quantity: int
+    initial_quantity: int
+    expiry_date: Optional[datetime] = None
+    received_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class InventoryLotCreate(BaseModel):
+    quantity: int = Field(gt=0)
+    expiry_date: Optional[datetime] = None
+
+class Ingredient(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    unit: IngredientUnit  # stock is always counted in this base unit
+    cost_per_unit: float = 0.0
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class IngredientCreate(BaseModel):
+    name: str
+    unit: IngredientUnit
+    cost_per_unit: float = 0.0
+    min_threshold: float = 0.0
+
+class IngredientStock(BaseModel):
+    store_id: str = DEFAULT_STORE_ID
+    ingredient_id: str
+    quantity: float = 0.0
+    min_threshold: float = 0.0
+    status: StockStatus = StockStatus.OUT_OF_STOCK
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class IngredientStockUpdate(BaseModel):
+    quantity: Optional[float] = Field(None, ge=0)
+    unit: Optional[str] = None  # quantity's unit when it isn't the ingredient's base unit
+    min_threshold: Optional[float] = Field(None, ge=0)
+
+class RecipeLine(BaseModel):
+    ingredient_id: str
+    quantity: float = Field(gt=0)
+    unit: str
+
+class RecipeCreate(BaseModel):
+    lines: List[RecipeLine]
+    yield_quantity: float = Field(1.0, gt=0)  # how many units of the product one batch makes
+
+class Recipe(BaseModel):
+    product_id: str
+    lines: List[RecipeLine]
+    yield_quantity: float = 1.0
+    per_unit: Dict[str, float] = {}  # ingredient_id -> base units used per product sold
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
 class Sale(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    items: List[Dict[str, Any]]  # [{"product_id": str, "quantity": int, "price": float}]
+    store_id: str = DEFAULT_STORE_ID
+    items: List[Dict[str, Any]]  # [{"product_id": str, "quantity": int, "price": float, "cost": float, "category": str}]
     total_amount: float
     payment_method: str = "cash"
     customer_name: Optional[str] = None
     employee_id: Optional[str] = None
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     order_type: str = "dine_in"  # dine_in, takeout, catering
+    register_id: Optional[str] = None
+    client_sale_id: Optional[str] = None
+    sequence: Optional[int] = None
 
 class SaleCreate(BaseModel):
+    store_id: str = DEFAULT_STORE_ID
     items: List[Dict[str, Any]]
     total_amount: float
     payment_method: str = "cash"
@@ -115,8 +307,26 @@ class SaleCreate(BaseModel):
     employee_id: Optional[str] = None
     order_type: str = "dine_in"
 
+class QueuedSale(BaseModel):
+    client_sale_id: str
+    sequence: int
+    timestamp: datetime
+    items: List[Dict[str, Any]]
+    total_amount: float
+    payment_method: str = "cash"
+    customer_name: Optional[str] = None
+    employee_id: Optional[str] = None
+    order_type: str = "dine_in"
+
+class SyncRequest(BaseModel):
+    register_id: str
+    store_id: str = DEFAULT_STORE_ID
+    since_token: Optional[str] = None
+    sales: List[QueuedSale] = Field(default=[], max_length=2000)
+
 class Employee(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    store_id: str = DEFAULT_STORE_ID
     name: str
     role: EmployeeRole
     email: Optional[str] = None
@@ -126,12 +336,34 @@ class Employee(BaseModel):
     is_active: bool = True
 
 class EmployeeCreate(BaseModel):
+    store_id: str = DEFAULT_STORE_ID
     name: str
     role: EmployeeRole
     email: Optional[str] = None
     phone: Optional[str] = None
     hourly_wage: float = 15.0
 
+class Shift(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    store_id: str = DEFAULT_STORE_ID
+    employee_id: str
+    hourly_wage: float
+    clock_in: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    clock_out: Optional[datetime] = None
+
+class ClockIn(BaseModel):
+    employee_id: str
+    clock_in: Optional[datetime] = None
+
+class ClockOut(BaseModel):
+    clock_out: Optional[datetime] = None
+
+class CustomerRFM(BaseModel):
+    recency: int  # 1-5 quintile scores, 5 is best
+    frequency: int
+    monetary: int
+    segment: CustomerSegment
+
 class Customer(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
@@ -140,6 +372,8 @@ class Customer(BaseModel):
     total_orders: int = 0
     total_spent: float = 0.0
     loyalty_points: int = 0
+    last_order_at: Optional[datetime] = None
+    rfm: Optional[CustomerRFM] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class CustomerCreate(BaseModel):
@@ -156,6 +390,2439 @@ def update_stock_status(quantity: int, min_threshold: int) -> StockStatus:
     else:
         return StockStatus.IN_STOCK
 
+def as_utc(value: datetime) -> datetime:
+    # Mongo hands back naive datetimes; everything we store is UTC
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def start_of_day(value: Optional[datetime] = None) -> datetime:
+    value = as_utc(value) if value else datetime.now(timezone.utc)
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def hour_bucket(value: datetime) -> datetime:
+    return as_utc(value).replace(minute=0, second=0, microsecond=0)
+
+_known_store_ids = {DEFAULT_STORE_ID}
+
+async def list_store_ids() -> List[str]:
+    stores = await db.stores.find({}, {"_id": 0, "id": 1}).to_list(None)
+    _known_store_ids.update(store["id"] for store in stores)
+    return sorted(_known_store_ids)
+
+async def ensure_store(store_id: str) -> str:
+    # Store ids are cached per worker; a miss re-reads the stores collection once
+    if store_id not in _known_store_ids:
+        await list_store_ids()
+        if store_id not in _known_store_ids:
+            raise HTTPException(status_code=404, detail="Store not found")
+    return store_id
+
+async def store_scope(store_id: str = Query(DEFAULT_STORE_ID)) -> str:
+    return await ensure_store(store_id)
+
+def sparse_fields(fields: Optional[str], model: Type[BaseModel]) -> Optional[Dict[str, int]]:
+    """Mongo projection for a comma-separated fields= parameter, or None for whole documents."""
+    if not fields:
+        return None
+    requested = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = sorted(name for name in requested if name.split(".")[0] not in model.__fields__)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    if "id" in model.__fields__:
+        requested.add("id")
+    # A whole field wins over paths inside it; Mongo rejects both at once
+    requested = {name for name in requested if "." not in name or name.split(".")[0] not in requested}
+    return {"_id": 0, **{name: 1 for name in sorted(requested)}}
+
+def sparse_response(documents: List[Dict[str, Any]]) -> JSONResponse:
+    # Partial documents can't satisfy the route's response_model, so they skip it
+    return JSONResponse(jsonable_encoder(documents))
+
+async def get_product_map(product_ids) -> Dict[str, Dict[str, Any]]:
+    product_ids = list(set(product_ids))
+    if not product_ids:
+        return {}
+    products = await db.products.find({"id": {"$in": product_ids}}).to_list(len(product_ids))
+    return {product["id"]: product for product in products}
+
+def stamp_sale_items(items: List[Dict[str, Any]], products: Dict[str, Dict[str, Any]]):
+    # Freeze cost and category on each line so margins survive later catalog edits
+    for item in items:
+        product = products.get(item["product_id"])
+        if product:
+            item.setdefault("cost", product["cost"])
+            item.setdefault("category", product["category"])
+
+ROLLUP_KEY = ("store_id", "bucket", "product_id", "employee_id")
+
+def rollup_lines(sale: Dict[str, Any]) -> Dict[tuple, Dict[str, Any]]:
+    bucket = hour_bucket(sale["timestamp"])
+    store_id = sale.get("store_id", DEFAULT_STORE_ID)
+    lines = {}
+    for item in sale["items"]:
+        key = (store_id, bucket, item["product_id"], sale.get("employee_id"))
+        line = lines.setdefault(key, {
+            "category": item.get("category"),
+            "quantity": 0,
+            "revenue": 0.0,
+            "cogs": 0.0,
+            "lines": 0
+        })
+        line["quantity"] += item["quantity"]
+        line["revenue"] += item["price"] * item["quantity"]
+        line["cogs"] += item.get("cost", 0.0) * item["quantity"]
+        line["lines"] += 1
+    return lines
+
+async def update_sales_rollups(sales: List[Dict[str, Any]]):
+    lines: Dict[tuple, Dict[str, Any]] = {}
+    for sale in sales:
+        for key, line in rollup_lines(sale).items():
+            if key in lines:
+                for field in ("quantity", "revenue", "cogs", "lines"):
+                    lines[key][field] += line[field]
+            else:
+                lines[key] = line
+
+    operations = [
+        UpdateOne(
+            dict(zip(ROLLUP_KEY, key)),
+            {
+                "$inc": {
+                    "quantity": line["quantity"],
+                    "revenue": line["revenue"],
+                    "cogs": line["cogs"],
+                    "lines": line["lines"]
+                },
+                "$setOnInsert": {"category": line["category"]}
+            },
+            upsert=True
+        )
+        for key, line in lines.items()
+    ]
+    if operations:
+        await db.sales_rollups.bulk_write(operations, ordered=False)
+
+# Weekday x hour heatmaps, one counter document per store, category and
+# product. Slots are keyed weekday * 24 + hour in the store's local time,
+# so a document never grows past 168 entries per counter and a read is a
+# single indexed lookup.
+STORE_TIMEZONE = ZoneInfo(os.environ.get('STORE_TIMEZONE', 'UTC'))
+WEEKDAY_NAMES = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+def heatmap_slot(timestamp: datetime) -> int:
+    local = as_utc(timestamp).astimezone(STORE_TIMEZONE)
+    return local.weekday() * 24 + local.hour
+
+async def update_sales_heatmaps(store_id: str, sales: List[Dict[str, Any]]):
+    counters: Dict[tuple, Dict[str, Any]] = {}
+    for sale in sales:
+        slot = str(heatmap_slot(sale["timestamp"]))
+        units: Dict[tuple, int] = {("store", "all"): 0}
+        for item in sale["items"]:
+            for key in (("product", item["product_id"]), ("category", item.get("category"))):
+                if key[1] is not None:
+                    units[key] = units.get(key, 0) + item["quantity"]
+            units[("store", "all")] += item["quantity"]
+        for key, quantity in units.items():
+            counter = counters.setdefault(key, {"inc": {}, "first_sale_at": sale["timestamp"]})
+            # A sale counts once as an order for every product and category it contains
+            counter["inc"][f"orders.{slot}"] = counter["inc"].get(f"orders.{slot}", 0) + 1
+            counter["inc"][f"units.{slot}"] = counter["inc"].get(f"units.{slot}", 0) + quantity
+            counter["first_sale_at"] = min(counter["first_sale_at"], sale["timestamp"])
+
+    operations = [
+        UpdateOne(
+            {"store_id": store_id, "dimension": dimension, "key": key},
+            {"$inc": counter["inc"], "$min": {"first_sale_at": counter["first_sale_at"]}},
+            upsert=True
+        )
+        for (dimension, key), counter in counters.items()
+    ]
+    if operations:
+        await db.sales_heatmaps.bulk_write(operations, ordered=False)
+
+def heatmap_matrix(counts: Dict[str, int]) -> List[List[int]]:
+    return [[counts.get(str(day * 24 + hour), 0) for hour in range(24)] for day in range(7)]
+
+def weekdays_observed(first_sale_at: datetime, weekday: int, until: date) -> int:
+    """How many times a weekday has occurred from the first recorded sale up to, not including, until."""
+    first = as_utc(first_sale_at).astimezone(STORE_TIMEZONE).date()
+    span = (until - first).days
+    if span <= 0:
+        return 0
+    return span // 7 + (1 if (weekday - first.weekday()) % 7 < span % 7 else 0)
+
+async def rebuild_sales_rollups(store_id: str, start: datetime, end: datetime) -> int:
+    """Recompute one store's hourly rollups for [start, end) from raw sales.
+
+    Only closed hours are rebuilt, since the open hour is still taking live
+    $inc upserts. Buckets are replaced key by key rather than deleted and
+    reinserted, so readers never see the window empty.
+    """
+    start, end = hour_bucket(start), min(hour_bucket(end), hour_bucket(datetime.now(timezone.utc)))
+    if start >= end:
+        return 0
+    sales = await find_sales_range(store_id, start, end)
+    products = await get_product_map(
+        item["product_id"] for sale in sales for item in sale["items"]
+    )
+
+    totals = {}
+    for sale in sales:
+        stamp_sale_items(sale["items"], products)
+        for key, line in rollup_lines(sale).items():
+            total = totals.setdefault(key, {**line, "quantity": 0, "revenue": 0.0, "cogs": 0.0, "lines": 0})
+            for field in ("quantity", "revenue", "cogs", "lines"):
+                total[field] += line[field]
+
+    existing = await db.sales_rollups.find(
+        {"store_id": store_id, "bucket": {"$gte": start, "$lt": end}},
+        {"_id": 1, **{field: 1 for field in ROLLUP_KEY}}
+    ).to_list(None)
+    operations = [
+        ReplaceOne(dict(zip(ROLLUP_KEY, key)), {**dict(zip(ROLLUP_KEY, key)), **line}, upsert=True)
+        for key, line in totals.items()
+    ] + [
+        DeleteOne({"_id": row["_id"]})
+        for row in existing
+        if (row["store_id"], as_utc(row["bucket"]), row["product_id"], row.get("employee_id")) not in totals
+    ]
+    if operations:
+        await db.sales_rollups.bulk_write(operations, ordered=False)
+    return len(totals)
+
+# Shifts longer than this are treated as a missed clock-out and capped, which
+# also bounds how far back a range query has to look for overlapping shifts
+MAX_SHIFT_HOURS = 16
+
+def split_into_hours(start: datetime, end: datetime) -> List[tuple]:
+    """Break [start, end) into (hour bucket, hours worked in that bucket) pairs."""
+    pieces = []
+    cursor = as_utc(start)
+    end = as_utc(end)
+    while cursor < end:
+        bucket = hour_bucket(cursor)
+        piece_end = min(bucket + timedelta(hours=1), end)
+        pieces.append((bucket, (piece_end - cursor).total_seconds() / 3600))
+        cursor = piece_end
+    return pieces
+
+async def get_shifts_overlapping(store_id: str, start: datetime, end: datetime) -> List[Dict[str, Any]]:
+    return await db.shifts.find({
+        "store_id": store_id,
+        "clock_in": {"$gte": start - timedelta(hours=MAX_SHIFT_HOURS), "$lt": end},
+        "$or": [{"clock_out": None}, {"clock_out": {"$gt": start}}]
+    }).to_list(None)
+
+def margin_summary(revenue: float, cogs: float) -> Dict[str, float]:
+    gross_margin = revenue - cogs
+    return {
+        "revenue": round(revenue, 2),
+        "cogs": round(cogs, 2),
+        "gross_margin": round(gross_margin, 2),
+        "margin_pct": round(gross_margin / revenue * 100, 2) if revenue else 0
+    }
+
+async def compute_demand_forecast(
+    store_id: str,
+    history_days: int = 28,
+    horizon_days: int = 7,
+    lead_days: int = 1,
+    review_days: int = 1,
+    service_z: float = 1.65
+) -> List[Dict[str, Any]]:
+    """Fit day-of-week and hour-of-day baselines for every SKU in one pass.
+
+    Daily and hourly unit series are pulled from the sales rollups with two
+    aggregations and laid out as (products x days) and (products x hours)
+    matrices, so the fit is a handful of array operations regardless of how
+    many SKUs the store carries.
+    """
+    # NumPy is only needed here, so keep it off the import path
+    import numpy as np
+
+    end = start_of_day()
+    start = end - timedelta(days=history_days)
+    match = {"$match": {"store_id": store_id, "bucket": {"$gte": start, "$lt": end}}}
+    daily_rows, hourly_rows = await asyncio.gather(
+        db.sales_rollups.aggregate([
+            match,
+            {"$group": {
+                "_id": {
+                    "product_id": "$product_id",
+                    "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$bucket"}}
+                },
+                "quantity": {"$sum": "$quantity"}
+            }}
+        ]).to_list(None),
+        db.sales_rollups.aggregate([
+            match,
+            {"$group": {
+                "_id": {"product_id": "$product_id", "hour": {"$hour": "$bucket"}},
+                "quantity": {"$sum": "$quantity"}
+            }}
+        ]).to_list(None)
+    )
+    if not daily_rows:
+        return []
+
+    product_ids = sorted({row["_id"]["product_id"] for row in daily_rows})
+    index = {product_id: i for i, product_id in enumerate(product_ids)}
+    first_day = np.datetime64(start.date(), "D")
+
+    units = np.zeros((len(product_ids), history_days))
+    np.add.at(
+        units,
+        (
+            np.array([index[row["_id"]["product_id"]] for row in daily_rows]),
+            (np.array([row["_id"]["day"] for row in daily_rows], dtype="datetime64[D]") - first_day).astype(int)
+        ),
+        np.array([row["quantity"] for row in daily_rows], dtype=float)
+    )
+
+    hourly = np.zeros((len(product_ids), 24))
+    np.add.at(
+        hourly,
+        (
+            np.array([index[row["_id"]["product_id"]] for row in hourly_rows], dtype=int),
+            np.array([row["_id"]["hour"] for row in hourly_rows], dtype=int)
+        ),
+        np.array([row["quantity"] for row in hourly_rows], dtype=float)
+    )
+    hourly_profile = hourly / np.maximum(hourly.sum(axis=1, keepdims=True), 1)
+
+    # 1970-01-01 was a Thursday, so (days since epoch + 3) % 7 gives Monday=0
+    day_numbers = first_day.astype(int) + np.arange(history_days)
+    weekdays = (day_numbers + 3) % 7
+    weekday_onehot = np.eye(7)[weekdays]
+    baseline = units @ weekday_onehot / np.maximum(weekday_onehot.sum(axis=0), 1)
+    residual_std = (units - baseline[:, weekdays]).std(axis=1)
+
+    # Scale the seasonal baseline by how the last week compares to the window
+    recent = units[:, -7:].mean(axis=1)
+    overall = units.mean(axis=1)
+    trend = np.clip(np.divide(recent, overall, out=np.ones_like(recent), where=overall > 0), 0.5, 2.0)
+
+    horizon_weekdays = (day_numbers[-1] + 1 + np.arange(horizon_days) + 3) % 7
+    forecast = baseline[:, horizon_weekdays] * trend[:, None]
+    cover = np.cumsum(forecast, axis=1)
+
+    min_threshold = np.ceil(cover[:, lead_days - 1] + service_z * residual_std * math.sqrt(lead_days))
+    par_days = min(lead_days + review_days, horizon_days)
+    max_capacity = np.ceil(cover[:, par_days - 1] + service_z * residual_std * math.sqrt(par_days))
+    max_capacity = np.maximum(max_capacity, min_threshold + 1)
+
+    products = await get_product_map(product_ids)
+    generated_at = datetime.now(timezone.utc)
+    params = {
+        "history_days": history_days,
+        "horizon_days": horizon_days,
+        "lead_days": lead_days,
+        "review_days": review_days,
+        "service_z": service_z
+    }
+    return [
+        {
+            "store_id": store_id,
+            "product_id": product_id,
+            "name": products.get(product_id, {}).get("name"),
+            "generated_at": generated_at,
+            "history_days": history_days,
+            "params": params,
+            "weekday_baseline": np.round(baseline[i], 2).tolist(),
+            "hourly_profile": np.round(hourly_profile[i], 4).tolist(),
+            "daily_forecast": np.round(forecast[i], 2).tolist(),
+            "suggested_min_threshold": int(min_threshold[i]),
+            "suggested_max_capacity": int(max_capacity[i])
+        }
+        for i, product_id in enumerate(product_ids)
+    ]
+
+async def refresh_forecasts(store_id: str, **params) -> List[Dict[str, Any]]:
+    forecasts = await compute_demand_forecast(store_id, **params)
+    if forecasts:
+        await db.forecasts.bulk_write([
+            ReplaceOne({"store_id": store_id, "product_id": forecast["product_id"]}, forecast, upsert=True)
+            for forecast in forecasts
+        ], ordered=False)
+        await db.forecasts.delete_many({
+            "store_id": store_id,
+            "generated_at": {"$lt": forecasts[0]["generated_at"]}
+        })
+    return forecasts
+
+async def backfill_last_orders() -> int:
+    """Seed last_order_at for customers who ordered before it was tracked.
+
+    The newest hot sale wins; customers with none left there are looked up
+    in each store's archive, newest day first. Customers with no sale
+    anywhere get an explicit null so later runs don't search for them again.
+    Returns how many customers were seeded.
+    """
+    missing = await db.customers.find(
+        {"total_orders": {"$gt": 0}, "last_order_at": {"$exists": False}},
+        {"_id": 0, "name": 1}
+    ).to_list(None)
+    if not missing:
+        return 0
+    names = {customer["name"] for customer in missing}
+    store_ids = await list_store_ids()
+    # Sales are read per store so each lookup rides a store-prefixed index
+    latest: Dict[str, datetime] = {}
+    for store_id in store_ids:
+        rows = await db.sales.aggregate([
+            {"$match": {"store_id": store_id, "customer_name": {"$in": list(names)}}},
+            {"$group": {"_id": "$customer_name", "last_order_at": {"$max": "$timestamp"}}}
+        ]).to_list(None)
+        for row in rows:
+            ordered_at = as_utc(row["last_order_at"])
+            latest[row["_id"]] = max(latest.get(row["_id"], ordered_at), ordered_at)
+
+    archived = names - set(latest)
+    for store_id in store_ids:
+        found: Dict[str, datetime] = {}
+        current_day = None
+        chunks = db.sales_archive.find({"store_id": store_id}, {"day": 1, "data": 1}).sort("day", DESCENDING)
+        async for chunk in chunks:
+            if chunk["day"] != current_day:
+                # A day is read whole, since its chunks aren't in time order
+                if archived.issubset(found):
+                    break
+                current_day = chunk["day"]
+            for sale in unpack_sales(chunk["data"]):
+                name = sale.get("customer_name")
+                if name in archived:
+                    ordered_at = as_utc(sale["timestamp"])
+                    found[name] = max(found.get(name, ordered_at), ordered_at)
+        for name, ordered_at in found.items():
+            latest[name] = max(latest.get(name, ordered_at), ordered_at)
+
+    # The $exists guard leaves anyone who has ordered since untouched
+    await db.customers.bulk_write([
+        UpdateMany({"name": name, "last_order_at": {"$exists": False}}, {"$set": {"last_order_at": latest.get(name)}})
+        for name in names
+    ], ordered=False)
+    return len(latest)
+
+def quintile_scores(values):
+    """Score each value 1-5 by the quintile it falls in; equal values share a score."""
+    import numpy as np
+    ranks = np.searchsorted(np.sort(values), values, side="left")
+    return 1 + ranks * 5 // len(values)
+
+async def score_customers() -> Dict[str, Any]:
+    """Recompute recency/frequency/monetary scores for every customer who has ordered.
+
+    Raw sales are archived away after a few weeks, so the inputs are the
+    lifetime totals and last_order_at that record_sales keeps on each
+    customer, read with one aggregation. Scoring and segmenting are array
+    operations, and only customers whose scores changed are written back.
+    """
+    import numpy as np
+
+    rows = await db.customers.aggregate([
+        {"$match": {"total_orders": {"$gt": 0}}},
+        {"$project": {"last_order_at": 1, "total_orders": 1, "total_spent": 1, "rfm": 1}}
+    ]).to_list(None)
+    scored_at = datetime.now(timezone.utc)
+    segments = list(CustomerSegment)
+    summary: Dict[str, Any] = {"scored_at": scored_at, "customers": len(rows), "updated": 0, "segments": []}
+    if rows:
+        # Customers from before last_order_at was tracked rank as least recent
+        last_order = np.array([as_utc(row["last_order_at"]).timestamp() if row.get("last_order_at") else 0.0 for row in rows])
+        orders = np.array([row["total_orders"] for row in rows], dtype=float)
+        spent = np.array([row.get("total_spent", 0.0) for row in rows], dtype=float)
+        recency, frequency, monetary = quintile_scores(last_order), quintile_scores(orders), quintile_scores(spent)
+        value = (frequency + monetary) / 2
+
+        # Indexes into segments; the first matching rule wins
+        codes = np.select([
+            (recency >= 4) & (orders == 1),
+            (recency >= 4) & (value >= 4),
+            (recency >= 3) & (value >= 3),
+            recency >= 3,
+            (recency == 2) & (value < 3),
+            value >= 3
+        ], [2, 0, 1, 3, 4, 5], default=6)
+
+        operations = []
+        for i, row in enumerate(rows):
+            rfm = {
+                "recency": int(recency[i]),
+                "frequency": int(frequency[i]),
+                "monetary": int(monetary[i]),
+                "segment": segments[codes[i]].value
+            }
+            if row.get("rfm") != rfm:
+                operations.append(UpdateOne({"_id": row["_id"]}, {"$set": {"rfm": rfm}}))
+        if operations:
+            await db.customers.bulk_write(operations, ordered=False)
+
+        counts = np.bincount(codes, minlength=len(segments))
+        totals = np.bincount(codes, weights=spent, minlength=len(segments))
+        summary["updated"] = len(operations)
+        summary["segments"] = [
+            {
+                "segment": segment.value,
+                "customers": int(counts[i]),
+                "total_spent": round(float(totals[i]), 2),
+                "average_spent": round(float(totals[i] / counts[i]), 2) if counts[i] else 0
+            }
+            for i, segment in enumerate(segments)
+        ]
+    await db.system_state.replace_one({"_id": "customer_segments"}, summary, upsert=True)
+    return summary
+
+# Server-side version of update_stock_status, for pipeline updates that never read the row
+STOCK_STATUS_EXPRESSION = {"$switch": {
+    "branches": [
+        {"case": {"$lte": ["$quantity", 0]}, "then": StockStatus.OUT_OF_STOCK.value},
+        {"case": {"$lte": ["$quantity", "$min_threshold"]}, "then": StockStatus.LOW_STOCK.value},
+    ],
+    "default": StockStatus.IN_STOCK.value
+}}
+
+# Re-reads allowed when a lot is drained by someone else mid-sale
+LOT_CONSUME_ATTEMPTS = 5
+
+def lot_order(lot: Dict[str, Any]) -> tuple:
+    # First-expiring first; lots without an expiry go last, oldest received first
+    expiry = lot.get("expiry_date")
+    return (expiry is None, as_utc(expiry) if expiry else None, as_utc(lot["received_at"]))
+
+async def apply_inventory_deltas(
+    store_id: str,
+    deltas: Dict[str, int],
+    earliest_expiry: Optional[Dict[str, Optional[datetime]]] = None
+):
+    """Add signed quantity deltas to the product-level inventory rows in one bulk write, without reading them first."""
+    if not deltas:
+        return
+    now = datetime.now(timezone.utc)
+    operations = []
+    for product_id, delta in deltas.items():
+        update = {"quantity": {"$max": [0, {"$add": ["$quantity", delta]}]}, "updated_at": now}
+        if earliest_expiry is not None and product_id in earliest_expiry:
+            update["expiry_date"] = earliest_expiry[product_id]
+        operations.append(UpdateOne(
+            {"store_id": store_id, "product_id": product_id},
+            [{"$set": update}, {"$set": {"status": STOCK_STATUS_EXPRESSION}}]
+        ))
+    await db.inventory.bulk_write(operations, ordered=False)
+
+async def consume_product_lots(
+    store_id: str,
+    product_id: str,
+    quantity: int,
+    lots: List[Dict[str, Any]]
+) -> tuple:
+    """Draw one product's sold quantity from its open lots, first-expiring first.
+
+    Each lot is decremented with a conditional update. When another sale or
+    the expiry sweep got to a lot first, the lots are re-read and whatever is
+    still owed is drawn from what is left. Returns the earliest expiry still
+    on hand and the units no lot could cover.
+    """
+    remaining = quantity
+    for _ in range(LOT_CONSUME_ATTEMPTS):
+        lost_race = False
+        for lot in sorted(lots, key=lot_order):
+            take = min(remaining, lot["quantity"])
+            if not take:
+                continue
+            result = await db.inventory_lots.update_one(
+                {"store_id": store_id, "id": lot["id"], "quantity": {"$gte": take}},
+                {"$inc": {"quantity": -take}}
+            )
+            if not result.modified_count:
+                lost_race = True
+                break
+            remaining -= take
+            lot["quantity"] -= take
+        if not lost_race:
+            break
+        lots = await db.inventory_lots.find({
+            "store_id": store_id,
+            "product_id": product_id,
+            "quantity": {"$gt": 0}
+        }).to_list(None)
+    open_lots = sorted((lot for lot in lots if lot["quantity"] > 0), key=lot_order)
+    return (open_lots[0].get("expiry_date") if open_lots else None), remaining
+
+async def consume_lots_fifo(store_id: str, quantities: Dict[str, int]) -> Dict[str, Optional[datetime]]:
+    """Draw sold quantities from open lots, first-expiring first.
+
+    Returns the earliest remaining expiry for every product that has lots so
+    the product-level inventory row can be kept in step.
+    """
+    lots = await db.inventory_lots.find({
+        "store_id": store_id,
+        "product_id": {"$in": list(quantities)},
+        "quantity": {"$gt": 0}
+    }).to_list(None)
+
+    by_product: Dict[str, List[Dict[str, Any]]] = {}
+    for lot in lots:
+        by_product.setdefault(lot["product_id"], []).append(lot)
+
+    results = await asyncio.gather(*(
+        consume_product_lots(store_id, product_id, quantities[product_id], product_lots)
+        for product_id, product_lots in by_product.items()
+    ))
+    earliest_expiry = {}
+    for product_id, (expiry, shortfall) in zip(by_product, results):
+        earliest_expiry[product_id] = expiry
+        if shortfall:
+            # The product row is still decremented in full, so lots now under-count it
+            logger.warning(
+                "Lots for product %s in store %s were %d units short of a sale of %d",
+                product_id, store_id, shortfall, quantities[product_id]
+            )
+    return earliest_expiry
+
+async def sweep_expired_lots(store_id: str, now: Optional[datetime] = None) -> Dict[str, Any]:
+    """Write off every open lot in a store past its expiry and log it as waste.
+
+    Each lot is zeroed with find_one_and_update, so only the quantity this
+    sweep actually took is logged and deducted, even if a sale drew from the
+    lot in between.
+    """
+    now = now or datetime.now(timezone.utc)
+    candidates = await db.inventory_lots.find(
+        {"store_id": store_id, "expiry_date": {"$lte": now}, "quantity": {"$gt": 0}},
+        {"_id": 0, "id": 1}
+    ).to_list(None)
+    swept = await asyncio.gather(*(
+        db.inventory_lots.find_one_and_update(
+            {"store_id": store_id, "id": lot["id"], "quantity": {"$gt": 0}},
+            {"$set": {"quantity": 0}}
+        )
+        for lot in candidates
+    ))
+    expired = [lot for lot in swept if lot]
+    if not expired:
+        return {"lots": 0, "units": 0}
+
+    await db.inventory_waste.insert_many([
+        {
+            "store_id": store_id,
+            "lot_id": lot["id"],
+            "product_id": lot["product_id"],
+            "quantity": lot["quantity"],
+            "expiry_date": lot["expiry_date"],
+            "swept_at": now
+        }
+        for lot in expired
+    ])
+
+    deltas: Dict[str, int] = {}
+    for lot in expired:
+        deltas[lot["product_id"]] = deltas.get(lot["product_id"], 0) - lot["quantity"]
+    open_lots = await db.inventory_lots.find({
+        "store_id": store_id,
+        "product_id": {"$in": list(deltas)},
+        "quantity": {"$gt": 0}
+    }).to_list(None)
+    earliest_expiry = {product_id: None for product_id in deltas}
+    for lot in sorted(open_lots, key=lot_order, reverse=True):
+        earliest_expiry[lot["product_id"]] = lot.get("expiry_date")
+    await apply_inventory_deltas(store_id, deltas, earliest_expiry)
+    production_queue.invalidate(store_id)
+
+    return {"lots": len(expired), "units": -sum(deltas.values())}
+
+# Recipe units, each mapped to an ingredient base unit and a conversion factor
+UNIT_CONVERSIONS = {
+    "g": (IngredientUnit.GRAM, 1.0),
+    "kg": (IngredientUnit.GRAM, 1000.0),
+    "oz": (IngredientUnit.GRAM, 28.349523125),
+    "lb": (IngredientUnit.GRAM, 453.59237),
+    "ml": (IngredientUnit.MILLILITER, 1.0),
+    "l": (IngredientUnit.MILLILITER, 1000.0),
+    "tsp": (IngredientUnit.MILLILITER, 4.92892159375),
+    "tbsp": (IngredientUnit.MILLILITER, 14.78676478125),
+    "cup": (IngredientUnit.MILLILITER, 236.5882365),
+    "each": (IngredientUnit.EACH, 1.0),
+    "dozen": (IngredientUnit.EACH, 12.0),
+}
+
+def to_base_units(quantity: float, unit: str, ingredient: Dict[str, Any]) -> float:
+    base_unit, factor = UNIT_CONVERSIONS.get(unit.lower(), (None, None))
+    if base_unit is None:
+        raise HTTPException(status_code=400, detail=f"Unknown unit '{unit}'")
+    if base_unit != ingredient["unit"]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{ingredient['name']} is counted in {ingredient['unit']}, which can't be converted from {unit}"
+        )
+    return quantity * factor
+
+async def apply_ingredient_deltas(store_id: str, deltas: Dict[str, float]):
+    """Add signed deltas (in base units) to ingredient stock in one bulk write, without reading it first."""
+    if not deltas:
+        return
+    now = datetime.now(timezone.utc)
+    await db.ingredient_stock.bulk_write([
+        UpdateOne(
+            {"store_id": store_id, "ingredient_id": ingredient_id},
+            [
+                {"$set": {"quantity": {"$max": [0, {"$add": ["$quantity", delta]}]}, "updated_at": now}},
+                {"$set": {"status": STOCK_STATUS_EXPRESSION}}
+            ]
+        )
+        for ingredient_id, delta in deltas.items()
+    ], ordered=False)
+
+async def deduct_ingredients(store_id: str, quantities: Dict[str, int]):
+    """Draw down the ingredients behind sold products, summed across every line in the batch."""
+    recipes = await db.recipes.find(
+        {"product_id": {"$in": list(quantities)}},
+        {"_id": 0, "product_id": 1, "per_unit": 1}
+    ).to_list(None)
+    usage: Dict[str, float] = {}
+    for recipe in recipes:
+        sold = quantities[recipe["product_id"]]
+        for ingredient_id, amount in recipe["per_unit"].items():
+            usage[ingredient_id] = usage.get(ingredient_id, 0.0) + amount * sold
+    await apply_ingredient_deltas(store_id, {
+        ingredient_id: -round(amount, 6) for ingredient_id, amount in usage.items()
+    })
+
+# A sale whose side effects haven't been confirmed within this long is taken
+# to belong to a request that failed part way, and its side effects are replayed
+SALE_APPLY_LEASE = timedelta(seconds=int(os.environ.get('SALE_APPLY_LEASE_SECONDS', '60')))
+
+async def claim_unapplied_sales(store_id: str, query: Dict[str, Any]) -> tuple:
+    """Take over unapplied sales whose claim has lapsed, so exactly one caller replays them.
+
+    Returns the sales and, by sale id, the side effects that already landed.
+    """
+    now = datetime.now(timezone.utc)
+    claim = str(uuid.uuid4())
+    unapplied = {"store_id": store_id, "applied": False}
+    await db.sales.update_many(
+        {**query, **unapplied, "claimed_at": {"$lte": now - SALE_APPLY_LEASE}},
+        {"$set": {"claim": claim, "claimed_at": now}}
+    )
+    claimed = await db.sales.find({**unapplied, "claimed_at": now, "claim": claim}).to_list(None)
+    done = {sale["id"]: set(sale.get("effects_applied", [])) for sale in claimed}
+    return [Sale(**sale) for sale in claimed], done
+
+def sold_quantities(sales: List[Sale]) -> Dict[str, int]:
+    quantities: Dict[str, int] = {}
+    for sale in sales:
+        for item in sale.items:
+            quantities[item["product_id"]] = quantities.get(item["product_id"], 0) + item["quantity"]
+    return quantities
+
+async def update_customer_totals(sales: List[Sale]):
+    customer_totals: Dict[str, Dict[str, float]] = {}
+    last_orders: Dict[str, datetime] = {}
+    for sale in sales:
+        totals = customer_totals.setdefault(sale.customer_name, {
+            "total_orders": 0,
+            "total_spent": 0.0,
+            "loyalty_points": 0
+        })
+        totals["total_orders"] += 1
+        totals["total_spent"] += sale.total_amount
+        totals["loyalty_points"] += int(sale.total_amount)
+        ordered_at = as_utc(sale.timestamp)
+        last_orders[sale.customer_name] = max(last_orders.get(sale.customer_name, ordered_at), ordered_at)
+    # $max keeps recency right when queued offline sales arrive out of order
+    await db.customers.bulk_write([
+        UpdateOne({"name": name}, {"$inc": totals, "$max": {"last_order_at": last_orders[name]}})
+        for name, totals in customer_totals.items()
+    ], ordered=False)
+
+async def apply_sale_effects(
+    store_id: str,
+    sales: List[Sale],
+    production_entry: Optional[Dict[str, Any]],
+    done: Optional[Dict[str, set]] = None
+):
+    """Apply stock, customer and analytics side effects of stored sales, then mark them applied.
+
+    Each effect is recorded in the sales' effects_applied as soon as it
+    lands, and effects already listed there (done, by sale id) are skipped,
+    so a replay after a partial failure only runs what is still missing.
+    """
+    done = done or {}
+
+    async def run(effects: Dict[str, tuple]) -> Dict[str, Any]:
+        # effects maps a name to (write, sales it applies to); independent writes run together
+        pending = {
+            name: (write, [sale for sale in subset if name not in done.get(sale.id, ())])
+            for name, (write, subset) in effects.items()
+        }
+        pending = {name: work for name, work in pending.items() if work[1]}
+        results = await asyncio.gather(*(write(subset) for write, subset in pending.values()), return_exceptions=True)
+        outcome = dict(zip(pending, results))
+        landed = [name for name, result in outcome.items() if not isinstance(result, BaseException)]
+        await asyncio.gather(*(
+            db.sales.update_many(
+                {"store_id": store_id, "id": {"$in": [sale.id for sale in pending[name][1]]}},
+                {"$addToSet": {"effects_applied": name}}
+            )
+            for name in landed
+        ))
+        for result in outcome.values():
+            if isinstance(result, BaseException):
+                raise result
+        return outcome
+
+    # Draw down lots first-expiring first and the ingredients behind each product
+    stock = await run({
+        "lots": (lambda subset: consume_lots_fifo(store_id, sold_quantities(subset)), sales),
+        "ingredients": (lambda subset: deduct_ingredients(store_id, sold_quantities(subset)), sales)
+    })
+    await run({"inventory": (
+        lambda subset: apply_inventory_deltas(
+            store_id,
+            {product_id: -quantity for product_id, quantity in sold_quantities(subset).items()},
+            stock.get("lots", {})
+        ),
+        sales
+    )})
+    sale_docs = [sale.dict() for sale in sales]
+    documents = {sale.id: doc for sale, doc in zip(sales, sale_docs)}
+    await run({
+        # Only sales naming a known customer touch customer data
+        "customers": (update_customer_totals, [sale for sale in sales if sale.customer_name]),
+        "rollups": (lambda subset: update_sales_rollups([documents[sale.id] for sale in subset]), sales),
+        "heatmaps": (lambda subset: update_sales_heatmaps(store_id, [documents[sale.id] for sale in subset]), sales)
+    })
+    await db.sales.update_many(
+        {"store_id": store_id, "id": {"$in": [sale.id for sale in sales]}},
+        {"$set": {"applied": True}, "$unset": {"claim": "", "claimed_at": "", "effects_applied": ""}}
+    )
+
+    production_queue.record(store_id, sale_docs, production_entry)
+    sale_broadcaster.publish(store_id, sale_docs)
+    sales_columns.append(store_id, sale_docs)
+
+async def record_sales(store_id: str, sales: List[Sale]) -> List[Sale]:
+    """Persist a batch of sales and apply their side effects with bulk writes.
+
+    Sales that carry a client_sale_id already stored for the same register
+    are skipped, so replaying a batch is harmless. Sales are stored
+    unapplied and only marked applied once every side effect has landed; a
+    replay of one left unapplied by a failed request applies it again.
+    Returns the sales that were newly recorded or replayed.
+    """
+    if not sales:
+        return []
+    # Taken before any write so a queue rebuilt mid-batch isn't also updated by it
+    production_entry = production_queue.current(store_id)
+    # A register can queue the same sale twice before it syncs; keep the first
+    unique: Dict[tuple, Sale] = {}
+    for sale in sales:
+        unique.setdefault((sale.register_id, sale.client_sale_id or sale.id), sale)
+    sales = list(unique.values())
+    # Sales old enough to have been archived may have been purged from the
+    # dedupe index; their tombstones catch replays of those
+    archive_horizon = start_of_day() - timedelta(days=SALES_ARCHIVE_AFTER_DAYS)
+    old = [sale for sale in sales if sale.register_id and as_utc(sale.timestamp) < archive_horizon]
+    if old:
+        tombstones = await db.sale_tombstones.find(
+            {"store_id": store_id, "client_sale_id": {"$in": [sale.client_sale_id for sale in old]}},
+            {"_id": 0, "register_id": 1, "client_sale_id": 1}
+        ).to_list(None)
+        purged = {(tombstone["register_id"], tombstone["client_sale_id"]) for tombstone in tombstones}
+        sales = [sale for sale in sales if (sale.register_id, sale.client_sale_id) not in purged]
+        if not sales:
+            return []
+    products = await get_product_map(item["product_id"] for sale in sales for item in sale.items)
+    for sale in sales:
+        stamp_sale_items(sale.items, products)
+
+    claimed_at = datetime.now(timezone.utc)
+    try:
+        await db.sales.insert_many([
+            {**sale.dict(), "applied": False, "claimed_at": claimed_at}
+            for sale in sales
+        ], ordered=False)
+        recorded, done = sales, {}
+    except BulkWriteError as exc:
+        errors = exc.details["writeErrors"]
+        if any(error["code"] != 11000 for error in errors):
+            raise
+        duplicates = {error["index"] for error in errors}
+        recorded = [sale for i, sale in enumerate(sales) if i not in duplicates]
+        replayed, done = await claim_unapplied_sales(store_id, {"$or": [
+            {"client_sale_id": sales[i].client_sale_id, "register_id": sales[i].register_id}
+            for i in sorted(duplicates)
+        ]})
+        recorded += replayed
+    if not recorded:
+        return []
+
+    await apply_sale_effects(store_id, recorded, production_entry, done)
+    return recorded
+
+def encode_search_cursor(sort: ProductSort, order: SortOrder, last: Dict[str, Any], offset: int) -> str:
+    # Field sorts resume after the last row (keyset); relevance has no
+    # stable key to seek on, so it carries an offset instead
+    position = {"offset": offset} if sort == ProductSort.RELEVANCE else {"value": last[sort.value], "id": last["id"]}
+    payload = {"sort": sort.value, "order": order.value, **position}
+    return base64.urlsafe_b64encode(json.dumps(jsonable_encoder(payload)).encode()).decode()
+
+def decode_search_cursor(cursor: str, sort: ProductSort, order: SortOrder) -> Dict[str, Any]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        issued_for = (payload["sort"], payload["order"])
+        position = {"offset": int(payload["offset"])} if sort == ProductSort.RELEVANCE else {"value": payload["value"], "id": payload["id"]}
+        if sort == ProductSort.CREATED_AT:
+            position["value"] = datetime.fromisoformat(position["value"])
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if issued_for != (sort.value, order.value):
+        raise HTTPException(status_code=400, detail="Cursor was issued for a different sort")
+    return position
+
+def encode_sync_token(moment: datetime) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"t": moment.isoformat()}).encode()).decode()
+
+def decode_sync_token(token: str) -> datetime:
+    try:
+        return as_utc(datetime.fromisoformat(json.loads(base64.urlsafe_b64decode(token.encode()))["t"]))
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+
+# Sales archive. Days older than SALES_ARCHIVE_AFTER_DAYS whose rollups are
+# finalized are packed into zlib-compressed BSON chunks in sales_archive.
+# The hot copies are soft-deleted (archived_at) and purged once the grace
+# period has passed, so a bad archive run can still be undone. Purged
+# register sales leave a tombstone of their sync key in sale_tombstones so
+# a late replay is still recognised as a duplicate.
+SALES_ARCHIVE_AFTER_DAYS = int(os.environ.get('SALES_ARCHIVE_AFTER_DAYS', '90'))
+SALES_ARCHIVE_PURGE_GRACE = timedelta(hours=int(os.environ.get('SALES_ARCHIVE_PURGE_GRACE_HOURS', '48')))
+SALE_TOMBSTONE_RETENTION_DAYS = int(os.environ.get('SALE_TOMBSTONE_RETENTION_DAYS', '365'))
+ARCHIVE_CHUNK_SIZE = 5000
+
+def pack_sales(sales: List[Dict[str, Any]]) -> bytes:
+    import bson
+    return zlib.compress(bson.encode({"sales": sales}), 6)
+
+def unpack_sales(data: bytes) -> List[Dict[str, Any]]:
+    import bson
+    return bson.decode(zlib.decompress(data))["sales"]
+
+async def find_sales_range(
+    store_id: str,
+    start: datetime,
+    end: datetime,
+    limit: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Sales in [start, end) from both the hot collection and the archive, oldest first.
+
+    With a limit only the newest `limit` sales are returned: the hot tier is
+    read newest-first, and archived days are unpacked newest-first until
+    enough sales have been read to fill the limit.
+    """
+    start, end = as_utc(start), as_utc(end)
+    hot_query = db.sales.find({
+        "store_id": store_id,
+        "timestamp": {"$gte": start, "$lt": end},
+        "archived_at": None
+    }, {"_id": 0})
+    archive_query = {"store_id": store_id, "day": {"$gte": start_of_day(start), "$lt": end}}
+
+    def in_range(chunks):
+        return [
+            sale
+            for chunk in chunks
+            for sale in unpack_sales(chunk["data"])
+            if start <= as_utc(sale["timestamp"]) < end
+        ]
+
+    if limit is None:
+        hot, chunks = await asyncio.gather(hot_query.to_list(None), db.sales_archive.find(archive_query).to_list(None))
+        return sorted(hot + in_range(chunks), key=lambda sale: as_utc(sale["timestamp"]))
+
+    hot, headers = await asyncio.gather(
+        hot_query.sort("timestamp", DESCENDING).limit(limit).to_list(limit),
+        db.sales_archive.find(archive_query, {"day": 1}).sort("day", DESCENDING).to_list(None)
+    )
+    days: Dict[datetime, List[str]] = {}
+    for header in headers:
+        days.setdefault(as_utc(header["day"]), []).append(header["_id"])
+    # With a full page of hot sales, archived days ending before its oldest sale can't make the cut
+    floor = as_utc(hot[-1]["timestamp"]) if len(hot) == limit else None
+    archived: List[Dict[str, Any]] = []
+    for day, chunk_ids in days.items():
+        if len(archived) >= limit or (floor and day + timedelta(days=1) <= floor):
+            break
+        archived += in_range(await db.sales_archive.find({"_id": {"$in": chunk_ids}}).to_list(None))
+    return sorted(hot + archived, key=lambda sale: as_utc(sale["timestamp"]))[-limit:]
+
+async def archive_sales_day(store_id: str, day: datetime) -> int:
+    unarchived = {
+        "store_id": store_id,
+        "timestamp": {"$gte": day, "$lt": day + timedelta(days=1)},
+        "archived_at": None
+    }
+    # Pin the day's pending sales to a batch before packing, so a run retried
+    # after a crash rebuilds exactly the same chunks while sales arriving
+    # in between form a batch of their own instead of shifting boundaries
+    await db.sales.update_many(
+        {**unarchived, "archive_batch": None},
+        {"$set": {"archive_batch": str(uuid.uuid4())}}
+    )
+    sales = await db.sales.find(unarchived, {"_id": 0}).to_list(None)
+    if not sales:
+        return 0
+    batches: Dict[str, List[Dict[str, Any]]] = {}
+    for sale in sorted(sales, key=lambda sale: sale["id"]):
+        batches.setdefault(sale.pop("archive_batch"), []).append(sale)
+
+    await db.sales_archive.bulk_write([
+        ReplaceOne(
+            {"_id": f"{store_id}:{day.date().isoformat()}:{batch}:{i // ARCHIVE_CHUNK_SIZE}"},
+            {
+                "store_id": store_id,
+                "day": day,
+                "count": len(chunk),
+                "total_amount": sum(sale["total_amount"] for sale in chunk),
+                "data": pack_sales(chunk)
+            },
+            upsert=True
+        )
+        for batch, batch_sales in batches.items()
+        for i in range(0, len(batch_sales), ARCHIVE_CHUNK_SIZE)
+        for chunk in [batch_sales[i:i + ARCHIVE_CHUNK_SIZE]]
+    ], ordered=False)
+    await db.sales.update_many(
+        {"store_id": store_id, "id": {"$in": [sale["id"] for sale in sales]}},
+        {"$set": {"archived_at": datetime.now(timezone.utc)}}
+    )
+    return len(sales)
+
+async def archive_old_sales(store_id: str, max_days: int = 31) -> Dict[str, Any]:
+    state = await db.system_state.find_one({"_id": f"rollups_finalized:{store_id}"})
+    if not state:
+        return {"days": 0, "sales": 0, "purged": 0, "reason": "rollups not finalized yet"}
+    cutoff = min(start_of_day() - timedelta(days=SALES_ARCHIVE_AFTER_DAYS), as_utc(state["through"]))
+
+    days = archived = 0
+    oldest = await db.sales.find_one(
+        {"store_id": store_id, "timestamp": {"$lt": cutoff}, "archived_at": None},
+        sort=[("timestamp", ASCENDING)]
+    )
+    day = start_of_day(oldest["timestamp"]) if oldest else cutoff
+    while day < cutoff and days < max_days:
+        archived += await archive_sales_day(store_id, day)
+        days += 1
+        day += timedelta(days=1)
+
+    now = datetime.now(timezone.utc)
+    expired = {"store_id": store_id, "archived_at": {"$lte": now - SALES_ARCHIVE_PURGE_GRACE}}
+    keys = await db.sales.find(
+        {**expired, "register_id": {"$ne": None}},
+        {"_id": 0, "register_id": 1, "client_sale_id": 1}
+    ).to_list(None)
+    if keys:
+        # Upserts, so a purge retried after a crash doesn't trip the unique index
+        await db.sale_tombstones.bulk_write([
+            UpdateOne(
+                {"store_id": store_id, "client_sale_id": key["client_sale_id"], "register_id": key["register_id"]},
+                {"$setOnInsert": {"purged_at": now}},
+                upsert=True
+            )
+            for key in keys
+        ], ordered=False)
+    purged = await db.sales.delete_many(expired)
+    return {"days": days, "sales": archived, "purged": purged.deleted_count}
+
+# Writes from other workers may commit slightly after our clock reads, so
+# deltas overlap by this much; clients apply them idempotently
+SYNC_TOKEN_OVERLAP = timedelta(seconds=5)
+
+# Live sales feed
+SSE_BUFFER_SIZE = int(os.environ.get('SSE_BUFFER_SIZE', '100'))
+SSE_HEARTBEAT_SECONDS = 15
+SSE_POLL_SECONDS = float(os.environ.get('SSE_POLL_SECONDS', '2'))
+SSE_TOTALS_RELOAD_SECONDS = 60
+
+class RecentIds:
+    """Remembers the last maxlen sale ids so overlapping reads are applied once."""
+
+    def __init__(self, maxlen: int):
+        self.order: deque = deque(maxlen=maxlen)
+        self.ids: set = set()
+
+    def fresh(self, sales: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        fresh = [sale for sale in sales if sale["id"] not in self.ids]
+        for sale in fresh:
+            if len(self.order) == self.order.maxlen:
+                self.ids.discard(self.order[0])
+            self.order.append(sale["id"])
+            self.ids.add(sale["id"])
+        return fresh
+
+class SaleSubscriber:
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SSE_BUFFER_SIZE)
+        self.dropped = False
+
+class SaleBroadcaster:
+    """In-process fan-out of committed sales to live dashboard streams.
+
+    Each subscriber gets a bounded queue; one that falls a full buffer
+    behind is dropped rather than allowed to hold memory. Running totals
+    for the day are loaded once per store and then updated from the sales
+    themselves, and re-read every minute to correct any drift. Sales
+    recorded by other workers are picked up by a single poller per store,
+    so DB load does not grow with the number of screens.
+    """
+
+    def __init__(self):
+        self.subscribers: Dict[str, set] = {}
+        self.totals: Dict[str, Dict[str, Any]] = {}
+        self.pollers: Dict[str, asyncio.Task] = {}
+        self.seen = RecentIds(5000)
+
+    async def subscribe(self, store_id: str) -> SaleSubscriber:
+        subscriber = SaleSubscriber()
+        self.subscribers.setdefault(store_id, set()).add(subscriber)
+        self.publish(store_id, await self.load_totals(store_id), count_totals=False)
+        if store_id not in self.pollers:
+            self.pollers[store_id] = asyncio.create_task(self.poll(store_id))
+        return subscriber
+
+    def unsubscribe(self, store_id: str, subscriber: SaleSubscriber):
+        subscribers = self.subscribers.get(store_id, set())
+        subscribers.discard(subscriber)
+        if not subscribers:
+            self.subscribers.pop(store_id, None)
+            self.totals.pop(store_id, None)
+            poller = self.pollers.pop(store_id, None)
+            if poller:
+                poller.cancel()
+
+    def poll_window_start(self):
+        from bson import ObjectId
+        # ObjectIds are minted client-side, so overlap a little for other workers' clocks
+        return ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=SSE_POLL_SECONDS + 5))
+
+    async def load_totals(self, store_id: str, force: bool = False) -> List[Dict[str, Any]]:
+        """Reload the day's totals; returns recent sales already counted in them but not yet published."""
+        today = start_of_day()
+        totals = self.totals.get(store_id)
+        if totals and totals["date"] == today and not force:
+            return []
+        # Read recent sales first: everything here is also in the aggregate below
+        recent = await db.sales.find(
+            {"_id": {"$gte": self.poll_window_start()}, "store_id": store_id}
+        ).to_list(None)
+        rows = await db.sales.aggregate([
+            {"$match": {"store_id": store_id, "timestamp": {"$gte": today}}},
+            {"$group": {"_id": None, "revenue": {"$sum": "$total_amount"}, "orders": {"$sum": 1}}}
+        ]).to_list(1)
+        row = rows[0] if rows else {"revenue": 0.0, "orders": 0}
+        self.totals[store_id] = {
+            "date": today,
+            "revenue": row["revenue"],
+            "orders": row["orders"],
+            "loaded_at": time.monotonic()
+        }
+        return sorted(recent, key=lambda sale: sale["_id"])
+
+    def totals_snapshot(self, store_id: str) -> Dict[str, Any]:
+        totals = self.totals[store_id]
+        return {
+            "date": totals["date"].isoformat(),
+            "today_revenue": round(totals["revenue"], 2),
+            "today_orders": totals["orders"],
+            "average_order_value": round(totals["revenue"] / totals["orders"], 2) if totals["orders"] else 0
+        }
+
+    def publish(self, store_id: str, sales: List[Dict[str, Any]], count_totals: bool = True):
+        fresh = self.seen.fresh(sales)
+        if not fresh or store_id not in self.subscribers:
+            return
+
+        totals = self.totals.get(store_id)
+        today = start_of_day()
+        for sale in fresh:
+            if count_totals and totals and totals["date"] == today and as_utc(sale["timestamp"]) >= today:
+                totals["revenue"] += sale["total_amount"]
+                totals["orders"] += 1
+            event = {
+                "sale": {
+                    "id": sale["id"],
+                    "timestamp": as_utc(sale["timestamp"]).isoformat(),
+                    "total_amount": sale["total_amount"],
+                    "items": [
+                        {"product_id": item["product_id"], "quantity": item["quantity"], "price": item["price"]}
+                        for item in sale["items"]
+                    ],
+                    "customer_name": sale.get("customer_name"),
+                    "payment_method": sale.get("payment_method"),
+                    "order_type": sale.get("order_type"),
+                    "employee_id": sale.get("employee_id")
+                },
+                "totals": self.totals_snapshot(store_id) if totals else None
+            }
+            for subscriber in list(self.subscribers.get(store_id, ())):
+                try:
+                    subscriber.queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    subscriber.dropped = True
+                    self.unsubscribe(store_id, subscriber)
+
+    async def poll(self, store_id: str):
+        while True:
+            await asyncio.sleep(SSE_POLL_SECONDS)
+            try:
+                totals = self.totals.get(store_id)
+                stale = not totals or time.monotonic() - totals["loaded_at"] > SSE_TOTALS_RELOAD_SECONDS
+                self.publish(store_id, await self.load_totals(store_id, force=stale), count_totals=False)
+                sales = await db.sales.find(
+                    {"_id": {"$gte": self.poll_window_start()}, "store_id": store_id}
+                ).to_list(None)
+                self.publish(store_id, sorted(sales, key=lambda sale: sale["_id"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Live sales poll failed for store %s", store_id)
+
+sale_broadcaster = SaleBroadcaster()
+
+# Columnar cache of the last few days of sales. Each store's sales and
+# line items live in parallel NumPy columns (a few dozen bytes per line)
+# so the today/recent-days analytics are vectorized reductions instead of
+# walks over sale documents. Sales recorded here are appended directly;
+# other workers' sales are picked up by a throttled catch-up read.
+SALES_CACHE_DAYS = min(int(os.environ.get('SALES_CACHE_DAYS', '7')), SALES_ARCHIVE_AFTER_DAYS)
+SALES_CACHE_CATCHUP_SECONDS = float(os.environ.get('SALES_CACHE_CATCHUP_SECONDS', '2'))
+# ObjectIds are minted client-side, so catch-up reads overlap for other workers' clocks
+SALES_CACHE_CATCHUP_OVERLAP = timedelta(seconds=10)
+CATEGORY_CODES = {category.value: code for code, category in enumerate(CategoryType)}
+SALE_COLUMNS = {"ts": "int64", "total": "float64"}
+LINE_COLUMNS = {"ts": "int64", "product": "int32", "category": "int8", "quantity": "int32", "price": "float32", "cost": "float32"}
+
+def epoch_micros(value: datetime) -> int:
+    return int(as_utc(value).timestamp() * 1_000_000)
+
+class ColumnTable:
+    """Equal-length NumPy columns that grow by doubling."""
+
+    def __init__(self, dtypes: Dict[str, str]):
+        import numpy as np
+        self.size = 0
+        self.columns = {name: np.empty(1024, dtype) for name, dtype in dtypes.items()}
+
+    def __getitem__(self, name: str):
+        return self.columns[name][:self.size]
+
+    def append(self, rows: Dict[str, list]):
+        import numpy as np
+        count = len(next(iter(rows.values())))
+        needed = self.size + count
+        for name, column in self.columns.items():
+            if needed > len(column):
+                grown = np.empty(max(needed, len(column) * 2), column.dtype)
+                grown[:self.size] = column[:self.size]
+                self.columns[name] = column = grown
+            column[self.size:needed] = rows[name]
+        self.size = needed
+
+    def keep(self, mask):
+        for name in self.columns:
+            self.columns[name] = self[name][mask]
+        self.size = int(mask.sum())
+
+    @property
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in self.columns.values())
+
+class SalesColumnCache:
+    def __init__(self):
+        self.stores: Dict[str, Dict[str, Any]] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.product_ids: List[str] = []
+        self.product_codes: Dict[str, int] = {}
+        self.seen = RecentIds(20000)
+
+    def product_code(self, product_id: str) -> int:
+        code = self.product_codes.get(product_id)
+        if code is None:
+            code = self.product_codes[product_id] = len(self.product_ids)
+            self.product_ids.append(product_id)
+        return code
+
+    def ingest(self, entry: Dict[str, Any], sales: List[Dict[str, Any]]):
+        sale_rows: Dict[str, list] = {name: [] for name in SALE_COLUMNS}
+        line_rows: Dict[str, list] = {name: [] for name in LINE_COLUMNS}
+        for sale in sales:
+            ts = epoch_micros(sale["timestamp"])
+            sale_rows["ts"].append(ts)
+            sale_rows["total"].append(sale["total_amount"])
+            for item in sale["items"]:
+                line_rows["ts"].append(ts)
+                line_rows["product"].append(self.product_code(item["product_id"]))
+                line_rows["category"].append(CATEGORY_CODES.get(item.get("category"), -1))
+                line_rows["quantity"].append(item["quantity"])
+                line_rows["price"].append(item["price"])
+                line_rows["cost"].append(item.get("cost", 0.0))
+        if sale_rows["ts"]:
+            entry["sales"].append(sale_rows)
+        if line_rows["ts"]:
+            entry["lines"].append(line_rows)
+
+    def append(self, store_id: str, sales: List[Dict[str, Any]]):
+        # Stores that haven't been loaded yet will read these from the DB
+        entry = self.stores.get(store_id)
+        if entry:
+            self.ingest(entry, self.seen.fresh(sales))
+
+    async def fetch(self, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        sales = await db.sales.find(
+            query, {"_id": 1, "id": 1, "timestamp": 1, "total_amount": 1, "items": 1}
+        ).to_list(None)
+        # Lines from before cost/category were frozen on sales get the catalog's values
+        unstamped = [item for sale in sales for item in sale["items"] if "category" not in item]
+        if unstamped:
+            products = await get_product_map(item["product_id"] for item in unstamped)
+            stamp_sale_items(unstamped, products)
+        return sales
+
+    async def store(self, store_id: str) -> Dict[str, Any]:
+        """The store's columns, loaded on first use and caught up with other workers' sales."""
+        entry = self.stores.get(store_id)
+        if entry and time.monotonic() - entry["checked"] < SALES_CACHE_CATCHUP_SECONDS:
+            return entry
+        async with self.locks.setdefault(store_id, asyncio.Lock()):
+            entry = self.stores.get(store_id)
+            if entry is None:
+                entry = await self.load(store_id)
+            elif time.monotonic() - entry["checked"] >= SALES_CACHE_CATCHUP_SECONDS:
+                await self.catch_up(store_id, entry)
+            return entry
+
+    async def load(self, store_id: str) -> Dict[str, Any]:
+        from bson import ObjectId
+        started = datetime.now(timezone.utc)
+        sales = await self.fetch({
+            "store_id": store_id,
+            "timestamp": {"$gte": start_of_day() - timedelta(days=SALES_CACHE_DAYS - 1)},
+            "archived_at": None
+        })
+        entry = {
+            "sales": ColumnTable(SALE_COLUMNS),
+            "lines": ColumnTable(LINE_COLUMNS),
+            "caught_up": started,
+            "checked": time.monotonic()
+        }
+        # Only sales inserted near load time can show up again in the first catch-up
+        recent = ObjectId.from_datetime(started - SALES_CACHE_CATCHUP_OVERLAP)
+        self.seen.fresh([sale for sale in sales if sale["_id"] >= recent])
+        self.ingest(entry, sales)
+        self.stores[store_id] = entry
+        return entry
+
+    async def catch_up(self, store_id: str, entry: Dict[str, Any]):
+        from bson import ObjectId
+        started = datetime.now(timezone.utc)
+        self.ingest(entry, self.seen.fresh(await self.fetch({
+            "_id": {"$gte": ObjectId.from_datetime(entry["caught_up"] - SALES_CACHE_CATCHUP_OVERLAP)},
+            "store_id": store_id
+        })))
+        entry["caught_up"] = started
+        entry["checked"] = time.monotonic()
+
+        horizon = epoch_micros(start_of_day() - timedelta(days=SALES_CACHE_DAYS - 1))
+        for table in (entry["sales"], entry["lines"]):
+            if table.size and table["ts"].min() < horizon:
+                table.keep(table["ts"] >= horizon)
+
+    async def totals(self, store_id: str, start: datetime) -> Dict[str, float]:
+        sales = (await self.store(store_id))["sales"]
+        selected = sales["total"][sales["ts"] >= epoch_micros(start)]
+        return {"revenue": float(selected.sum()), "orders": int(selected.size)}
+
+    async def units_by_product(self, store_id: str, start: datetime, limit: int) -> List[tuple]:
+        """The best sellers since start as (product_id, units), most units first."""
+        import numpy as np
+        lines = (await self.store(store_id))["lines"]
+        selected = lines["ts"] >= epoch_micros(start)
+        units = np.bincount(lines["product"][selected], weights=lines["quantity"][selected], minlength=len(self.product_ids))
+        top = np.argsort(-units, kind="stable")[:limit]
+        return [(self.product_ids[code], int(units[code])) for code in top if units[code] > 0]
+
+    async def category_stats(self, store_id: str, start: datetime) -> Dict[str, Dict[str, float]]:
+        import numpy as np
+        lines = (await self.store(store_id))["lines"]
+        selected = (lines["ts"] >= epoch_micros(start)) & (lines["category"] >= 0)
+        categories = lines["category"][selected]
+        quantity = lines["quantity"][selected]
+        size = len(CATEGORY_CODES)
+        revenue = np.bincount(categories, weights=lines["price"][selected].astype(np.float64) * quantity, minlength=size)
+        units = np.bincount(categories, weights=quantity, minlength=size)
+        orders = np.bincount(categories, minlength=size)
+        return {
+            category: {"revenue": round(float(revenue[code]), 2), "quantity": int(units[code]), "orders": int(orders[code])}
+            for category, code in CATEGORY_CODES.items()
+            if orders[code]
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            store_id: {
+                "sales": entry["sales"].size,
+                "lines": entry["lines"].size,
+                "bytes": entry["sales"].nbytes + entry["lines"].nbytes
+            }
+            for store_id, entry in self.stores.items()
+        }
+
+sales_columns = SalesColumnCache()
+
+# Production planning. A store's queue is built from its inventory, the
+# catalog and the last few hours of rollups, then kept current from the
+# sales this worker records, so kitchen screens can poll it without
+# touching the database. A periodic rebuild picks up other workers' sales
+# and stock changes made outside the sales path.
+PRODUCTION_VELOCITY_HOURS = int(os.environ.get('PRODUCTION_VELOCITY_HOURS', '3'))
+PRODUCTION_COVER_HOURS = float(os.environ.get('PRODUCTION_COVER_HOURS', '2'))
+PRODUCTION_REBUILD_SECONDS = float(os.environ.get('PRODUCTION_REBUILD_SECONDS', '30'))
+PRODUCTION_START_SOON_MINUTES = 15
+BAKED_CATEGORIES = {CategoryType.DONUTS.value, CategoryType.KOLACHES.value, CategoryType.CROISSANTS.value}
+
+class ProductionQueue:
+    def __init__(self):
+        self.stores: Dict[str, Dict[str, Any]] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+
+    def current(self, store_id: str) -> Optional[Dict[str, Any]]:
+        return self.stores.get(store_id)
+
+    def invalidate(self, store_id: str):
+        self.stores.pop(store_id, None)
+
+    def invalidate_all(self):
+        # The catalog is shared, so a product change affects every store's queue
+        self.stores.clear()
+
+    def record(self, store_id: str, sales: List[Dict[str, Any]], entry: Optional[Dict[str, Any]]):
+        """Apply sales to the queue that was current before they were written.
+
+        A rebuild in between may or may not have read them already, so they
+        are left to the next rebuild rather than risk counting them twice.
+        """
+        if entry is None or self.stores.get(store_id) is not entry:
+            return
+        for sale in sales:
+            bucket = hour_bucket(sale["timestamp"])
+            for line in sale["items"]:
+                item = entry["items"].get(line["product_id"])
+                if item:
+                    item["quantity"] = max(0, item["quantity"] - line["quantity"])
+                    item["sold"][bucket] = item["sold"].get(bucket, 0) + line["quantity"]
+
+    async def store(self, store_id: str) -> Dict[str, Any]:
+        entry = self.stores.get(store_id)
+        if entry and time.monotonic() - entry["built"] < PRODUCTION_REBUILD_SECONDS:
+            return entry
+        async with self.locks.setdefault(store_id, asyncio.Lock()):
+            entry = self.stores.get(store_id)
+            if entry is None or time.monotonic() - entry["built"] >= PRODUCTION_REBUILD_SECONDS:
+                entry = await self.build(store_id)
+            return entry
+
+    async def build(self, store_id: str) -> Dict[str, Any]:
+        built, built_at = time.monotonic(), datetime.now(timezone.utc)
+        window_start = hour_bucket(built_at) - timedelta(hours=PRODUCTION_VELOCITY_HOURS)
+        inventory, rollups = await asyncio.gather(
+            db.inventory.find(
+                {"store_id": store_id}, {"_id": 0, "product_id": 1, "quantity": 1, "min_threshold": 1, "max_capacity": 1}
+            ).to_list(None),
+            db.sales_rollups.find(
+                {"store_id": store_id, "bucket": {"$gte": window_start}}, {"_id": 0, "product_id": 1, "bucket": 1, "quantity": 1}
+            ).to_list(None)
+        )
+        stock = {row["product_id"]: row for row in inventory}
+        products = await db.products.find(
+            {"id": {"$in": list(stock)}},
+            {"_id": 0, "id": 1, "name": 1, "category": 1, "prep_time": 1, "is_available": 1}
+        ).to_list(None)
+        items = {
+            product["id"]: {
+                "name": product["name"],
+                "category": product["category"],
+                "prep_time": product.get("prep_time", 0),
+                "quantity": stock[product["id"]]["quantity"],
+                "min_threshold": stock[product["id"]].get("min_threshold", 10),
+                "max_capacity": stock[product["id"]].get("max_capacity", 100),
+                "sold": {}
+            }
+            for product in products
+            if product.get("is_available", True) and product["id"] in stock
+        }
+        for row in rollups:
+            item = items.get(row["product_id"])
+            if item:
+                bucket = as_utc(row["bucket"])
+                item["sold"][bucket] = item["sold"].get(bucket, 0) + row["quantity"]
+        entry = {"items": items, "built": built, "built_at": built_at}
+        self.stores[store_id] = entry
+        return entry
+
+    async def queue(self, store_id: str, station: Optional[EmployeeRole] = None) -> Dict[str, Any]:
+        """Batches worth starting, most urgent first.
+
+        Velocity is units sold per hour over the rollup window. A product
+        needs a batch when the stock left once a batch started now is ready
+        would be under the larger of its threshold and the velocity over
+        PRODUCTION_COVER_HOURS. It is ranked by how many minutes of slack
+        remain before it has to go in the oven.
+        """
+        entry = await self.store(store_id)
+        now = datetime.now(timezone.utc)
+        current_hour = hour_bucket(now)
+        window_start = current_hour - timedelta(hours=PRODUCTION_VELOCITY_HOURS)
+        window_hours = PRODUCTION_VELOCITY_HOURS + (now - current_hour).total_seconds() / 3600
+
+        batches = []
+        for product_id, item in entry["items"].items():
+            role = EmployeeRole.BAKER if item["category"] in BAKED_CATEGORIES else EmployeeRole.PREP_COOK
+            if station and role != station:
+                continue
+            for bucket in [bucket for bucket in item["sold"] if bucket < window_start]:
+                del item["sold"][bucket]
+            velocity = sum(item["sold"].values()) / window_hours
+            prep_hours = item["prep_time"] / 60
+            target = min(
+                max(item["min_threshold"], math.ceil(velocity * (PRODUCTION_COVER_HOURS + prep_hours))),
+                item["max_capacity"]
+            )
+            quantity = min(math.ceil(target - (item["quantity"] - velocity * prep_hours)), item["max_capacity"] - item["quantity"])
+            if quantity <= 0:
+                continue
+
+            minutes_left = item["quantity"] / velocity * 60 if velocity else None
+            slack = minutes_left - item["prep_time"] if minutes_left is not None else None
+            if slack is None:
+                status = ProductionStatus.RESTOCK
+            elif slack <= 0:
+                status = ProductionStatus.LATE
+            elif slack <= PRODUCTION_START_SOON_MINUTES:
+                status = ProductionStatus.START_NOW
+            else:
+                status = ProductionStatus.UPCOMING
+            batches.append({
+                "product_id": product_id,
+                "name": item["name"],
+                "category": item["category"],
+                "station": role,
+                "status": status,
+                "quantity": quantity,
+                "on_hand": item["quantity"],
+                "prep_time": item["prep_time"],
+                "velocity_per_hour": round(velocity, 2),
+                "minutes_to_stockout": round(minutes_left, 1) if minutes_left is not None else None,
+                "start_by": now + timedelta(minutes=max(slack, 0)) if slack is not None else None,
+                "slack": slack
+            })
+
+        batches.sort(key=lambda batch: (batch["slack"] is None, batch["slack"] or 0, -batch["quantity"]))
+        for batch in batches:
+            del batch["slack"]
+        return {"store_id": store_id, "generated_at": now, "built_at": entry["built_at"], "queue": batches}
+
+production_queue = ProductionQueue()
+
+# Admission control. Analytics reads are far costlier than register
+# traffic, so they are rate limited per client and capped in concurrency;
+# sales writes and everything else always go straight through.
+ANALYTICS_PATHS = ("/api/sales/analytics/", "/api/analytics/", "/api/dashboard/overview", "/api/inventory/forecast")
+ANALYTICS_RATE_PER_MINUTE = float(os.environ.get('ANALYTICS_RATE_PER_MINUTE', '60'))
+ANALYTICS_BURST = int(os.environ.get('ANALYTICS_BURST', '20'))
+ANALYTICS_MAX_CONCURRENCY = int(os.environ.get('ANALYTICS_MAX_CONCURRENCY', '4'))
+ANALYTICS_MAX_QUEUE = int(os.environ.get('ANALYTICS_MAX_QUEUE', '16'))
+ANALYTICS_QUEUE_TIMEOUT = float(os.environ.get('ANALYTICS_QUEUE_TIMEOUT_SECONDS', '2'))
+# How old a cached analytics response may be and still stand in for a shed request
+ANALYTICS_STALE_SECONDS = float(os.environ.get('ANALYTICS_STALE_SECONDS', '300'))
+ANALYTICS_CACHE_ENTRIES = 256
+TRACKED_CLIENTS = 10000
+
+# Only these peers (addresses or CIDR ranges, comma separated) may name the
+# client in X-Forwarded-For; anyone else is rate limited by their own address
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(entry.strip(), strict=False)
+    for entry in os.environ.get('TRUSTED_PROXIES', '').split(',')
+    if entry.strip()
+]
+
+def is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, burst: int):
+        self.rate = rate_per_second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Spend a token; returns 0 on success, otherwise seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class ConcurrencyLimiter:
+    """A semaphore with a bounded FIFO wait queue; freed slots pass straight to the next waiter."""
+
+    def __init__(self, limit: int, max_queue: int):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiters: deque = deque()
+        self.max_queue_seen = 0
+
+    async def acquire(self, timeout: float) -> bool:
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+            return True
+        if len(self.waiters) >= self.max_queue:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.max_queue_seen = max(self.max_queue_seen, len(self.waiters))
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+class AdmissionController:
+    def __init__(self):
+        self.limiter = ConcurrencyLimiter(ANALYTICS_MAX_CONCURRENCY, ANALYTICS_MAX_QUEUE)
+        self.buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self.cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.counters = {"admitted": 0, "throttled": 0, "queue_full": 0, "queue_timeout": 0, "served_stale": 0, "rejected": 0}
+
+    async def admit(self, app, scope, receive, send):
+        cache_key = f"{scope['method']} {scope['path']}?{scope.get('query_string', b'').decode()}"
+        retry_after = self.bucket_for(scope).take()
+        if retry_after:
+            self.counters["throttled"] += 1
+            await self.shed(cache_key, retry_after, send)
+            return
+        queue_was_full = len(self.limiter.waiters) >= self.limiter.max_queue
+        if not await self.limiter.acquire(ANALYTICS_QUEUE_TIMEOUT):
+            self.counters["queue_full" if queue_was_full else "queue_timeout"] += 1
+            await self.shed(cache_key, 1.0, send)
+            return
+
+        self.counters["admitted"] += 1
+        response: Dict[str, Any] = {"status": None, "headers": [], "body": []}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = message.get("headers", [])
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await app(scope, receive, capture)
+        finally:
+            self.limiter.release()
+        if scope["method"] == "GET" and response["status"] == 200:
+            self.cache[cache_key] = {
+                "headers": response["headers"],
+                "body": b"".join(response["body"]),
+                "stored_at": time.monotonic()
+            }
+            self.cache.move_to_end(cache_key)
+            while len(self.cache) > ANALYTICS_CACHE_ENTRIES:
+                self.cache.popitem(last=False)
+
+    def bucket_for(self, scope) -> TokenBucket:
+        client = (scope.get("client") or ("unknown",))[0]
+        if is_trusted_proxy(client):
+            # Walk back through our own proxies to the first hop we don't run
+            forwarded = dict(scope.get("headers", [])).get(b"x-forwarded-for", b"").decode()
+            for hop in reversed([hop.strip() for hop in forwarded.split(",") if hop.strip()]):
+                client = hop
+                if not is_trusted_proxy(hop):
+                    break
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = TokenBucket(ANALYTICS_RATE_PER_MINUTE / 60, ANALYTICS_BURST)
+            while len(self.buckets) > TRACKED_CLIENTS:
+                self.buckets.popitem(last=False)
+        self.buckets.move_to_end(client)
+        return bucket
+
+    async def shed(self, cache_key: str, retry_after: float, send):
+        cached = self.cache.get(cache_key)
+        age = time.monotonic() - cached["stored_at"] if cached else None
+        if cached and age <= ANALYTICS_STALE_SECONDS:
+            self.counters["served_stale"] += 1
+            headers = [
+                (name, value) for name, value in cached["headers"]
+                if name.lower() not in (b"content-length", b"age")
+            ]
+            headers += [
+                (b"content-length", str(len(cached["body"])).encode()),
+                (b"age", str(int(age)).encode()),
+                (b"x-cache", b"stale")
+            ]
+            await send({"type": "http.response.start", "status": 200, "headers": headers})
+            await send({"type": "http.response.body", "body": cached["body"]})
+            return
+
+        self.counters["rejected"] += 1
+        body = json.dumps({"detail": "Analytics are busy, retry shortly"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode())
+            ]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.limiter.in_flight,
+            "queue_depth": len(self.limiter.waiters),
+            "max_queue_depth": self.limiter.max_queue_seen,
+            "concurrency_limit": self.limiter.limit,
+            "queue_limit": self.limiter.max_queue,
+            "tracked_clients": len(self.buckets),
+            "cached_responses": len(self.cache),
+            **self.counters
+        }
+
+admission_control = AdmissionController()
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware, so shed requests cost no routing or body parsing."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(ANALYTICS_PATHS):
+            await self.app(scope, receive, send)
+            return
+        await admission_control.admit(self.app, scope, receive, send)
+
+# Response compression. Brotli is used when the package is installed and
+# the client accepts it, gzip otherwise. Event streams are never
+# compressed because each event has to reach the browser as it is sent.
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '500'))
+BROTLI_AVAILABLE = importlib.util.find_spec("brotli") is not None
+UNCOMPRESSED_TYPES = ("text/event-stream", "image/", "application/zip", "application/gzip")
+
+def pick_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(coding.strip())
+    if BROTLI_AVAILABLE and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+class StreamCompressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            import brotli
+            self.compressor = brotli.Compressor(quality=5)
+        else:
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = gzip framing
+
+    def compress(self, data: bytes, more: bool) -> bytes:
+        # Streamed chunks are flushed so each one is decodable on arrival
+        if self.encoding == "br":
+            return self.compressor.process(data) + (self.compressor.flush() if more else self.compressor.finish())
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH if more else zlib.Z_FINISH)
+
+class CompressionMiddleware:
+    """Pure ASGI gzip/brotli compression for responses of at least COMPRESSION_MIN_SIZE bytes."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        encoding = pick_encoding(Headers(scope=scope).get("accept-encoding", "")) if scope["type"] == "http" else None
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        start: Dict[str, Any] = {}
+        compressor: Optional[StreamCompressor] = None
+
+        async def send_compressed(message):
+            nonlocal compressor
+            if message["type"] == "http.response.start":
+                start.update(message)
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body, more = message.get("body", b""), message.get("more_body", False)
+            if start:
+                headers = MutableHeaders(raw=start["headers"])
+                skip = (
+                    "content-encoding" in headers
+                    or headers.get("content-type", "").startswith(UNCOMPRESSED_TYPES)
+                    or (not more and len(body) < COMPRESSION_MIN_SIZE)
+                )
+                if not skip:
+                    compressor = StreamCompressor(encoding)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if "content-length" in headers:
+                        del headers["Content-Length"]
+                    if not more:
+                        body = compressor.compress(body, more)
+                        headers["Content-Length"] = str(len(body))
+                        await send(start)
+                        start.clear()
+                        await send({**message, "body": body})
+                        return
+                await send(start)
+                start.clear()
+            if compressor:
+                message = {**message, "body": compressor.compress(body, more)}
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+# On-demand request profiling. With PROFILING_TOKEN set, a request that
+# sends the token in X-Profile-Token runs under a stack sampler and its
+# response carries an X-Profile-Id for the stored profile. Requests
+# without the header pay a counter update and one header scan; with no
+# token configured the middleware returns straight away and no command
+# listener is attached.
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN')
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '2')) / 1000
+PROFILE_MAX_SECONDS = 30
+PROFILE_RETENTION_DAYS = 7
+
+# Requests currently inside ProfilingMiddleware, counted only while profiling is configured
+requests_in_flight = 0
+
+class RequestProfile:
+    """Samples the event loop thread's stack and times DB commands until stopped.
+
+    Everything on the loop thread is sampled, so requests running
+    concurrently with the profiled one show up in its stacks too; idle
+    time appears as the event loop's select() frame. The same goes for the
+    CPU, await and DB timings, which is why the report also counts the
+    requests that overlapped the profiled one. Profiles that outlive
+    PROFILE_MAX_SECONDS stop measuring and give up the profiling slot.
+    """
+
+    def __init__(self):
+        self.thread_id = threading.get_ident()
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+        self.pending_commands: Dict[int, tuple] = {}
+        self.commands: Dict[tuple, List[float]] = {}
+        self.concurrent_requests = 0
+        self.truncated = False
+        self.measuring = True
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, name="request-profiler", daemon=True)
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.started_at = datetime.now(timezone.utc)
+        self.wall_started = time.perf_counter()
+        self.cpu_started = time.thread_time()
+        self.sampler.start()
+
+    def finish_measuring(self):
+        # Runs on the loop thread, since thread_time() only sees the calling thread
+        global active_profile
+        if not self.measuring:
+            return
+        self.measuring = False
+        self.wall_ms = (time.perf_counter() - self.wall_started) * 1000
+        self.cpu_ms = (time.thread_time() - self.cpu_started) * 1000
+        if active_profile is self:
+            active_profile = None
+
+    def expire(self):
+        if self.measuring:
+            self.truncated = True
+            self.finish_measuring()
+
+    def stop(self):
+        self.finish_measuring()
+        self.stopped.set()
+        self.sampler.join()
+
+    def sample(self):
+        deadline = time.perf_counter() + PROFILE_MAX_SECONDS
+        while not self.stopped.wait(PROFILE_SAMPLE_INTERVAL):
+            if time.perf_counter() >= deadline:
+                # Long-running responses such as event streams would otherwise hold the slot
+                self.loop.call_soon_threadsafe(self.expire)
+                return
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_qualname}")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def command_started(self, event):
+        collection = event.command.get(event.command_name)
+        self.pending_commands[event.request_id] = (
+            event.command_name,
+            collection if isinstance(collection, str) else None
+        )
+
+    def command_finished(self, event):
+        key = self.pending_commands.pop(event.request_id, None)
+        if key:
+            self.commands.setdefault(key, []).append(event.duration_micros / 1000)
+
+    def report(self, profile_id: str, scope: Dict[str, Any], status_code: Optional[int]) -> Dict[str, Any]:
+        db_ms = sum(sum(durations) for durations in self.commands.values())
+        return {
+            "id": profile_id,
+            "method": scope["method"],
+            "path": scope["path"],
+            "query_string": scope["query_string"].decode("latin-1"),
+            "status_code": status_code,
+            "started_at": self.started_at,
+            "wall_ms": round(self.wall_ms, 2),
+            "cpu_ms": round(self.cpu_ms, 2),
+            "await_ms": round(max(self.wall_ms - self.cpu_ms, 0), 2),
+            "db_ms": round(db_ms, 2),
+            # cpu/await/db and the stacks cover the whole event loop, not just this request
+            "timings_scope": "event_loop",
+            "concurrent_requests": self.concurrent_requests,
+            "truncated": self.truncated,
+            "sample_interval_ms": PROFILE_SAMPLE_INTERVAL * 1000,
+            "samples": self.samples,
+            # A list rather than a mapping because stack keys contain dots
+            "stacks": [
+                {"stack": stack, "samples": samples}
+                for stack, samples in sorted(self.stacks.items(), key=lambda item: -item[1])
+            ],
+            "db_commands": [
+                {
+                    "command": command,
+                    "collection": collection,
+                    "count": len(durations),
+                    "total_ms": round(sum(durations), 2),
+                    "max_ms": round(max(durations), 2)
+                }
+                for (command, collection), durations in sorted(self.commands.items(), key=lambda item: -sum(item[1]))
+            ]
+        }
+
+active_profile: Optional[RequestProfile] = None
+
+class ProfileCommandListener(monitoring.CommandListener):
+    """Feeds command timings to the active profile; attached only when profiling is configured.
+
+    Commands from other requests in the same window are counted as well.
+    """
+
+    def started(self, event):
+        if active_profile:
+            active_profile.command_started(event)
+
+    def succeeded(self, event):
+        if active_profile:
+            active_profile.command_finished(event)
+
+    def failed(self, event):
+        if active_profile:
+            active_profile.command_finished(event)
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware that profiles requests carrying a valid X-Profile-Token."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global requests_in_flight
+        if not PROFILING_TOKEN or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if active_profile is not None:
+            active_profile.concurrent_requests += 1
+        requests_in_flight += 1
+        try:
+            await self.handle(scope, receive, send)
+        finally:
+            requests_in_flight -= 1
+
+    async def handle(self, scope, receive, send):
+        global active_profile
+        if scope["path"].startswith("/api/profiles"):
+            await self.app(scope, receive, send)
+            return
+        token = next((value for name, value in scope["headers"] if name == b"x-profile-token"), None)
+        if token is None:
+            await self.app(scope, receive, send)
+            return
+        if not hmac.compare_digest(token, PROFILING_TOKEN.encode()):
+            await JSONResponse({"detail": "Invalid profiling token"}, status_code=403)(scope, receive, send)
+            return
+        # One request at a time, so command timings can't mix two profiles
+        if active_profile is not None:
+            await JSONResponse({"detail": "Another request is being profiled"}, status_code=409)(scope, receive, send)
+            return
+
+        profile_id = str(uuid.uuid4())
+        status_code: Optional[int] = None
+
+        async def send_with_profile_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(scope=message).append("X-Profile-Id", profile_id)
+            await send(message)
+
+        profile = active_profile = RequestProfile()
+        # Requests already running when this one started overlap it too
+        profile.concurrent_requests = requests_in_flight - 1
+        profile.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profile.stop()
+            await db.profiles.insert_one(profile.report(profile_id, scope, status_code))
+
+# Background Jobs
+class CronSchedule:
+    """Five-field cron expression (minute hour day month weekday), evaluated in UTC."""
+
+    FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression!r}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self._parse_field(field, low, high)
+            for field, (low, high) in zip(fields, self.FIELD_RANGES)
+        ]
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse_field(field: str, low: int, high: int) -> set:
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step_text = part.split("/")
+                step = int(step_text)
+            if part == "*":
+                start, stop = low, high
+            elif "-" in part:
+                start, stop = (int(value) for value in part.split("-"))
+            else:
+                start = stop = int(part)
+            values.update(range(start, stop + 1, step))
+        if high == 6:
+            # Cron allows 7 for Sunday
+            values = {value % 7 for value in values}
+        if not values or min(values) < low or max(values) > high:
+            raise ValueError(f"Invalid cron field: {field!r}")
+        return values
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        # Standard cron: when both fields are restricted either one may match
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, moment: datetime) -> datetime:
+        moment = as_utc(moment).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 4)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(moment):
+                moment = (moment + timedelta(days=1)).replace(hour=0, minute=0)
+            elif moment.hour not in self.hours:
+                moment = (moment + timedelta(hours=1)).replace(minute=0)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression never fires: {self.expression!r}")
+
+class ScheduledJob:
+    def __init__(self, name: str, schedule: CronSchedule, func: Callable[[], Awaitable[Any]], lease_seconds: int):
+        self.name = name
+        self.schedule = schedule
+        self.func = func
+        self.lease_seconds = lease_seconds
+        self.next_run_at: Optional[datetime] = None
+
+class JobScheduler:
+    """In-process asyncio scheduler.
+
+    Every worker runs the same timers; a lease document per job in
+    ``job_leases`` makes sure only one of them executes a given slot.
+    Run history is kept in the ``jobs`` collection.
+    """
+
+    def __init__(self):
+        self.jobs: Dict[str, ScheduledJob] = {}
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._tasks: List[asyncio.Task] = []
+
+    def job(self, name: str, schedule: str, lease_seconds: int = 600):
+        def register(func: Callable[[], Awaitable[Any]]):
+            self.jobs[name] = ScheduledJob(name, CronSchedule(schedule), func, lease_seconds)
+            return func
+        return register
+
+    async def acquire_lease(self, job: ScheduledJob, slot: Optional[datetime]) -> bool:
+        now = datetime.now(timezone.utc)
+        conditions = [{"$or": [{"expires_at": {"$lte": now}}, {"owner": self.owner}]}]
+        if slot is not None:
+            conditions.append({"$or": [{"slot": {"$lt": slot}}, {"slot": None}]})
+        update = {"owner": self.owner, "expires_at": now + timedelta(seconds=job.lease_seconds)}
+        if slot is not None:
+            update["slot"] = slot
+        try:
+            await db.job_leases.find_one_and_update(
+                {"_id": job.name, "$and": conditions},
+                {"$set": update},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Someone else holds the lease or already ran this slot
+            return False
+        return True
+
+    async def release_lease(self, job: ScheduledJob):
+        await db.job_leases.update_one(
+            {"_id": job.name, "owner": self.owner},
+            {"$set": {"expires_at": datetime.now(timezone.utc)}}
+        )
+
+    async def run_job(self, name: str, slot: Optional[datetime] = None) -> Dict[str, Any]:
+        job = self.jobs[name]
+        if not await self.acquire_lease(job, slot):
+            return {"name": name, "status": "skipped", "reason": "lease held elsewhere"}
+
+        started_at = datetime.now(timezone.utc)
+        started = time.perf_counter()
+        status = {"last_started_at": started_at, "owner": self.owner}
+        try:
+            result = await job.func()
+            status.update(last_status="success", last_error=None, last_result=result)
+        except Exception as exc:
+            logger.exception("Job %s failed", name)
+            status.update(last_status="failed", last_error=str(exc), last_result=None)
+        finally:
+            await self.release_lease(job)
+
+        status["last_finished_at"] = datetime.now(timezone.utc)
+        status["last_duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        await db.jobs.update_one(
+            {"_id": name},
+            {"$set": status, "$inc": {"run_count": 1}},
+            upsert=True
+        )
+        return {"name": name, "status": status["last_status"], **status}
+
+    async def _loop(self, job: ScheduledJob):
+        while True:
+            job.next_run_at = job.schedule.next_after(datetime.now(timezone.utc))
+            delay = (job.next_run_at - datetime.now(timezone.utc)).total_seconds()
+            await asyncio.sleep(max(delay, 0))
+            try:
+                await self.run_job(job.name, slot=job.next_run_at)
+            except Exception:
+                logger.exception("Scheduler loop for %s failed", job.name)
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._loop(job)) for job in self.jobs.values()]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def status(self) -> List[Dict[str, Any]]:
+        stored = {doc["_id"]: doc for doc in await db.jobs.find({"_id": {"$in": list(self.jobs)}}).to_list(None)}
+        statuses = []
+        for name, job in self.jobs.items():
+            doc = stored.get(name, {})
+            doc.pop("_id", None)
+            statuses.append({
+                "name": name,
+                "schedule": job.schedule.expression,
+                "next_run_at": job.next_run_at or job.schedule.next_after(datetime.now(timezone.utc)),
+                "run_count": doc.pop("run_count", 0),
+                **doc
+            })
+        return statuses
+
+scheduler = JobScheduler()
+
+@scheduler.job("rollup_compaction", "10 0 * * *")
+async def compact_yesterdays_rollups():
+    # Re-derive yesterday's hourly rollups from raw sales to correct any drift
+    today = start_of_day()
+    buckets = 0
+    for store_id in await list_store_ids():
+        buckets += await rebuild_sales_rollups(store_id, today - timedelta(days=1), today)
+        # Everything before today now has final rollups, so it may be archived
+        await db.system_state.update_one(
+            {"_id": f"rollups_finalized:{store_id}"},
+            {"$max": {"through": today}},
+            upsert=True
+        )
+    return {"buckets": buckets}
+
+@scheduler.job("sales_archival", "40 3 * * *", lease_seconds=3600)
+async def archive_sales():
+    results = {}
+    for store_id in await list_store_ids():
+        results[store_id] = await archive_old_sales(store_id)
+    return results
+
+@scheduler.job("forecast_refresh", "30 2 * * *")
+async def refresh_nightly_forecast():
+    products = 0
+    for store_id in await list_store_ids():
+        products += len(await refresh_forecasts(store_id))
+    return {"products": products}
+
+@scheduler.job("customer_scoring", "50 2 * * *", lease_seconds=1800)
+async def refresh_customer_segments():
+    backfilled = await backfill_last_orders()
+    summary = await score_customers()
+    return {"customers": summary["customers"], "updated": summary["updated"], "backfilled": backfilled}
+
+@scheduler.job("sale_replay", "* * * * *", lease_seconds=120)
+async def replay_unapplied_sales():
+    # Catches sales whose request failed part way and was never retried
+    replayed = 0
+    for store_id in await list_store_ids():
+        sales, done = await claim_unapplied_sales(store_id, {})
+        if sales:
+            await apply_sale_effects(store_id, sales, production_queue.current(store_id), done)
+            replayed += len(sales)
+    return {"sales": replayed}
+
+@scheduler.job("expiry_sweep", "*/15 * * * *", lease_seconds=120)
+async def sweep_expired_inventory():
+    lots = units = 0
+    for store_id in await list_store_ids():
+        result = await sweep_expired_lots(store_id)
+        lots += result["lots"]
+        units += result["units"]
+    return {"lots": lots, "units": units}
+
+# End-of-day close. Each finalized day is frozen into one immutable
+# daily_reports document, CSV export included, which is served as stored.
+DAILY_CLOSE_CATCH_UP_DAYS = 7
+
+async def build_daily_report(store_id: str, day: datetime) -> Dict[str, Any]:
+    end = day + timedelta(days=1)
+    order_rows, product_rows, labor = await asyncio.gather(
+        db.sales.aggregate([
+            {"$match": {"store_id": store_id, "timestamp": {"$gte": day, "$lt": end}}},
+            {"$group": {
+                "_id": "$payment_method",
+                "orders": {"$sum": 1},
+                "revenue": {"$sum": "$total_amount"}
+            }}
+        ]).to_list(None),
+        db.sales_rollups.aggregate([
+            {"$match": {"store_id": store_id, "bucket": {"$gte": day, "$lt": end}}},
+            {"$group": {
+                "_id": "$product_id",
+                "category": {"$first": "$category"},
+                "quantity": {"$sum": "$quantity"},
+                "revenue": {"$sum": "$revenue"},
+                "cogs": {"$sum": "$cogs"}
+            }}
+        ]).to_list(None),
+        get_labor_analytics(start=day, end=end, store_id=store_id)
+    )
+
+    revenue = sum(row["revenue"] for row in order_rows)
+    orders = sum(row["orders"] for row in order_rows)
+    categories: Dict[str, Dict[str, float]] = {}
+    for row in product_rows:
+        category = categories.setdefault(row["category"] or "uncategorized", {"quantity": 0, "revenue": 0.0, "cogs": 0.0})
+        for field in category:
+            category[field] += row[field]
+    best_sellers = sorted(product_rows, key=lambda row: (-row["quantity"], row["_id"]))[:10]
+    products = await get_product_map(row["_id"] for row in best_sellers)
+
+    return {
+        "_id": f"{store_id}:{day.date().isoformat()}",
+        "store_id": store_id,
+        "date": day.date().isoformat(),
+        "day": day,
+        "closed_at": datetime.now(timezone.utc),
+        "totals": {
+            "orders": orders,
+            "revenue": round(revenue, 2),
+            "average_order_value": round(revenue / orders, 2) if orders else 0,
+            "items_sold": sum(row["quantity"] for row in product_rows)
+        },
+        "margin": margin_summary(
+            sum(row["revenue"] for row in product_rows),
+            sum(row["cogs"] for row in product_rows)
+        ),
+        "payment_methods": [
+            {"payment_method": row["_id"], "orders": row["orders"], "revenue": round(row["revenue"], 2)}
+            for row in sorted(order_rows, key=lambda row: -row["revenue"])
+        ],
+        "categories": [
+            {"category": name, "quantity": row["quantity"], **margin_summary(row["revenue"], row["cogs"])}
+            for name, row in sorted(categories.items(), key=lambda item: -item[1]["revenue"])
+        ],
+        "top_items": [
+            {
+                "product_id": row["_id"],
+                "name": products.get(row["_id"], {}).get("name"),
+                "quantity": row["quantity"],
+                "revenue": round(row["revenue"], 2)
+            }
+            for row in best_sellers
+        ],
+        "labor": {
+            "totals": labor["totals"],
+            "hours": labor["hours"],
+            "employees": [
+                {key: value for key, value in employee.items() if key != "hours"}
+                for employee in labor["employees"]
+            ]
+        }
+    }
+
+def render_daily_report_csv(report: Dict[str, Any]) -> str:
+    out = io.StringIO()
+    writer = csv.writer(out)
+
+    def section(title: str, header: List[str], rows: List[List[Any]]):
+        writer.writerow([title])
+        writer.writerow(header)
+        writer.writerows(rows)
+        writer.writerow([])
+
+    totals, margin, labor = report["totals"], report["margin"], report["labor"]["totals"]
+    section(f"Daily report {report['date']} ({report['store_id']})", ["metric", "value"], [
+        ["orders", totals["orders"]],
+        ["revenue", totals["revenue"]],
+        ["average_order_value", totals["average_order_value"]],
+        ["items_sold", totals["items_sold"]],
+        ["cogs", margin["cogs"]],
+        ["gross_margin", margin["gross_margin"]],
+        ["margin_pct", margin["margin_pct"]],
+        ["labor_hours", labor["labor_hours"]],
+        ["labor_cost", labor["labor_cost"]],
+        ["labor_cost_pct", labor["labor_cost_pct"]],
+    ])
+    section("Categories", ["category", "quantity", "revenue", "cogs", "gross_margin", "margin_pct"], [
+        [row["category"], row["quantity"], row["revenue"], row["cogs"], row["gross_margin"], row["margin_pct"]]
+        for row in report["categories"]
+    ])
+    section("Top items", ["product", "quantity", "revenue"], [
+        [row["name"] or row["product_id"], row["quantity"], row["revenue"]]
+        for row in report["top_items"]
+    ])
+    section("Payment methods", ["payment_method", "orders", "revenue"], [
+        [row["payment_method"], row["orders"], row["revenue"]]
+        for row in report["payment_methods"]
+    ])
+    section("Hours", ["hour", "revenue", "items", "labor_hours", "labor_cost"], [
+        [row["hour"], row["revenue"], row["items"], row["labor_hours"], row["labor_cost"]]
+        for row in report["labor"]["hours"]
+    ])
+    section("Staff", ["employee", "labor_hours", "labor_cost", "revenue", "items"], [
+        [row["name"] or row["employee_id"], row["labor_hours"], row["labor_cost"], row["revenue"], row["items"]]
+        for row in report["labor"]["employees"]
+    ])
+    return out.getvalue()
+
+async def close_business_day(store_id: str, day: datetime) -> bool:
+    """Freeze one day's report; returns False if there was nothing to close or it was already closed."""
+    report = await build_daily_report(store_id, day)
+    if not report["totals"]["orders"] and not report["labor"]["totals"]["labor_hours"]:
+        return False
+    report["csv"] = render_daily_report_csv(report)
+    try:
+        await db.daily_reports.insert_one(report)
+    except DuplicateKeyError:
+        # Snapshots are immutable; a second close never rewrites one
+        return False
+    return True
+
+@scheduler.job("daily_close", "20 0 * * *")
+async def close_finalized_days():
+    # Runs after rollup compaction and closes every finalized day not yet
+    # closed, so a missed night is caught up on the next run
+    closed = []
+    for store_id in await list_store_ids():
+        state = await db.system_state.find_one({"_id": f"rollups_finalized:{store_id}"})
+        if not state:
+            continue
+        through = as_utc(state["through"])
+        day = through - timedelta(days=DAILY_CLOSE_CATCH_UP_DAYS)
+        done = {
+            report["date"]
+            for report in await db.daily_reports.find(
+                {"store_id": store_id, "day": {"$gte": day}}, {"_id": 0, "date": 1}
+            ).to_list(None)
+        }
+        while day < through:
+            if day.date().isoformat() not in done and await close_business_day(store_id, day):
+                closed.append(f"{store_id}:{day.date().isoformat()}")
+            day += timedelta(days=1)
+    return {"closed": closed}
+
 # Product Routes
 @api_router.post("/products", response_model=Product)
 async def create_product(product: ProductCreate):
@@ -163,24 +2830,91 @@ async def create_product(product: ProductCreate):
     product_obj = Product(**product_dict)
     await db.products.insert_one(product_obj.dict())
     
-    # Create inventory entry for new product
-    inventory_item = InventoryItem(
-        product_id=product_obj.id,
-        quantity=0,
-        status=StockStatus.OUT_OF_STOCK
-    )
-    await db.inventory.insert_one(inventory_item.dict())
+    # Create an inventory entry for the new product in every store
+    await db.inventory.insert_many([
+        InventoryItem(
+            store_id=store_id,
+            product_id=product_obj.id,
+            quantity=0,
+            status=StockStatus.OUT_OF_STOCK
+        ).dict()
+        for store_id in await list_store_ids()
+    ])
+    production_queue.invalidate_all()
     
     return product_obj
 
 @api_router.get("/products", response_model=List[Product])
-async def get_products(category: Optional[CategoryType] = None):
+async def get_products(category: Optional[CategoryType] = None, fields: Optional[str] = None):
+    projection = sparse_fields(fields, Product)
     query = {}
     if category:
         query["category"] = category
-    products = await db.products.find(query).to_list(1000)
+    products = await db.products.find(query, projection).to_list(1000)
+    if projection:
+        return sparse_response(products)
     return [Product(**product) for product in products]
 
+@api_router.get("/products/search")
+async def search_products(
+    q: Optional[str] = Query(None, min_length=1, max_length=100),
+    category: Optional[CategoryType] = None,
+    available: Optional[bool] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    max_prep_time: Optional[int] = Query(None, ge=0),
+    sort: Optional[ProductSort] = None,
+    order: SortOrder = SortOrder.ASC,
+    limit: int = Query(25, ge=1, le=100),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    sort = sort or (ProductSort.RELEVANCE if q else ProductSort.NAME)
+    if sort == ProductSort.RELEVANCE and not q:
+        raise HTTPException(status_code=400, detail="Relevance sort needs a search query")
+
+    query: Dict[str, Any] = {}
+    if q:
+        query["$text"] = {"$search": q}
+    if category:
+        query["category"] = category
+    if available is not None:
+        query["is_available"] = available
+    if min_price is not None or max_price is not None:
+        query["price"] = {
+            **({"$gte": min_price} if min_price is not None else {}),
+            **({"$lte": max_price} if max_price is not None else {})
+        }
+    if max_prep_time is not None:
+        query["prep_time"] = {"$lte": max_prep_time}
+
+    position = decode_search_cursor(cursor, sort, order) if cursor else {}
+    offset = position.get("offset", 0)
+    projection = sparse_fields(fields, Product)
+    if sort == ProductSort.RELEVANCE:
+        projection = {**(projection or {}), "score": {"$meta": "textScore"}}
+        sort_spec = [("score", {"$meta": "textScore"}), ("id", ASCENDING)]
+    else:
+        if projection:
+            # The next cursor is built from the sort field
+            projection[sort.value] = 1
+        direction = ASCENDING if order == SortOrder.ASC else DESCENDING
+        sort_spec = [(sort.value, direction), ("id", direction)]
+        if position:
+            after = "$gt" if order == SortOrder.ASC else "$lt"
+            query = {"$and": [query, {"$or": [
+                {sort.value: {after: position["value"]}},
+                {sort.value: position["value"], "id": {after: position["id"]}}
+            ]}]}
+
+    # One extra row tells us whether there is a next page
+    products = await db.products.find(query, projection).sort(sort_spec).skip(offset).limit(limit + 1).to_list(limit + 1)
+    page = jsonable_encoder(products[:limit]) if fields else [Product(**product) for product in products[:limit]]
+    next_cursor = None
+    if len(products) > limit:
+        next_cursor = encode_search_cursor(sort, order, products[limit - 1], offset + limit)
+    return {"items": page, "next_cursor": next_cursor}
+
 @api_router.get("/products/{product_id}", response_model=Product)
 async def get_product(product_id: str):
     product = await db.products.find_one({"id": product_id})
@@ -200,6 +2934,7 @@ async def update_product(product_id: str, product_update: ProductUpdate):
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    production_queue.invalidate_all()
     
     updated_product = await db.products.find_one({"id": product_id})
     return Product(**updated_product)
@@ -210,26 +2945,121 @@ async def delete_product(product_id: str):
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    # Also delete inventory entry
-    await db.inventory.delete_one({"product_id": product_id})
+    # Also delete inventory entries and lots in every store
+    in_all_stores = {"store_id": {"$in": await list_store_ids()}, "product_id": product_id}
+    await db.inventory.delete_many(in_all_stores)
+    await db.inventory_lots.delete_many(in_all_stores)
+    await db.recipes.delete_one({"product_id": product_id})
+    # Registers learn about deletions through the sync deltas
+    await db.catalog_tombstones.insert_one({"product_id": product_id, "deleted_at": datetime.now(timezone.utc)})
+    production_queue.invalidate_all()
     return {"message": "Product deleted successfully"}
 
 # Inventory Routes
 @api_router.get("/inventory", response_model=List[InventoryItem])
-async def get_inventory():
-    inventory = await db.inventory.find().to_list(1000)
+async def get_inventory(store_id: str = Depends(store_scope), fields: Optional[str] = None):
+    projection = sparse_fields(fields, InventoryItem)
+    inventory = await db.inventory.find({"store_id": store_id}, projection).to_list(1000)
+    if projection:
+        return sparse_response(inventory)
     return [InventoryItem(**item) for item in inventory]
 
+@api_router.get("/inventory/forecast")
+async def get_inventory_forecast(
+    refresh: bool = False,
+    history_days: int = Query(28, ge=7, le=365),
+    horizon_days: int = Query(7, ge=1, le=28),
+    lead_days: int = Query(1, ge=1, le=14),
+    review_days: int = Query(1, ge=1, le=14),
+    store_id: str = Depends(store_scope)
+):
+    params = {
+        "history_days": history_days,
+        "horizon_days": max(horizon_days, lead_days + review_days),
+        "lead_days": lead_days,
+        "review_days": review_days
+    }
+    forecasts = []
+    if not refresh:
+        # Cached forecasts only count if they were fitted with the same parameters
+        forecasts = await db.forecasts.find(
+            {"store_id": store_id, **{f"params.{name}": value for name, value in params.items()}},
+            {"_id": 0}
+        ).to_list(None)
+    if not forecasts:
+        forecasts = await refresh_forecasts(store_id, **params)
+
+    product_ids = [forecast["product_id"] for forecast in forecasts]
+    inventory = await db.inventory.find({"store_id": store_id, "product_id": {"$in": product_ids}}).to_list(None)
+    current = {item["product_id"]: item for item in inventory}
+    for forecast in forecasts:
+        item = current.get(forecast["product_id"])
+        forecast["current_quantity"] = item["quantity"] if item else None
+        forecast["current_min_threshold"] = item["min_threshold"] if item else None
+        forecast["current_max_capacity"] = item["max_capacity"] if item else None
+    return forecasts
+
+@api_router.post("/inventory/forecast/apply")
+async def apply_inventory_forecast(store_id: str = Depends(store_scope)):
+    forecasts = await db.forecasts.find({"store_id": store_id}, {"_id": 0}).to_list(None)
+    if not forecasts:
+        raise HTTPException(status_code=404, detail="No forecast available, refresh it first")
+
+    suggestions = {forecast["product_id"]: forecast for forecast in forecasts}
+    inventory = await db.inventory.find({"store_id": store_id, "product_id": {"$in": list(suggestions)}}).to_list(None)
+    operations = []
+    for item in inventory:
+        forecast = suggestions[item["product_id"]]
+        min_threshold = forecast["suggested_min_threshold"]
+        operations.append(UpdateOne(
+            {"store_id": store_id, "product_id": item["product_id"]},
+            {"$set": {
+                "min_threshold": min_threshold,
+                "max_capacity": forecast["suggested_max_capacity"],
+                "status": update_stock_status(item["quantity"], min_threshold),
+                "updated_at": datetime.now(timezone.utc)
+            }}
+        ))
+    if operations:
+        await db.inventory.bulk_write(operations, ordered=False)
+        production_queue.invalidate(store_id)
+    return {"message": "Suggested thresholds applied", "updated": len(operations)}
+
+@api_router.get("/inventory/expiring")
+async def get_expiring_inventory(
+    within: int = Query(24, ge=0, le=24 * 30),
+    store_id: str = Depends(store_scope)
+):
+    now = datetime.now(timezone.utc)
+    lots = await db.inventory_lots.find({
+        "store_id": store_id,
+        "expiry_date": {"$lte": now + timedelta(hours=within)},
+        "quantity": {"$gt": 0}
+    }).sort("expiry_date", 1).to_list(None)
+
+    products = await get_product_map(lot["product_id"] for lot in lots)
+    return [
+        {
+            "lot_id": lot["id"],
+            "product_id": lot["product_id"],
+            "product_name": products.get(lot["product_id"], {}).get("name"),
+            "quantity": lot["quantity"],
+            "expiry_date": lot["expiry_date"],
+            "expired": as_utc(lot["expiry_date"]) <= now
+        }
+        for lot in lots
+    ]
+
 @api_router.get("/inventory/{product_id}", response_model=InventoryItem)
-async def get_inventory_item(product_id: str):
-    item = await db.inventory.find_one({"product_id": product_id})
+async def get_inventory_item(product_id: str, store_id: str = Depends(store_scope)):
+    item = await db.inventory.find_one({"store_id": store_id, "product_id": product_id})
     if not item:
         raise HTTPException(status_code=404, detail="Inventory item not found")
     return InventoryItem(**item)
 
 @api_router.put("/inventory/{product_id}", response_model=InventoryItem)
-async def update_inventory(product_id: str, update: InventoryUpdate):
-    current_item = await db.inventory.find_one({"product_id": product_id})
+async def update_inventory(product_id: str, update: InventoryUpdate, store_id: str = Depends(store_scope)):
+    current_item = await db.inventory.find_one({"store_id": store_id, "product_id": product_id})
     if not current_item:
         raise HTTPException(status_code=404, detail="Inventory item not found")
     
@@ -240,18 +3070,54 @@ async def update_inventory(product_id: str, update: InventoryUpdate):
         min_threshold = update_data.get("min_threshold", current_item["min_threshold"])
         update_data["status"] = update_stock_status(update_data["quantity"], min_threshold)
         update_data["last_restocked"] = datetime.now(timezone.utc)
+    update_data["updated_at"] = datetime.now(timezone.utc)
     
     await db.inventory.update_one(
-        {"product_id": product_id},
+        {"store_id": store_id, "product_id": product_id},
         {"$set": update_data}
     )
     
-    updated_item = await db.inventory.find_one({"product_id": product_id})
+    production_queue.invalidate(store_id)
+    updated_item = await db.inventory.find_one({"store_id": store_id, "product_id": product_id})
     return InventoryItem(**updated_item)
 
+@api_router.post("/inventory/{product_id}/lots", response_model=InventoryLot)
+async def receive_inventory_lot(product_id: str, lot: InventoryLotCreate, store_id: str = Depends(store_scope)):
+    current_item = await db.inventory.find_one({"store_id": store_id, "product_id": product_id})
+    if not current_item:
+        raise HTTPException(status_code=404, detail="Inventory item not found")
+
+    lot_obj = InventoryLot(store_id=store_id, product_id=product_id, initial_quantity=lot.quantity, **lot.dict())
+    await db.inventory_lots.insert_one(lot_obj.dict())
+
+    new_quantity = current_item["quantity"] + lot_obj.quantity
+    update_data = {
+        "quantity": new_quantity,
+        "status": update_stock_status(new_quantity, current_item["min_threshold"]),
+        "last_restocked": lot_obj.received_at,
+        "updated_at": lot_obj.received_at
+    }
+    current_expiry = current_item.get("expiry_date")
+    if lot_obj.expiry_date and (not current_expiry or as_utc(lot_obj.expiry_date) < as_utc(current_expiry)):
+        update_data["expiry_date"] = lot_obj.expiry_date
+    await db.inventory.update_one({"store_id": store_id, "product_id": product_id}, {"$set": update_data})
+    # A received batch should leave the kitchen queue right away
+    production_queue.invalidate(store_id)
+    return lot_obj
+
+@api_router.get("/inventory/{product_id}/lots", response_model=List[InventoryLot])
+async def get_inventory_lots(product_id: str, store_id: str = Depends(store_scope)):
+    lots = await db.inventory_lots.find({
+        "store_id": store_id,
+        "product_id": product_id,
+        "quantity": {"$gt": 0}
+    }).to_list(None)
+    return [InventoryLot(**lot) for lot in sorted(lots, key=lot_order)]
+
 @api_router.get("/inventory/alerts/low-stock")
-async def get_low_stock_alerts():
+async def get_low_stock_alerts(store_id: str = Depends(store_scope)):
     low_stock_items = await db.inventory.find({
+        "store_id": store_id,
         "status": {"$in": [StockStatus.LOW_STOCK, StockStatus.OUT_OF_STOCK]}
     }).to_list(1000)
     
@@ -269,83 +3135,237 @@ async def get_low_stock_alerts():
     
     return alerts
 
+# Ingredient Routes
+@api_router.post("/ingredients", response_model=Ingredient)
+async def create_ingredient(ingredient: IngredientCreate):
+    ingredient_obj = Ingredient(**ingredient.dict(exclude={"min_threshold"}))
+    await db.ingredients.insert_one(ingredient_obj.dict())
+
+    # Start every store at zero stock
+    await db.ingredient_stock.insert_many([
+        IngredientStock(
+            store_id=store_id,
+            ingredient_id=ingredient_obj.id,
+            min_threshold=ingredient.min_threshold
+        ).dict()
+        for store_id in await list_store_ids()
+    ])
+    return ingredient_obj
+
+@api_router.get("/ingredients", response_model=List[Ingredient])
+async def get_ingredients():
+    ingredients = await db.ingredients.find().to_list(1000)
+    return [Ingredient(**ingredient) for ingredient in ingredients]
+
+@api_router.get("/ingredients/stock", response_model=List[IngredientStock])
+async def get_ingredient_stock(
+    status: Optional[StockStatus] = None,
+    fields: Optional[str] = None,
+    store_id: str = Depends(store_scope)
+):
+    projection = sparse_fields(fields, IngredientStock)
+    query: Dict[str, Any] = {"store_id": store_id}
+    if status:
+        query["status"] = status
+    stock = await db.ingredient_stock.find(query, projection).to_list(1000)
+    if projection:
+        return sparse_response(stock)
+    return [IngredientStock(**row) for row in stock]
+
+@api_router.put("/ingredients/{ingredient_id}/stock", response_model=IngredientStock)
+async def update_ingredient_stock(
+    ingredient_id: str,
+    update: IngredientStockUpdate,
+    store_id: str = Depends(store_scope)
+):
+    ingredient = await db.ingredients.find_one({"id": ingredient_id})
+    current = await db.ingredient_stock.find_one({"store_id": store_id, "ingredient_id": ingredient_id})
+    if not ingredient or not current:
+        raise HTTPException(status_code=404, detail="Ingredient not found")
+
+    update_data = update.dict(exclude={"unit"}, exclude_none=True)
+    if "quantity" in update_data and update.unit:
+        update_data["quantity"] = to_base_units(update_data["quantity"], update.unit, ingredient)
+    quantity = update_data.get("quantity", current["quantity"])
+    update_data["status"] = update_stock_status(quantity, update_data.get("min_threshold", current["min_threshold"]))
+    update_data["updated_at"] = datetime.now(timezone.utc)
+
+    await db.ingredient_stock.update_one({"store_id": store_id, "ingredient_id": ingredient_id}, {"$set": update_data})
+    return IngredientStock(**{**current, **update_data})
+
+@api_router.put("/products/{product_id}/recipe", response_model=Recipe)
+async def set_product_recipe(product_id: str, recipe: RecipeCreate):
+    if not await db.products.find_one({"id": product_id}):
+        raise HTTPException(status_code=404, detail="Product not found")
+    ingredient_ids = list({line.ingredient_id for line in recipe.lines})
+    ingredients = {
+        ingredient["id"]: ingredient
+        for ingredient in await db.ingredients.find({"id": {"$in": ingredient_ids}}).to_list(None)
+    }
+    missing = [ingredient_id for ingredient_id in ingredient_ids if ingredient_id not in ingredients]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Ingredients not found: {', '.join(missing)}")
+
+    # Convert once here so a sale is just a multiply per ingredient
+    per_unit: Dict[str, float] = {}
+    for line in recipe.lines:
+        amount = to_base_units(line.quantity, line.unit, ingredients[line.ingredient_id]) / recipe.yield_quantity
+        per_unit[line.ingredient_id] = per_unit.get(line.ingredient_id, 0.0) + amount
+
+    recipe_obj = Recipe(product_id=product_id, per_unit=per_unit, **recipe.dict())
+    await db.recipes.replace_one({"product_id": product_id}, recipe_obj.dict(), upsert=True)
+    return recipe_obj
+
+@api_router.get("/products/{product_id}/recipe", response_model=Recipe)
+async def get_product_recipe(product_id: str):
+    recipe = await db.recipes.find_one({"product_id": product_id})
+    if not recipe:
+        raise HTTPException(status_code=404, detail="Recipe not found")
+    return Recipe(**recipe)
+
 # Sales Routes
 @api_router.post("/sales", response_model=Sale)
 async def create_sale(sale: SaleCreate):
+    await ensure_store(sale.store_id)
     sale_dict = sale.dict()
     sale_obj = Sale(**sale_dict)
-    
-    # Update inventory for sold items
-    for item in sale_obj.items:
-        inventory_item = await db.inventory.find_one({"product_id": item["product_id"]})
-        if inventory_item:
-            new_quantity = max(0, inventory_item["quantity"] - item["quantity"])
-            new_status = update_stock_status(new_quantity, inventory_item["min_threshold"])
-            
-            await db.inventory.update_one(
-                {"product_id": item["product_id"]},
-                {"$set": {"quantity": new_quantity, "status": new_status}}
-            )
-    
-    # Update customer data if provided
-    if sale_obj.customer_name:
-        customer = await db.customers.find_one({"name": sale_obj.customer_name})
-        if customer:
-            await db.customers.update_one(
-                {"id": customer["id"]},
-                {
-                    "$inc": {
-                        "total_orders": 1,
-                        "total_spent": sale_obj.total_amount,
-                        "loyalty_points": int(sale_obj.total_amount)
-                    }
-                }
-            )
-    
-    await db.sales.insert_one(sale_obj.dict())
+    sale_obj.client_sale_id = sale_obj.id
+    await record_sales(sale_obj.store_id, [sale_obj])
     return sale_obj
 
+@api_router.post("/sync")
+async def sync_register(request: SyncRequest):
+    store_id = await ensure_store(request.store_id)
+    sync_started = datetime.now(timezone.utc)
+
+    queued = sorted(request.sales, key=lambda sale: sale.sequence)
+    recorded = await record_sales(store_id, [
+        Sale(store_id=store_id, register_id=request.register_id, **sale.dict())
+        for sale in queued
+    ])
+    applied = {sale.client_sale_id for sale in recorded}
+    applied_ids, duplicate_ids = [], []
+    for sale in queued:
+        # A sale queued twice in one batch is applied once and reported once as a duplicate
+        if sale.client_sale_id in applied:
+            applied.discard(sale.client_sale_id)
+            applied_ids.append(sale.client_sale_id)
+        else:
+            duplicate_ids.append(sale.client_sale_id)
+    acknowledged_sequence = queued[-1].sequence if queued else None
+    if acknowledged_sequence is not None:
+        await db.registers.update_one(
+            {"store_id": store_id, "register_id": request.register_id},
+            {
+                "$max": {"last_sequence": acknowledged_sequence},
+                "$set": {"last_sync_at": sync_started}
+            },
+            upsert=True
+        )
+
+    # Catalog and stock changes since the register last synced; a missing
+    # token means the register has nothing cached and gets everything
+    since = decode_sync_token(request.since_token) if request.since_token else None
+    changed = {"updated_at": {"$gte": since}} if since else {}
+    deleted = {"deleted_at": {"$gte": since}}
+    products, inventory = await asyncio.gather(
+        db.products.find(changed, {"_id": 0}).to_list(None),
+        db.inventory.find({"store_id": store_id, **changed}, {"_id": 0}).to_list(None)
+    )
+    tombstones = []
+    if since:
+        tombstones = await db.catalog_tombstones.find(deleted, {"_id": 0, "product_id": 1}).to_list(None)
+
+    return {
+        "sync_token": encode_sync_token(sync_started - SYNC_TOKEN_OVERLAP),
+        "full": since is None,
+        "applied": applied_ids,
+        "duplicates": duplicate_ids,
+        "acknowledged_sequence": acknowledged_sequence,
+        "products": products,
+        "deleted_product_ids": [tombstone["product_id"] for tombstone in tombstones],
+        "inventory": inventory
+    }
+
 @api_router.get("/sales", response_model=List[Sale])
-async def get_sales(limit: int = 100):
-    sales = await db.sales.find().sort("timestamp", -1).limit(limit).to_list(limit)
+async def get_sales(
+    limit: int = 100,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    fields: Optional[str] = None,
+    store_id: str = Depends(store_scope)
+):
+    projection = sparse_fields(fields, Sale)
+    if start is None and end is None:
+        sales = await db.sales.find({"store_id": store_id}, projection).sort("timestamp", -1).limit(limit).to_list(limit)
+        if projection:
+            return sparse_response(sales)
+        return [Sale(**sale) for sale in sales]
+
+    # Explicit ranges may reach back past the hot tier into the archive
+    end = as_utc(end) if end else datetime.now(timezone.utc)
+    start = as_utc(start) if start else end - timedelta(days=1)
+    sales = list(reversed(await find_sales_range(store_id, start, end, limit)))
+    if projection:
+        # Archived chunks are unpacked whole, so trim them here (to top-level fields)
+        keep = {name.split(".")[0] for name in projection if name != "_id"}
+        return sparse_response([{key: sale[key] for key in keep if key in sale} for sale in sales])
     return [Sale(**sale) for sale in sales]
 
+@api_router.get("/sales/stream")
+async def stream_sales(request: Request, store_id: str = Depends(store_scope)):
+    subscriber = await sale_broadcaster.subscribe(store_id)
+
+    async def events():
+        try:
+            yield f"event: totals\ndata: {json.dumps(sale_broadcaster.totals_snapshot(store_id))}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if subscriber.dropped:
+                    yield "event: dropped\ndata: {}\n\n"
+                    return
+                yield f"event: sale\ndata: {json.dumps(jsonable_encoder(event))}\n\n"
+        finally:
+            sale_broadcaster.unsubscribe(store_id, subscriber)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @api_router.get("/sales/analytics/daily")
-async def get_daily_analytics():
-    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+async def get_daily_analytics(
+    days: int = Query(1, ge=1, le=SALES_CACHE_DAYS),
+    store_id: str = Depends(store_scope)
+):
+    start = start_of_day() - timedelta(days=days - 1)
     
-    # Daily sales
-    daily_sales = await db.sales.find({
-        "timestamp": {"$gte": today}
-    }).to_list(1000)
-    
-    total_revenue = sum(sale["total_amount"] for sale in daily_sales)
-    total_orders = len(daily_sales)
-    
-    # Popular items
-    item_counts = {}
-    for sale in daily_sales:
-        for item in sale["items"]:
-            product_id = item["product_id"]
-            quantity = item["quantity"]
-            if product_id in item_counts:
-                item_counts[product_id] += quantity
-            else:
-                item_counts[product_id] = quantity
+    # Sales since the start of the window, from the columnar cache
+    totals = await sales_columns.totals(store_id, start)
+    total_revenue = totals["revenue"]
+    total_orders = totals["orders"]
     
-    # Get product names for popular items
-    popular_items = []
-    for product_id, count in sorted(item_counts.items(), key=lambda x: x[1], reverse=True)[:5]:
-        product = await db.products.find_one({"id": product_id})
-        if product:
-            popular_items.append({
-                "name": product["name"],
-                "quantity_sold": count,
-                "category": product["category"]
-            })
+    # Popular items, with names looked up for the top five only
+    best_sellers = await sales_columns.units_by_product(store_id, start, limit=5)
+    products = await get_product_map(product_id for product_id, _ in best_sellers)
+    popular_items = [
+        {
+            "name": products[product_id]["name"],
+            "quantity_sold": count,
+            "category": products[product_id]["category"]
+        }
+        for product_id, count in best_sellers
+        if product_id in products
+    ]
     
     return {
-        "date": today.isoformat(),
+        "date": start.isoformat(),
+        "days": days,
         "total_revenue": total_revenue,
         "total_orders": total_orders,
         "average_order_value": total_revenue / total_orders if total_orders > 0 else 0,
@@ -353,45 +3373,462 @@ async def get_daily_analytics():
     }
 
 @api_router.get("/sales/analytics/category")
-async def get_category_analytics():
-    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    daily_sales = await db.sales.find({
-        "timestamp": {"$gte": today}
-    }).to_list(1000)
-    
-    category_stats = {}
-    
-    for sale in daily_sales:
-        for item in sale["items"]:
-            product = await db.products.find_one({"id": item["product_id"]})
-            if product:
-                category = product["category"]
-                if category not in category_stats:
-                    category_stats[category] = {
-                        "revenue": 0,
-                        "quantity": 0,
-                        "orders": 0
-                    }
-                category_stats[category]["revenue"] += item["price"] * item["quantity"]
-                category_stats[category]["quantity"] += item["quantity"]
-                category_stats[category]["orders"] += 1
-    
-    return category_stats
+async def get_category_analytics(
+    days: int = Query(1, ge=1, le=SALES_CACHE_DAYS),
+    store_id: str = Depends(store_scope)
+):
+    # Lines are grouped by the category frozen on the sale
+    return await sales_columns.category_stats(store_id, start_of_day() - timedelta(days=days - 1))
+
+# Production Routes
+@api_router.get("/production/queue")
+async def get_production_queue(station: Optional[EmployeeRole] = None, store_id: str = Depends(store_scope)):
+    return await production_queue.queue(store_id, station)
+
+# Heatmap Routes
+@api_router.get("/analytics/heatmap")
+async def get_sales_heatmap(
+    product_id: Optional[str] = None,
+    category: Optional[CategoryType] = None,
+    store_id: str = Depends(store_scope)
+):
+    if product_id and category:
+        raise HTTPException(status_code=400, detail="Pass product_id or category, not both")
+    dimension, key = ("product", product_id) if product_id else ("category", category.value) if category else ("store", "all")
+    heatmap = await db.sales_heatmaps.find_one({"store_id": store_id, "dimension": dimension, "key": key}) or {}
+    return {
+        "store_id": store_id,
+        "dimension": dimension,
+        "key": key,
+        "timezone": str(STORE_TIMEZONE),
+        "weekdays": WEEKDAY_NAMES,
+        "orders": heatmap_matrix(heatmap.get("orders", {})),
+        "units": heatmap_matrix(heatmap.get("units", {}))
+    }
+
+@api_router.get("/analytics/heatmap/peaks")
+async def get_peak_predictions(
+    day: Optional[date] = None,
+    peak_hours: int = Query(3, ge=1, le=24),
+    store_id: str = Depends(store_scope)
+):
+    """Expected orders per hour for a day (tomorrow by default) from its weekday's history.
+
+    Each product's busiest hours come with the time its prep has to start,
+    using prep_time, so batches are ready when the rush begins. The heatmaps
+    hold every sale so far, so averages divide by the weekday's occurrences
+    through today whichever day is asked for.
+
+    This reads one heatmap per product the store has sold, projected down
+    to the 24 slots of the requested weekday, so its cost grows with the
+    catalog rather than with sales volume.
+    """
+    until = datetime.now(STORE_TIMEZONE).date() + timedelta(days=1)
+    day = day or until
+    base = day.weekday() * 24
+    slots = [str(base + hour) for hour in range(24)]
+    heatmaps = await db.sales_heatmaps.find(
+        {"store_id": store_id, "dimension": {"$in": ["store", "product"]}},
+        {
+            "_id": 0, "dimension": 1, "key": 1, "first_sale_at": 1,
+            **{f"orders.{slot}": 1 for slot in slots},
+            **{f"units.{slot}": 1 for slot in slots}
+        }
+    ).to_list(None)
+    products = await get_product_map(heatmap["key"] for heatmap in heatmaps if heatmap["dimension"] == "product")
+
+    def expected(heatmap: Dict[str, Any], counter: str) -> List[float]:
+        weeks = weekdays_observed(heatmap["first_sale_at"], day.weekday(), until)
+        counts = heatmap.get(counter, {})
+        return [round(counts.get(str(base + hour), 0) / weeks, 2) if weeks else 0.0 for hour in range(24)]
+
+    def busiest(hourly: List[float]) -> List[int]:
+        return sorted(hour for hour in sorted(range(24), key=lambda hour: -hourly[hour])[:peak_hours] if hourly[hour] > 0)
+
+    store_orders = [0.0] * 24
+    prep = []
+    for heatmap in heatmaps:
+        if heatmap["dimension"] == "store":
+            store_orders = expected(heatmap, "orders")
+            continue
+        product = products.get(heatmap["key"])
+        hourly_units = expected(heatmap, "units")
+        if not product or not any(hourly_units):
+            continue
+        prep.append({
+            "product_id": product["id"],
+            "name": product["name"],
+            "prep_time": product.get("prep_time", 0),
+            "expected_units": round(sum(hourly_units), 2),
+            "batches": [
+                {
+                    "hour": hour,
+                    "expected_units": hourly_units[hour],
+                    "start_prep_at": (
+                        datetime.combine(day, datetime.min.time(), STORE_TIMEZONE)
+                        + timedelta(hours=hour, minutes=-product.get("prep_time", 0))
+                    ).isoformat()
+                }
+                for hour in busiest(hourly_units)
+            ]
+        })
+    prep.sort(key=lambda row: -row["expected_units"])
+    return {
+        "store_id": store_id,
+        "day": day,
+        "timezone": str(STORE_TIMEZONE),
+        "expected_orders": store_orders,
+        "peak_hours": busiest(store_orders),
+        "prep": prep
+    }
+
+# Margin Analytics Routes
+@api_router.get("/analytics/margin")
+async def get_margin_analytics(
+    group_by: MarginGroupBy = MarginGroupBy.PRODUCT,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    store_id: str = Depends(store_scope)
+):
+    start = as_utc(start) if start else start_of_day()
+    end = as_utc(end) if end else datetime.now(timezone.utc)
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+
+    group_keys = {
+        MarginGroupBy.PRODUCT: "$product_id",
+        MarginGroupBy.CATEGORY: "$category",
+        MarginGroupBy.HOUR: {"$hour": "$bucket"},
+        MarginGroupBy.EMPLOYEE: "$employee_id",
+    }
+    # Rollups are hourly, so the range is widened to whole hours
+    groups = await db.sales_rollups.aggregate([
+        {"$match": {"store_id": store_id, "bucket": {"$gte": hour_bucket(start), "$lt": end}}},
+        {"$group": {
+            "_id": group_keys[group_by],
+            "quantity": {"$sum": "$quantity"},
+            "revenue": {"$sum": "$revenue"},
+            "cogs": {"$sum": "$cogs"}
+        }},
+        {"$sort": {"revenue": -1}}
+    ]).to_list(None)
+
+    names = {}
+    keys = [group["_id"] for group in groups if group["_id"] is not None]
+    if group_by == MarginGroupBy.PRODUCT:
+        names = {pid: product["name"] for pid, product in (await get_product_map(keys)).items()}
+    elif group_by == MarginGroupBy.EMPLOYEE and keys:
+        employees = await db.employees.find({"id": {"$in": keys}}).to_list(len(keys))
+        names = {employee["id"]: employee["name"] for employee in employees}
+
+    total_revenue = sum(group["revenue"] for group in groups)
+    total_cogs = sum(group["cogs"] for group in groups)
+
+    return {
+        "store_id": store_id,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "group_by": group_by,
+        "totals": {
+            "quantity": sum(group["quantity"] for group in groups),
+            **margin_summary(total_revenue, total_cogs)
+        },
+        "groups": [
+            {
+                "key": group["_id"],
+                "name": names.get(group["_id"]),
+                "quantity": group["quantity"],
+                **margin_summary(group["revenue"], group["cogs"])
+            }
+            for group in groups
+        ]
+    }
+
+@api_router.post("/analytics/margin/rebuild")
+async def rebuild_margin_rollups(
+    start: datetime,
+    end: Optional[datetime] = None,
+    store_id: str = Depends(store_scope)
+):
+    end = as_utc(end) if end else datetime.now(timezone.utc)
+    buckets = await rebuild_sales_rollups(store_id, as_utc(start), end + timedelta(hours=1))
+    return {"message": "Rollups rebuilt", "buckets": buckets}
+
+# Job Routes
+@api_router.get("/jobs")
+async def get_jobs():
+    return await scheduler.status()
+
+@api_router.post("/jobs/{job_name}/run")
+async def run_job_now(job_name: str):
+    if job_name not in scheduler.jobs:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return await scheduler.run_job(job_name)
+
+# Store Routes
+@api_router.post("/stores", response_model=Store)
+async def create_store(store: StoreCreate):
+    store_obj = Store(**store.dict())
+    await db.stores.insert_one(store_obj.dict())
+    _known_store_ids.add(store_obj.id)
+
+    # Seed an empty inventory row for every catalog product
+    products = await db.products.find({}, {"_id": 0, "id": 1}).to_list(None)
+    if products:
+        await db.inventory.insert_many([
+            InventoryItem(
+                store_id=store_obj.id,
+                product_id=product["id"],
+                quantity=0,
+                status=StockStatus.OUT_OF_STOCK
+            ).dict()
+            for product in products
+        ])
+    ingredients = await db.ingredients.find({}, {"_id": 0, "id": 1}).to_list(None)
+    if ingredients:
+        await db.ingredient_stock.insert_many([
+            IngredientStock(store_id=store_obj.id, ingredient_id=ingredient["id"]).dict()
+            for ingredient in ingredients
+        ])
+    return store_obj
+
+@api_router.get("/stores", response_model=List[Store])
+async def get_stores():
+    stores = await db.stores.find().to_list(1000)
+    return [Store(**store) for store in stores]
+
+# Report Routes
+@api_router.get("/reports/daily/{date}")
+async def get_daily_report(
+    date: str,
+    format: ReportFormat = ReportFormat.JSON,
+    store_id: str = Depends(store_scope)
+):
+    try:
+        datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="date must be YYYY-MM-DD")
+    projection = {"_id": 0, "csv": 1} if format == ReportFormat.CSV else {"_id": 0, "csv": 0}
+    report = await db.daily_reports.find_one({"_id": f"{store_id}:{date}"}, projection)
+    if not report:
+        raise HTTPException(status_code=404, detail="No closed report for this day")
+    if format == ReportFormat.CSV:
+        return Response(
+            report["csv"],
+            media_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="daily-report-{store_id}-{date}.csv"'}
+        )
+    return report
+
+# Health Routes
+@api_router.get("/health/startup")
+async def get_startup_report():
+    return startup_report
+
+@api_router.get("/health/analytics-cache")
+async def get_analytics_cache_stats():
+    return sales_columns.stats()
+
+@api_router.get("/health/admission")
+async def get_admission_metrics():
+    return admission_control.metrics()
+
+# Profile Routes
+async def require_profiling_token(x_profile_token: Optional[str] = Header(None)):
+    if not PROFILING_TOKEN:
+        raise HTTPException(status_code=404, detail="Profiling is not enabled")
+    # Headers decode as latin-1, and compare_digest rejects non-ASCII str with a TypeError
+    if not x_profile_token or not hmac.compare_digest(x_profile_token.encode("latin-1"), PROFILING_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid profiling token")
+
+@api_router.get("/profiles", dependencies=[Depends(require_profiling_token)])
+async def get_profiles(limit: int = Query(50, ge=1, le=200)):
+    return await db.profiles.find({}, {"_id": 0, "stacks": 0}).sort("started_at", -1).to_list(limit)
+
+@api_router.get("/profiles/{profile_id}", dependencies=[Depends(require_profiling_token)])
+async def get_profile(profile_id: str, format: ProfileFormat = ProfileFormat.JSON):
+    profile = await db.profiles.find_one({"id": profile_id}, {"_id": 0})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == ProfileFormat.COLLAPSED:
+        return Response("".join(f"{row['stack']} {row['samples']}\n" for row in profile["stacks"]), media_type="text/plain")
+    return profile
 
 # Employee Routes
 @api_router.post("/employees", response_model=Employee)
 async def create_employee(employee: EmployeeCreate):
+    await ensure_store(employee.store_id)
     employee_dict = employee.dict()
     employee_obj = Employee(**employee_dict)
     await db.employees.insert_one(employee_obj.dict())
     return employee_obj
 
 @api_router.get("/employees", response_model=List[Employee])
-async def get_employees():
-    employees = await db.employees.find({"is_active": True}).to_list(1000)
+async def get_employees(store_id: str = Depends(store_scope), fields: Optional[str] = None):
+    projection = sparse_fields(fields, Employee)
+    employees = await db.employees.find({"store_id": store_id, "is_active": True}, projection).to_list(1000)
+    if projection:
+        return sparse_response(employees)
     return [Employee(**employee) for employee in employees]
 
+# Shift Routes
+@api_router.post("/shifts/clock-in", response_model=Shift)
+async def clock_in(request: ClockIn):
+    employee = await db.employees.find_one({"id": request.employee_id, "is_active": True})
+    if not employee:
+        raise HTTPException(status_code=404, detail="Employee not found")
+
+    shift_obj = Shift(
+        store_id=employee.get("store_id", DEFAULT_STORE_ID),
+        employee_id=employee["id"],
+        hourly_wage=employee["hourly_wage"],
+        clock_in=request.clock_in or datetime.now(timezone.utc)
+    )
+    try:
+        await db.shifts.insert_one(shift_obj.dict())
+    except DuplicateKeyError:
+        # The open-shift index allows one shift without a clock_out per employee
+        raise HTTPException(status_code=409, detail="Employee is already clocked in")
+    return shift_obj
+
+@api_router.post("/shifts/{shift_id}/clock-out", response_model=Shift)
+async def clock_out(shift_id: str, request: ClockOut):
+    shift = await db.shifts.find_one({"id": shift_id})
+    if not shift:
+        raise HTTPException(status_code=404, detail="Shift not found")
+    if shift.get("clock_out"):
+        raise HTTPException(status_code=409, detail="Shift is already closed")
+
+    clock_out_at = as_utc(request.clock_out) if request.clock_out else datetime.now(timezone.utc)
+    if clock_out_at <= as_utc(shift["clock_in"]):
+        raise HTTPException(status_code=400, detail="clock_out must be after clock_in")
+    result = await db.shifts.update_one({"id": shift_id, "clock_out": None}, {"$set": {"clock_out": clock_out_at}})
+    if not result.matched_count:
+        # Closed by a concurrent request since it was read
+        raise HTTPException(status_code=409, detail="Shift is already closed")
+    shift["clock_out"] = clock_out_at
+    return Shift(**shift)
+
+@api_router.get("/shifts", response_model=List[Shift])
+async def get_shifts(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    store_id: str = Depends(store_scope)
+):
+    start = as_utc(start) if start else start_of_day()
+    end = as_utc(end) if end else datetime.now(timezone.utc)
+    shifts = await get_shifts_overlapping(store_id, start, end)
+    return [Shift(**shift) for shift in sorted(shifts, key=lambda shift: shift["clock_in"])]
+
+@api_router.get("/analytics/labor")
+async def get_labor_analytics(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    store_id: str = Depends(store_scope)
+):
+    now = datetime.now(timezone.utc)
+    start = as_utc(start) if start else start_of_day()
+    end = min(as_utc(end) if end else now, now)
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+
+    shifts, sales_rows = await asyncio.gather(
+        get_shifts_overlapping(store_id, start, end),
+        db.sales_rollups.aggregate([
+            {"$match": {"store_id": store_id, "bucket": {"$gte": hour_bucket(start), "$lt": end}}},
+            {"$group": {
+                "_id": {"bucket": "$bucket", "employee_id": "$employee_id"},
+                "revenue": {"$sum": "$revenue"},
+                "items": {"$sum": "$quantity"}
+            }}
+        ]).to_list(None)
+    )
+
+    hours: Dict[datetime, Dict[str, float]] = {}
+    employees: Dict[str, Dict[str, Any]] = {}
+
+    def hour_row(bucket: datetime) -> Dict[str, float]:
+        return hours.setdefault(bucket, {"labor_hours": 0.0, "labor_cost": 0.0, "revenue": 0.0, "items": 0})
+
+    def employee_row(employee_id: str) -> Dict[str, Any]:
+        return employees.setdefault(employee_id, {
+            "labor_hours": 0.0, "labor_cost": 0.0, "revenue": 0.0, "items": 0, "hours": {}
+        })
+
+    for shift in shifts:
+        shift_start = max(as_utc(shift["clock_in"]), start)
+        shift_end = as_utc(shift["clock_out"]) if shift.get("clock_out") else now
+        shift_end = min(shift_end, end, as_utc(shift["clock_in"]) + timedelta(hours=MAX_SHIFT_HOURS))
+        employee = employee_row(shift["employee_id"])
+        for bucket, worked in split_into_hours(shift_start, shift_end):
+            cost = worked * shift["hourly_wage"]
+            row = hour_row(bucket)
+            row["labor_hours"] += worked
+            row["labor_cost"] += cost
+            employee["labor_hours"] += worked
+            employee["labor_cost"] += cost
+            employee["hours"].setdefault(bucket, {"labor_hours": 0.0, "items": 0})["labor_hours"] += worked
+
+    for sales_row in sales_rows:
+        bucket = as_utc(sales_row["_id"]["bucket"])
+        row = hour_row(bucket)
+        row["revenue"] += sales_row["revenue"]
+        row["items"] += sales_row["items"]
+        employee_id = sales_row["_id"].get("employee_id")
+        if employee_id:
+            employee = employee_row(employee_id)
+            employee["revenue"] += sales_row["revenue"]
+            employee["items"] += sales_row["items"]
+            employee["hours"].setdefault(bucket, {"labor_hours": 0.0, "items": 0})["items"] += sales_row["items"]
+
+    def labor_summary(row: Dict[str, float]) -> Dict[str, float]:
+        return {
+            "labor_hours": round(row["labor_hours"], 2),
+            "labor_cost": round(row["labor_cost"], 2),
+            "revenue": round(row["revenue"], 2),
+            "items": row["items"],
+            "sales_per_labor_hour": round(row["revenue"] / row["labor_hours"], 2) if row["labor_hours"] else None,
+            "labor_cost_pct": round(row["labor_cost"] / row["revenue"] * 100, 2) if row["revenue"] else None
+        }
+
+    names = {}
+    if employees:
+        staff = await db.employees.find({"id": {"$in": list(employees)}}).to_list(None)
+        names = {employee["id"]: employee["name"] for employee in staff}
+
+    totals = {"labor_hours": 0.0, "labor_cost": 0.0, "revenue": 0.0, "items": 0}
+    for row in hours.values():
+        for field in totals:
+            totals[field] += row[field]
+
+    return {
+        "store_id": store_id,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "totals": labor_summary(totals),
+        "hours": [
+            {"hour": bucket.isoformat(), **labor_summary(row)}
+            for bucket, row in sorted(hours.items())
+        ],
+        "employees": [
+            {
+                "employee_id": employee_id,
+                "name": names.get(employee_id),
+                **labor_summary(row),
+                "items_per_labor_hour": round(row["items"] / row["labor_hours"], 2) if row["labor_hours"] else None,
+                "hours": [
+                    {
+                        "hour": bucket.isoformat(),
+                        "labor_hours": round(hour["labor_hours"], 2),
+                        "items": hour["items"]
+                    }
+                    for bucket, hour in sorted(row["hours"].items())
+                ]
+            }
+            for employee_id, row in employees.items()
+        ]
+    }
+
 # Customer Routes
 @api_router.post("/customers", response_model=Customer)
 async def create_customer(customer: CustomerCreate):
@@ -400,36 +3837,55 @@ async def create_customer(customer: CustomerCreate):
     await db.customers.insert_one(customer_obj.dict())
     return customer_obj
 
+@api_router.get("/customers/segments")
+async def get_customer_segments(
+    segment: Optional[CustomerSegment] = None,
+    limit: int = Query(50, ge=1, le=500),
+    fields: Optional[str] = None
+):
+    """Segment sizes from the last scoring run, or one segment's customers by spend."""
+    if segment is None:
+        summary = await db.system_state.find_one({"_id": "customer_segments"}, {"_id": 0})
+        return summary or {"scored_at": None, "customers": 0, "segments": []}
+    projection = sparse_fields(fields, Customer)
+    customers = await db.customers.find({"rfm.segment": segment}, projection).sort("total_spent", -1).to_list(limit)
+    if projection:
+        return sparse_response(customers)
+    return [Customer(**customer) for customer in customers]
+
 @api_router.get("/customers", response_model=List[Customer])
-async def get_customers():
-    customers = await db.customers.find().sort("total_spent", -1).to_list(1000)
+async def get_customers(fields: Optional[str] = None):
+    projection = sparse_fields(fields, Customer)
+    customers = await db.customers.find({}, projection).sort("total_spent", -1).to_list(1000)
+    if projection:
+        return sparse_response(customers)
     return [Customer(**customer) for customer in customers]
 
 # Dashboard Routes
 @api_router.get("/dashboard/overview")
-async def get_dashboard_overview():
-    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-    
+async def get_dashboard_overview(store_id: str = Depends(store_scope)):
     # Today's sales
-    daily_sales = await db.sales.find({"timestamp": {"$gte": today}}).to_list(1000)
-    today_revenue = sum(sale["total_amount"] for sale in daily_sales)
-    today_orders = len(daily_sales)
+    totals = await sales_columns.totals(store_id, start_of_day())
+    today_revenue = totals["revenue"]
+    today_orders = totals["orders"]
     
     # Inventory alerts
     low_stock_count = await db.inventory.count_documents({
+        "store_id": store_id,
         "status": {"$in": [StockStatus.LOW_STOCK, StockStatus.OUT_OF_STOCK]}
     })
     
     # Total products
-    total_products = await db.products.count_documents({})
+    total_products = await db.products.estimated_document_count()
     
     # Total customers
-    total_customers = await db.customers.count_documents({})
+    total_customers = await db.customers.estimated_document_count()
     
     # Active employees
-    active_employees = await db.employees.count_documents({"is_active": True})
+    active_employees = await db.employees.count_documents({"store_id": store_id, "is_active": True})
     
     return {
+        "store_id": store_id,
         "today_revenue": today_revenue,
         "today_orders": today_orders,
         "low_stock_alerts": low_stock_count,
@@ -442,6 +3898,12 @@ async def get_dashboard_overview():
 # Include the router in the main app
 app.include_router(api_router)
 
+# Innermost, so profiles cover the handler rather than shedding or compression
+app.add_middleware(ProfilingMiddleware)
+
+# Added before CORS so shed responses still carry CORS headers
+app.add_middleware(AdmissionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -450,6 +3912,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so stale analytics served by admission control are compressed too
+app.add_middleware(CompressionMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -457,6 +3922,202 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+# Store-scoped collections and the shard key each one would use. Every
+# compound index below leads with store_id, so a per-store query only
+# touches that store's key range (or shard).
+SHARD_KEYS = {
+    "inventory": {"store_id": 1, "product_id": 1},
+    # Lots shard on their own id so the (store_id, id) unique index stays enforceable
+    "inventory_lots": {"store_id": 1, "id": 1},
+    "inventory_waste": {"store_id": 1, "swept_at": 1},
+    "ingredient_stock": {"store_id": 1, "ingredient_id": 1},
+    # Every sale carries a client_sale_id (direct sales reuse their id), and it
+    # leads the sync dedupe index so that index can stay unique
+    "sales": {"store_id": 1, "client_sale_id": 1},
+    "sales_rollups": {"store_id": 1, "bucket": 1},
+    "forecasts": {"store_id": 1, "product_id": 1},
+    "employees": {"store_id": 1, "id": 1},
+    # Prefixes the unique open-shift index
+    "shifts": {"store_id": 1, "employee_id": 1},
+    "sales_archive": {"store_id": 1, "day": 1},
+    "sale_tombstones": {"store_id": 1, "client_sale_id": 1},
+    "daily_reports": {"store_id": 1, "day": 1},
+    "sales_heatmaps": {"store_id": 1, "dimension": 1, "key": 1},
+}
+
+async def backfill_store_ids():
+    # Documents written before stores existed belong to the default store
+    for collection in SHARD_KEYS:
+        await db[collection].update_many(
+            {"store_id": {"$exists": False}},
+            {"$set": {"store_id": DEFAULT_STORE_ID}}
+        )
+    await db.stores.update_one(
+        {"id": DEFAULT_STORE_ID},
+        {"$setOnInsert": Store(id=DEFAULT_STORE_ID, name="Main Store").dict()},
+        upsert=True
+    )
+
+async def backfill_sale_keys():
+    # Sales from before client_sale_id existed would all share a null shard key.
+    # No index serves this filter, so it runs once and later boots skip it.
+    if await db.system_state.find_one({"_id": "migration:sale_keys"}):
+        return
+    await db.sales.update_many(
+        {"client_sale_id": None},
+        [{"$set": {"client_sale_id": "$id"}}]
+    )
+    await db.system_state.update_one(
+        {"_id": "migration:sale_keys"},
+        {"$set": {"completed_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+async def shard_store_collections():
+    try:
+        await client.admin.command("enableSharding", db.name)
+    except OperationFailure:
+        logger.exception("Could not enable sharding for %s", db.name)
+        return
+    # One collection that can't be sharded shouldn't stop the rest
+    for collection, key in SHARD_KEYS.items():
+        try:
+            await client.admin.command("shardCollection", f"{db.name}.{collection}", key=key)
+        except OperationFailure:
+            logger.exception("Could not shard %s", collection)
+
+INDEXES = {
+    "stores": [IndexModel("id", unique=True)],
+    "products": [
+        IndexModel("id", unique=True),
+        IndexModel("category"),
+        IndexModel("updated_at"),
+        IndexModel(
+            [("name", TEXT), ("description", TEXT), ("ingredients", TEXT)],
+            name="product_search",
+            weights={"name": 10, "ingredients": 3, "description": 1}
+        ),
+        # Keyset pagination for each search sort; id breaks ties
+        *(IndexModel([(field, ASCENDING), ("id", ASCENDING)]) for field in ("name", "price", "prep_time", "created_at")),
+    ],
+    "catalog_tombstones": [IndexModel("deleted_at")],
+    "sales": [
+        IndexModel([("store_id", ASCENDING), ("timestamp", ASCENDING)]),
+        IndexModel([("store_id", ASCENDING), ("id", ASCENDING)]),
+        IndexModel(
+            [("store_id", ASCENDING), ("archived_at", ASCENDING)],
+            partialFilterExpression={"archived_at": {"$type": "date"}}
+        ),
+        # Sales still waiting on their side effects, for the replay job
+        IndexModel(
+            [("store_id", ASCENDING), ("claimed_at", ASCENDING)],
+            partialFilterExpression={"applied": False}
+        ),
+        # Customers' newest orders, for backfill_last_orders
+        IndexModel([("store_id", ASCENDING), ("customer_name", ASCENDING), ("timestamp", ASCENDING)]),
+        # Backs the shard key; the partial dedupe index below can't
+        IndexModel([("store_id", ASCENDING), ("client_sale_id", ASCENDING)]),
+        # Replayed register batches collide here instead of double-counting
+        IndexModel(
+            [("store_id", ASCENDING), ("client_sale_id", ASCENDING), ("register_id", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"client_sale_id": {"$type": "string"}}
+        ),
+    ],
+    "sales_rollups": [
+        IndexModel(
+            [("store_id", ASCENDING), ("bucket", ASCENDING), ("product_id", ASCENDING), ("employee_id", ASCENDING)],
+            unique=True
+        ),
+    ],
+    "inventory": [
+        IndexModel([("store_id", ASCENDING), ("product_id", ASCENDING)], unique=True),
+        IndexModel([("store_id", ASCENDING), ("status", ASCENDING)]),
+        IndexModel([("store_id", ASCENDING), ("updated_at", ASCENDING)]),
+    ],
+    "inventory_lots": [
+        IndexModel([("store_id", ASCENDING), ("id", ASCENDING)], unique=True),
+        IndexModel([("store_id", ASCENDING), ("product_id", ASCENDING), ("expiry_date", ASCENDING)]),
+        # Only open lots are indexed, so sweeps never touch depleted batches
+        IndexModel(
+            [("store_id", ASCENDING), ("expiry_date", ASCENDING)],
+            partialFilterExpression={"quantity": {"$gt": 0}}
+        ),
+    ],
+    "inventory_waste": [IndexModel([("store_id", ASCENDING), ("swept_at", ASCENDING)])],
+    "ingredients": [IndexModel("id", unique=True)],
+    "ingredient_stock": [
+        IndexModel([("store_id", ASCENDING), ("ingredient_id", ASCENDING)], unique=True),
+        IndexModel([("store_id", ASCENDING), ("status", ASCENDING)]),
+    ],
+    "recipes": [IndexModel("product_id", unique=True)],
+    "sales_archive": [IndexModel([("store_id", ASCENDING), ("day", ASCENDING)])],
+    "sale_tombstones": [
+        IndexModel([("store_id", ASCENDING), ("client_sale_id", ASCENDING), ("register_id", ASCENDING)], unique=True),
+        IndexModel("purged_at", expireAfterSeconds=SALE_TOMBSTONE_RETENTION_DAYS * 86400),
+    ],
+    "daily_reports": [IndexModel([("store_id", ASCENDING), ("day", ASCENDING)])],
+    "sales_heatmaps": [
+        IndexModel([("store_id", ASCENDING), ("dimension", ASCENDING), ("key", ASCENDING)], unique=True)
+    ],
+    "profiles": [
+        IndexModel("id", unique=True),
+        IndexModel("started_at", expireAfterSeconds=PROFILE_RETENTION_DAYS * 86400)
+    ],
+    "registers": [IndexModel([("store_id", ASCENDING), ("register_id", ASCENDING)], unique=True)],
+    "forecasts": [IndexModel([("store_id", ASCENDING), ("product_id", ASCENDING)], unique=True)],
+    "employees": [
+        IndexModel([("store_id", ASCENDING), ("is_active", ASCENDING)]),
+        IndexModel([("store_id", ASCENDING), ("id", ASCENDING)]),
+        IndexModel("id"),
+    ],
+    "shifts": [
+        IndexModel([("store_id", ASCENDING), ("clock_in", ASCENDING)]),
+        IndexModel([("employee_id", ASCENDING), ("clock_out", ASCENDING)]),
+        # Backs the shard key; clock_in keeps its name apart from the partial index below
+        IndexModel([("store_id", ASCENDING), ("employee_id", ASCENDING), ("clock_in", ASCENDING)]),
+        # At most one open shift per employee, so concurrent clock-ins can't both land
+        IndexModel(
+            [("store_id", ASCENDING), ("employee_id", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"clock_out": {"$type": "null"}}
+        ),
+        IndexModel("id"),
+    ],
+    "customers": [
+        IndexModel("name"),
+        IndexModel([("total_spent", DESCENDING)]),
+        IndexModel([("rfm.segment", ASCENDING), ("total_spent", DESCENDING)]),
+        IndexModel([("total_orders", ASCENDING), ("last_order_at", ASCENDING)])
+    ],
+}
+
+# Indexes superseded by INDEXES, dropped once their replacements exist. The
+# pre-store unique indexes would also block per-store rows.
+REPLACED_INDEXES = [
+    ("sales_rollups", "bucket_1_product_id_1_employee_id_1"),
+    ("forecasts", "product_id_1"),
+    ("inventory", "product_id_1"),
+    ("inventory_lots", "id_1"),
+    ("inventory_lots", "product_id_1_expiry_date_1"),
+    ("inventory_lots", "expiry_date_1"),
+    ("sales", "store_id_1_register_id_1_client_sale_id_1"),
+]
+
+async def ensure_indexes():
+    await asyncio.gather(backfill_store_ids(), backfill_sale_keys())
+    await asyncio.gather(*(
+        db[collection].create_indexes(indexes)
+        for collection, indexes in INDEXES.items()
+    ))
+    for collection, index in REPLACED_INDEXES:
+        try:
+            await db[collection].drop_index(index)
+        except OperationFailure:
+            pass
+
+    if os.environ.get('MONGO_SHARDED', 'false').lower() == 'true':
+        await shard_store_collections()
+
+async def warm_caches():
+    await list_store_ids()
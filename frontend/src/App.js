@@ -28,7 +28,7 @@ const App = () => {
 
   const fetchProducts = async () => {
     try {
-      const response = await fetch(`${API}/products`);
+      const response = await fetch(`${API}/products?fields=name,category,description,price,cost,is_available`);
       const data = await response.json();
       setProducts(data);
     } catch (error) {
@@ -38,7 +38,7 @@ const App = () => {
 
   const fetchInventory = async () => {
     try {
-      const response = await fetch(`${API}/inventory`);
+      const response = await fetch(`${API}/inventory?fields=product_id,quantity,min_threshold,status,last_restocked`);
       const data = await response.json();
       setInventory(data);
       
@@ -53,7 +53,7 @@ const App = () => {
 
   const fetchSales = async () => {
     try {
-      const response = await fetch(`${API}/sales?limit=50`);
+      const response = await fetch(`${API}/sales?limit=50&fields=timestamp,customer_name,items.quantity,total_amount,payment_method`);
       const data = await response.json();
       setSales(data);
     } catch (error) {
@@ -90,6 +90,28 @@ const App = () => {
     fetchCustomers();
   }, []);
 
+  // Live sales ticker: push updates instead of refetching the dashboard
+  useEffect(() => {
+    const source = new EventSource(`${API}/sales/stream`);
+    const applyTotals = (totals) => {
+      if (totals) {
+        setDashboardData((current) => ({ ...current, ...totals }));
+      }
+    };
+    source.addEventListener('totals', (event) => applyTotals(JSON.parse(event.data)));
+    source.addEventListener('sale', (event) => {
+      const { sale, totals } = JSON.parse(event.data);
+      applyTotals(totals);
+      setSales((current) => [sale, ...current.filter((existing) => existing.id !== sale.id)].slice(0, 50));
+    });
+    source.addEventListener('dropped', () => {
+      // The server dropped us for falling behind; resync and let EventSource reconnect
+      fetchDashboardData();
+      fetchSales();
+    });
+    return () => source.close();
+  }, []);
+
   // Component for Dashboard
   const Dashboard = () => (
     <div className="space-y-6">
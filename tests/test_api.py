@@ -0,0 +1,539 @@
+"""In-process API tests.
+
+The app runs under the ASGI test client with STORAGE_BACKEND=memory, so
+these need neither a server nor MongoDB and finish in well under a second.
+"""
+import asyncio
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def client():
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("STORAGE_BACKEND", "memory")
+        patch.setenv("DB_NAME", "api_tests")
+        patch.setenv("SCHEDULER_ENABLED", "false")
+        with TestClient(server.app) as test_client:
+            yield test_client
+
+
+@pytest.fixture(scope="module")
+def products(client):
+    created = {}
+    for name, category, price, prep_time in [
+        ("Glazed Donut", "donuts", 1.5, 5),
+        ("Chocolate Donut", "donuts", 1.75, 5),
+        ("Sausage Kolache", "kolaches", 3.0, 12),
+    ]:
+        response = client.post("/api/products", json={
+            "name": name, "category": category, "price": price, "cost": price / 3, "prep_time": prep_time
+        })
+        assert response.status_code == 200
+        created[name] = response.json()
+    return created
+
+
+def queued_sale(product, sequence, quantity=1):
+    return {
+        "client_sale_id": str(uuid.uuid4()),
+        "sequence": sequence,
+        "timestamp": (datetime.now(timezone.utc) - timedelta(minutes=sequence)).isoformat(),
+        "items": [{"product_id": product["id"], "quantity": quantity, "price": product["price"]}],
+        "total_amount": product["price"] * quantity
+    }
+
+
+def db_call(client, operation):
+    # Runs a coroutine-returning callable on the app's event loop
+    return client.portal.call(operation)
+
+
+def test_product_crud(client, products):
+    product = products["Glazed Donut"]
+    assert client.get(f"/api/products/{product['id']}").json()["name"] == "Glazed Donut"
+
+    updated = client.put(f"/api/products/{product['id']}", json={
+        "name": "Glazed Donut", "category": "donuts", "price": 1.6, "cost": 0.5
+    })
+    assert updated.json()["price"] == 1.6
+
+    listed = client.get("/api/products", params={"fields": "id,name"}).json()
+    assert {item["name"] for item in listed} >= set(products)
+    assert all(set(item) == {"id", "name"} for item in listed)
+
+    assert client.get("/api/products/missing").status_code == 404
+
+
+def test_product_search(client, products):
+    results = client.get("/api/products/search", params={"q": "donuts"}).json()
+    assert {item["name"] for item in results["items"]} == {"Glazed Donut", "Chocolate Donut"}
+
+    filtered = client.get("/api/products/search", params={"category": "kolaches", "max_prep_time": 15}).json()
+    assert [item["name"] for item in filtered["items"]] == ["Sausage Kolache"]
+
+
+def test_sync_is_idempotent(client, products):
+    sales = [queued_sale(products["Sausage Kolache"], sequence) for sequence in range(20)]
+    first = client.post("/api/sync", json={"register_id": "register-1", "sales": sales}).json()
+    again = client.post("/api/sync", json={"register_id": "register-1", "sales": sales}).json()
+
+    assert len(first["applied"]) == 20
+    assert again["applied"] == []
+    assert len(again["duplicates"]) == 20
+
+
+def test_sync_replays_sales_left_unapplied(client, products, monkeypatch):
+    store_id = client.post("/api/stores", json={"name": "Retries"}).json()["id"]
+    product = products["Glazed Donut"]
+    scope = {"store_id": store_id}
+    client.put(f"/api/inventory/{product['id']}", params=scope, json={"quantity": 50, "min_threshold": 5})
+    monkeypatch.setattr(server, "SALE_APPLY_LEASE", timedelta(0))
+
+    async def lost_connection(*args):
+        raise ConnectionError("primary stepped down")
+
+    sale = {**queued_sale(product, 0, quantity=2), "store_id": store_id}
+    batch = {"register_id": "register-9", "store_id": store_id, "sales": [sale, sale]}
+    with monkeypatch.context() as patch:
+        patch.setattr(server, "consume_lots_fifo", lost_connection)
+        with pytest.raises(ConnectionError):
+            client.post("/api/sync", json=batch)
+    stored = db_call(client, lambda: server.db.sales.find({"store_id": store_id}).to_list(None))
+    assert [row["applied"] for row in stored] == [False]
+
+    retried = client.post("/api/sync", json=batch).json()
+    assert (retried["applied"], retried["duplicates"]) == ([sale["client_sale_id"]], [sale["client_sale_id"]])
+    assert client.get("/api/inventory", params=scope).json()[0]["quantity"] == 48
+
+    again = client.post("/api/sync", json=batch).json()
+    assert again["applied"] == [] and len(again["duplicates"]) == 2
+    assert client.get("/api/inventory", params=scope).json()[0]["quantity"] == 48
+
+    # A failed request that is never retried is picked up by the replay job
+    orphan = {**queued_sale(product, 1, quantity=3), "store_id": store_id}
+    with monkeypatch.context() as patch:
+        patch.setattr(server, "consume_lots_fifo", lost_connection)
+        with pytest.raises(ConnectionError):
+            client.post("/api/sync", json={**batch, "sales": [orphan]})
+    assert client.post("/api/jobs/sale_replay/run").json()["last_status"] == "success"
+    assert client.get("/api/inventory", params=scope).json()[0]["quantity"] == 45
+
+
+def test_sync_replay_skips_effects_already_applied(client, products, monkeypatch):
+    store_id = client.post("/api/stores", json={"name": "Partial"}).json()["id"]
+    product = products["Glazed Donut"]
+    scope = {"store_id": store_id}
+    client.put(f"/api/inventory/{product['id']}", params=scope, json={"quantity": 50, "min_threshold": 5})
+    client.post("/api/customers", json={"name": "Partial Pat"})
+    monkeypatch.setattr(server, "SALE_APPLY_LEASE", timedelta(0))
+
+    async def lost_connection(*args):
+        raise ConnectionError("primary stepped down")
+
+    sale = {**queued_sale(product, 0, quantity=2), "store_id": store_id, "customer_name": "Partial Pat"}
+    batch = {"register_id": "register-8", "store_id": store_id, "sales": [sale]}
+    with monkeypatch.context() as patch:
+        patch.setattr(server, "update_sales_heatmaps", lost_connection)
+        with pytest.raises(ConnectionError):
+            client.post("/api/sync", json=batch)
+    stored = db_call(client, lambda: server.db.sales.find_one({"store_id": store_id}))
+    assert not stored["applied"]
+    assert set(stored["effects_applied"]) == {"lots", "ingredients", "inventory", "customers", "rollups"}
+
+    assert client.post("/api/sync", json=batch).json()["applied"] == [sale["client_sale_id"]]
+    assert client.get("/api/inventory", params=scope).json()[0]["quantity"] == 48
+    customer = db_call(client, lambda: server.db.customers.find_one({"name": "Partial Pat"}))
+    assert customer["total_orders"] == 1
+    stored = db_call(client, lambda: server.db.sales.find_one({"store_id": store_id}))
+    assert stored["applied"] and "effects_applied" not in stored
+
+
+def test_sales_feed_analytics(client, products):
+    product = products["Chocolate Donut"]
+    client.post("/api/customers", json={"name": "Dana"})
+    response = client.post("/api/sales", json={
+        "items": [{"product_id": product["id"], "quantity": 4, "price": product["price"]}],
+        "total_amount": product["price"] * 4,
+        "customer_name": "Dana"
+    })
+    assert response.status_code == 200
+
+    categories = client.get("/api/sales/analytics/category").json()
+    assert categories["donuts"]["quantity"] >= 4
+
+    customers = client.get("/api/customers").json()
+    assert any(customer["name"] == "Dana" and customer["total_orders"] == 1 for customer in customers)
+
+
+def test_recipes_deduct_ingredient_stock(client, products):
+    product = products["Glazed Donut"]
+    flour = client.post("/api/ingredients", json={"name": "Flour", "unit": "g"}).json()
+    client.put(f"/api/ingredients/{flour['id']}/stock", json={"quantity": 1000, "min_threshold": 100})
+    client.put(f"/api/products/{product['id']}/recipe", json={
+        "lines": [{"ingredient_id": flour["id"], "quantity": 0.1, "unit": "kg"}]
+    })
+
+    client.post("/api/sync", json={"register_id": "register-2", "sales": [queued_sale(product, 1, quantity=3)]})
+
+    stock = client.get("/api/ingredients/stock").json()
+    assert next(row for row in stock if row["ingredient_id"] == flour["id"])["quantity"] == 700
+
+
+def test_jobs_run_against_memory_backend(client):
+    for name in server.scheduler.jobs:
+        result = client.post(f"/api/jobs/{name}/run").json()
+        assert result["last_status"] == "success", result
+
+
+def test_admission_sheds_analytics_per_client(client, monkeypatch):
+    monkeypatch.setattr(server, "ANALYTICS_BURST", 2)
+    monkeypatch.setattr(server, "ANALYTICS_RATE_PER_MINUTE", 1)
+    monkeypatch.setattr(server, "admission_control", server.AdmissionController())
+
+    assert client.get("/api/sales/analytics/category").status_code == 200
+    assert client.get("/api/sales/analytics/daily").status_code == 200
+    # A forged X-Forwarded-For from an untrusted peer doesn't buy a fresh bucket
+    spoofed = {"X-Forwarded-For": "198.51.100.7"}
+    shed = client.get("/api/sales/analytics/category", params={"days": 1}, headers=spoofed)
+    assert shed.status_code == 429
+    assert int(shed.headers["retry-after"]) > 0
+    stale = client.get("/api/sales/analytics/category", headers=spoofed)
+    assert (stale.status_code, stale.headers["x-cache"]) == (200, "stale")
+    metrics = client.get("/api/health/admission").json()
+    assert (metrics["admitted"], metrics["throttled"], metrics["served_stale"]) == (2, 2, 1)
+
+    # Behind a trusted proxy the nearest untrusted hop is the client
+    monkeypatch.setattr(server, "TRUSTED_PROXIES", [server.ipaddress.ip_network("10.0.0.0/8")])
+    scope = {"client": ("10.0.0.5", 443), "headers": [(b"x-forwarded-for", b"203.0.113.9, 198.51.100.7, 10.0.0.6")]}
+    assert server.admission_control.bucket_for(scope) is server.admission_control.buckets["198.51.100.7"]
+    assert server.admission_control.bucket_for({"client": ("192.0.2.1", 443), "headers": scope["headers"]}) \
+        is server.admission_control.buckets["192.0.2.1"]
+
+
+def test_customer_scoring_segments_customers(client, products):
+    product = products["Sausage Kolache"]
+    for spend, name in enumerate(["Ari", "Bea", "Cal", "Dee", "Eli"], start=1):
+        client.post("/api/customers", json={"name": name})
+        sales = [{**queued_sale(product, spend * 60 * 24 * 10 + i), "customer_name": name} for i in range(spend)]
+        client.post("/api/sync", json={"register_id": "register-3", "sales": sales})
+
+    result = client.post("/api/jobs/customer_scoring/run").json()
+    assert result["last_status"] == "success", result
+
+    summary = client.get("/api/customers/segments").json()
+    assert summary["customers"] == sum(segment["customers"] for segment in summary["segments"])
+
+    customers = {customer["name"]: customer for customer in client.get("/api/customers").json()}
+    assert customers["Eli"]["rfm"]["frequency"] > customers["Ari"]["rfm"]["frequency"]
+    assert customers["Ari"]["rfm"]["recency"] > customers["Eli"]["rfm"]["recency"]
+
+    segment = customers["Eli"]["rfm"]["segment"]
+    listed = client.get("/api/customers/segments", params={"segment": segment, "fields": "name"}).json()
+    assert {"id": customers["Eli"]["id"], "name": "Eli"} in listed
+
+
+def test_customer_scoring_backfills_last_order(client, products):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    hot_order, archived_order = now - timedelta(days=3), now - timedelta(days=200)
+    legacy = {"total_orders": 1, "total_spent": 4.0}
+    for name in ("Fay", "Gus", "Hal"):
+        client.post("/api/customers", json={"name": name})
+        db_call(client, lambda: server.db.customers.update_one(
+            {"name": name}, {"$set": legacy, "$unset": {"last_order_at": ""}}
+        ))
+    sale = server.Sale(items=[], total_amount=4.0, customer_name="Fay", timestamp=hot_order).dict()
+    db_call(client, lambda: server.db.sales.insert_one(sale))
+    archived = [server.Sale(items=[], total_amount=4.0, customer_name="Gus", timestamp=archived_order).dict()]
+    db_call(client, lambda: server.db.sales_archive.insert_one({
+        "_id": "backfill-test", "store_id": server.DEFAULT_STORE_ID, "day": server.start_of_day(archived_order),
+        "count": 1, "total_amount": 4.0, "data": server.pack_sales(archived)
+    }))
+
+    result = client.post("/api/jobs/customer_scoring/run").json()
+    assert result["last_status"] == "success", result
+    assert result["last_result"]["backfilled"] == 2
+
+    customers = {customer["name"]: customer for customer in client.get("/api/customers").json()}
+    assert datetime.fromisoformat(customers["Fay"]["last_order_at"]).replace(tzinfo=timezone.utc) == hot_order
+    assert datetime.fromisoformat(customers["Gus"]["last_order_at"]).replace(tzinfo=timezone.utc) == archived_order
+    assert customers["Hal"]["last_order_at"] is None
+    assert client.post("/api/jobs/customer_scoring/run").json()["last_result"]["backfilled"] == 0
+
+
+def test_profiling_header_stores_profile(client, products, monkeypatch):
+    headers = {"X-Profile-Token": "secret"}
+    assert client.get("/api/profiles", headers=headers).status_code == 404
+
+    monkeypatch.setattr(server, "PROFILING_TOKEN", "secret")
+    assert "x-profile-id" not in client.get("/api/sales/analytics/category").headers
+    assert client.get("/api/sales/analytics/category", headers={"X-Profile-Token": "wrong"}).status_code == 403
+    assert client.get("/api/profiles", headers={"X-Profile-Token": "s\u00e9cret".encode("latin-1")}).status_code == 403
+
+    response = client.get("/api/sales/analytics/category", headers=headers)
+    assert response.status_code == 200
+    profile_id = response.headers["x-profile-id"]
+
+    profile = client.get(f"/api/profiles/{profile_id}", headers=headers).json()
+    assert profile["path"] == "/api/sales/analytics/category"
+    assert profile["status_code"] == 200
+    assert profile["wall_ms"] >= profile["cpu_ms"] >= 0
+    assert (profile["timings_scope"], profile["concurrent_requests"], profile["truncated"]) == ("event_loop", 0, False)
+
+    collapsed = client.get(f"/api/profiles/{profile_id}", params={"format": "collapsed"}, headers=headers)
+    assert collapsed.headers["content-type"].startswith("text/plain")
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in collapsed.text.splitlines()) == profile["samples"]
+
+    assert [row["id"] for row in client.get("/api/profiles", headers=headers).json()][0] == profile_id
+    assert client.get("/api/profiles").status_code == 403
+
+
+def test_profile_gives_up_slot_at_deadline(client, monkeypatch):
+    monkeypatch.setattr(server, "PROFILE_MAX_SECONDS", 0.05)
+
+    async def outlive_deadline():
+        profile = server.active_profile = server.RequestProfile()
+        profile.start()
+        await asyncio.sleep(0.3)
+        slot_free = server.active_profile is None
+        profile.stop()
+        return slot_free, profile
+
+    slot_free, profile = client.portal.call(outlive_deadline)
+    assert slot_free and profile.truncated
+    assert 50 <= profile.wall_ms < 300
+
+
+def test_heatmap_counts_and_peak_predictions(client, products):
+    product = products["Chocolate Donut"]
+    store_id = client.post("/api/stores", json={"name": "Heatmap"}).json()["id"]
+    tomorrow = datetime.now(timezone.utc).date() + timedelta(days=1)
+    # The same weekday two and three weeks back, 07:00 UTC
+    sales = []
+    for weeks_back in (2, 3):
+        sold_at = datetime.combine(tomorrow - timedelta(weeks=weeks_back), datetime.min.time(), timezone.utc) + timedelta(hours=7)
+        sale = queued_sale(product, weeks_back, quantity=6)
+        sales.append({**sale, "store_id": store_id, "timestamp": sold_at.isoformat()})
+    client.post("/api/sync", json={"register_id": "register-4", "store_id": store_id, "sales": sales})
+
+    heatmap = client.get("/api/analytics/heatmap", params={"store_id": store_id, "product_id": product["id"]}).json()
+    slot = (tomorrow.weekday(), 7)
+    assert heatmap["units"][slot[0]][slot[1]] == 12
+    assert heatmap["orders"][slot[0]][slot[1]] == 2
+    assert sum(map(sum, heatmap["units"])) == 12
+
+    category = client.get("/api/analytics/heatmap", params={"store_id": store_id, "category": "donuts"}).json()
+    assert category["orders"][slot[0]][slot[1]] == 2
+
+    peaks = client.get("/api/analytics/heatmap/peaks", params={"store_id": store_id}).json()
+    assert peaks["peak_hours"] == [7]
+    # Three of that weekday have passed since the first sale, one without orders
+    assert peaks["expected_orders"][7] == 0.67
+    prep = peaks["prep"][0]
+    assert prep["product_id"] == product["id"]
+    assert prep["batches"] == [{
+        "hour": 7,
+        "expected_units": 4.0,
+        "start_prep_at": f"{tomorrow.isoformat()}T06:55:00+00:00"
+    }]
+
+    # A past day of the same weekday averages over the same history
+    last_week = client.get("/api/analytics/heatmap/peaks", params={
+        "store_id": store_id, "day": (tomorrow - timedelta(weeks=1)).isoformat()
+    }).json()
+    assert last_week["expected_orders"] == peaks["expected_orders"]
+    assert last_week["prep"][0]["batches"][0]["expected_units"] == 4.0
+
+
+def test_production_queue_follows_sales(client, products):
+    store_id = client.post("/api/stores", json={"name": "Kitchen"}).json()["id"]
+    glazed, kolache = products["Glazed Donut"], products["Sausage Kolache"]
+    scope = {"store_id": store_id}
+    client.put(f"/api/inventory/{glazed['id']}", params=scope, json={"quantity": 40, "min_threshold": 10})
+    client.put(f"/api/inventory/{kolache['id']}", params=scope, json={"quantity": 20, "min_threshold": 10})
+
+    before = client.get("/api/production/queue", params=scope).json()
+    assert [batch["name"] for batch in before["queue"]] == ["Chocolate Donut"]
+    assert before["queue"][0]["status"] == "restock"
+
+    sales = [{**queued_sale(glazed, sequence, quantity=3), "store_id": store_id} for sequence in range(10)]
+    client.post("/api/sync", json={"register_id": "register-5", "store_id": store_id, "sales": sales})
+
+    after = client.get("/api/production/queue", params=scope).json()
+    assert after["built_at"] == before["built_at"]  # applied from the sales, not rebuilt
+    assert [batch["name"] for batch in after["queue"]] == ["Glazed Donut", "Chocolate Donut"]
+    donuts = after["queue"][0]
+    assert donuts["on_hand"] == 10
+    assert donuts["station"] == "baker"
+    assert donuts["status"] == "upcoming"
+    assert donuts["velocity_per_hour"] > 0 and donuts["quantity"] > 0
+
+    assert client.get("/api/production/queue", params={**scope, "station": "prep_cook"}).json()["queue"] == []
+
+    client.put(f"/api/inventory/{glazed['id']}", params=scope, json={"quantity": 100})
+    restocked = client.get("/api/production/queue", params=scope).json()
+    assert [batch["name"] for batch in restocked["queue"]] == ["Chocolate Donut"]
+
+    # Catalog edits reach every store's queue without waiting for the rebuild interval
+    client.put(f"/api/products/{products['Chocolate Donut']['id']}", json={"prep_time": 5})
+    edited = client.get("/api/production/queue", params=scope).json()
+    assert edited["built_at"] != restocked["built_at"]
+
+
+def test_rollup_rebuild_replaces_closed_hours(client, products):
+    store_id = client.post("/api/stores", json={"name": "Rollups"}).json()["id"]
+    product = products["Glazed Donut"]
+    sold_at = datetime.now(timezone.utc) - timedelta(hours=3)
+    sales = [{**queued_sale(product, 0, quantity=2), "store_id": store_id, "timestamp": sold_at.isoformat()}]
+    client.post("/api/sync", json={"register_id": "register-6", "store_id": store_id, "sales": sales})
+    # Drift the rollup and leave a stray bucket behind
+    db_call(client, lambda: server.db.sales_rollups.update_many({"store_id": store_id}, {"$inc": {"quantity": 5}}))
+    db_call(client, lambda: server.db.sales_rollups.insert_one({
+        "store_id": store_id, "bucket": server.hour_bucket(sold_at), "product_id": "gone", "employee_id": None, "quantity": 1
+    }))
+
+    response = client.post("/api/analytics/margin/rebuild", params={
+        "store_id": store_id, "start": (sold_at - timedelta(hours=1)).isoformat()
+    })
+    assert response.json()["buckets"] == 1
+
+    rollups = db_call(client, lambda: server.db.sales_rollups.find({"store_id": store_id}).to_list(None))
+    assert [(row["product_id"], row["quantity"]) for row in rollups] == [(product["id"], 2)]
+
+
+def test_forecast_cache_respects_parameters(client, products):
+    store_id = client.post("/api/stores", json={"name": "Forecast"}).json()["id"]
+    product = products["Sausage Kolache"]
+    yesterday = datetime.now(timezone.utc) - timedelta(days=1)
+    sales = [
+        {**queued_sale(product, days, quantity=2), "store_id": store_id, "timestamp": (yesterday - timedelta(days=days)).isoformat()}
+        for days in range(10)
+    ]
+    client.post("/api/sync", json={"register_id": "register-7", "store_id": store_id, "sales": sales})
+
+    def forecast(**params):
+        return client.get("/api/inventory/forecast", params={"store_id": store_id, **params}).json()[0]
+
+    assert forecast()["params"]["history_days"] == 28
+
+    shorter = forecast(history_days=14, lead_days=2)
+    assert (shorter["params"]["history_days"], shorter["params"]["lead_days"]) == (14, 2)
+    # The cached 14-day fit must not be served for the default parameters
+    assert forecast()["params"]["history_days"] == 28
+
+
+def test_lots_drain_first_expiring_and_sweep_expired(client, products):
+    store_id = client.post("/api/stores", json={"name": "Lots"}).json()["id"]
+    product = products["Chocolate Donut"]
+    scope = {"store_id": store_id}
+    now = datetime.now(timezone.utc)
+    client.put(f"/api/inventory/{product['id']}", params=scope, json={"quantity": 0, "min_threshold": 2})
+    lots = {}
+    for name, quantity, expiry in [("later", 5, now + timedelta(days=2)), ("sooner", 3, now + timedelta(days=1))]:
+        lots[name] = client.post(f"/api/inventory/{product['id']}/lots", params=scope, json={
+            "quantity": quantity, "expiry_date": expiry.isoformat()
+        }).json()
+
+    sales = [{**queued_sale(product, 0, quantity=4), "store_id": store_id}]
+    client.post("/api/sync", json={"register_id": "register-8", "store_id": store_id, "sales": sales})
+    remaining = client.get(f"/api/inventory/{product['id']}/lots", params=scope).json()
+    assert [(lot["id"], lot["quantity"]) for lot in remaining] == [(lots["later"]["id"], 4)]
+
+    # A stale read loses the race for the drained lot and retries against what is left
+    stale = [{**lots["sooner"], "quantity": 3, "received_at": now}, {**lots["later"], "received_at": now}]
+    for lot in stale:
+        lot["expiry_date"] = datetime.fromisoformat(lot["expiry_date"])
+    assert db_call(client, lambda: server.consume_product_lots(store_id, product["id"], 1, stale))[1] == 0
+    assert client.get(f"/api/inventory/{product['id']}/lots", params=scope).json()[0]["quantity"] == 3
+
+    result = db_call(client, lambda: server.sweep_expired_lots(store_id, now + timedelta(days=3)))
+    assert result == {"lots": 1, "units": 3}
+    waste = db_call(client, lambda: server.db.inventory_waste.find({"store_id": store_id}).to_list(None))
+    assert [(row["lot_id"], row["quantity"]) for row in waste] == [(lots["later"]["id"], 3)]
+    item = client.get("/api/inventory", params=scope).json()[0]
+    assert (item["quantity"], item["status"], item["expiry_date"]) == (0, "out_of_stock", None)
+
+
+def test_archive_round_trip_keeps_sales_and_dedupe(client, products, monkeypatch):
+    store_id = client.post("/api/stores", json={"name": "Archive"}).json()["id"]
+    product = products["Sausage Kolache"]
+    monkeypatch.setattr(server, "SALES_ARCHIVE_PURGE_GRACE", timedelta(0))
+    old_day = datetime.now(timezone.utc) - timedelta(days=server.SALES_ARCHIVE_AFTER_DAYS + 10)
+    old_sales = [
+        {**queued_sale(product, i), "store_id": store_id, "timestamp": (old_day + timedelta(hours=i)).isoformat()}
+        for i in range(3)
+    ]
+    batch = {"register_id": "register-10", "store_id": store_id, "sales": old_sales}
+    client.post("/api/sync", json=batch)
+    recent = client.post("/api/sales", json={
+        "store_id": store_id,
+        "items": [{"product_id": product["id"], "quantity": 1, "price": product["price"]}],
+        "total_amount": product["price"]
+    }).json()
+
+    assert client.post("/api/jobs/rollup_compaction/run").json()["last_status"] == "success"
+    result = db_call(client, lambda: server.archive_old_sales(store_id))
+    assert (result["sales"], result["purged"]) == (3, 3)
+    hot = db_call(client, lambda: server.db.sales.find({"store_id": store_id}).to_list(None))
+    assert [sale["id"] for sale in hot] == [recent["id"]]
+
+    window = {"store_id": store_id, "start": (old_day - timedelta(days=1)).isoformat()}
+    listed = client.get("/api/sales", params={**window, "limit": 10}).json()
+    assert [sale["client_sale_id"] for sale in listed] == [recent["id"]] + [sale["client_sale_id"] for sale in reversed(old_sales)]
+    newest = client.get("/api/sales", params={**window, "limit": 2}).json()
+    assert [sale["id"] for sale in newest] == [sale["id"] for sale in listed[:2]]
+
+    # The purged sales' tombstones still catch a late replay
+    replay = client.post("/api/sync", json=batch).json()
+    assert replay["applied"] == [] and len(replay["duplicates"]) == 3
+    assert len(client.get("/api/sales", params={**window, "limit": 10}).json()) == 4
+
+
+def test_archive_rerun_after_crash_keeps_each_sale_once(client, products, monkeypatch):
+    store_id = client.post("/api/stores", json={"name": "Archive rerun"}).json()["id"]
+    product = products["Sausage Kolache"]
+    monkeypatch.setattr(server, "ARCHIVE_CHUNK_SIZE", 2)
+    day = server.start_of_day() - timedelta(days=server.SALES_ARCHIVE_AFTER_DAYS + 10)
+
+    def sync(count):
+        sales = [
+            {**queued_sale(product, i), "store_id": store_id, "timestamp": (day + timedelta(hours=i + 1)).isoformat()}
+            for i in range(count)
+        ]
+        client.post("/api/sync", json={"register_id": "register-12", "store_id": store_id, "sales": sales})
+
+    sync(3)
+    assert db_call(client, lambda: server.archive_sales_day(store_id, day)) == 3
+    # Crash before the hot copies were marked archived, then a late sale for the same day arrives
+    db_call(client, lambda: server.db.sales.update_many({"store_id": store_id}, {"$set": {"archived_at": None}}))
+    sync(1)
+    assert db_call(client, lambda: server.archive_sales_day(store_id, day)) == 4
+
+    chunks = db_call(client, lambda: server.db.sales_archive.find({"store_id": store_id}).to_list(None))
+    archived = sorted(sale["id"] for chunk in chunks for sale in server.unpack_sales(chunk["data"]))
+    hot = db_call(client, lambda: server.db.sales.find({"store_id": store_id}).to_list(None))
+    assert archived == sorted(sale["id"] for sale in hot)
+
+
+def test_exhausted_lots_report_shortfall(client, products, caplog):
+    store_id = client.post("/api/stores", json={"name": "Short lots"}).json()["id"]
+    product = products["Glazed Donut"]
+    scope = {"store_id": store_id}
+    client.put(f"/api/inventory/{product['id']}", params=scope, json={"quantity": 10, "min_threshold": 2})
+    client.post(f"/api/inventory/{product['id']}/lots", params=scope, json={"quantity": 2})
+
+    sales = [{**queued_sale(product, 0, quantity=5), "store_id": store_id}]
+    with caplog.at_level("WARNING"):
+        client.post("/api/sync", json={"register_id": "register-11", "store_id": store_id, "sales": sales})
+    assert client.get(f"/api/inventory/{product['id']}/lots", params=scope).json() == []
+    assert client.get("/api/inventory", params=scope).json()[0]["quantity"] == 7
+    assert any("3 units short of a sale of 5" in record.getMessage() for record in caplog.records)
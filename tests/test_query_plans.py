@@ -0,0 +1,83 @@
+"""Query plan checks.
+
+The plan rules are checked against canned explain output everywhere. The
+full run seeds a scratch database and explains every query the API sends,
+so it only runs when PLAN_CHECK_MONGO_URL points at a disposable mongod.
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import query_plan_check  # noqa: E402
+
+
+def find_query(filter_):
+    return {"command_name": "find", "command": {"find": "sales", "filter": filter_}}
+
+
+def explain_of(stage, examined=0, returned=0):
+    return {
+        "queryPlanner": {
+            "winningPlan": stage,
+            "rejectedPlans": [{"stage": "COLLSCAN"}]
+        },
+        "executionStats": {"nReturned": returned, "totalDocsExamined": examined}
+    }
+
+
+def test_index_scan_passes():
+    plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "store_id_1_timestamp_1"}}
+    assert query_plan_check.check_plan(find_query({"store_id": "main"}), explain_of(plan, 40, 40)) == []
+
+
+def test_filtered_collection_scan_fails():
+    problems = query_plan_check.check_plan(find_query({"category": "donuts"}), explain_of({"stage": "COLLSCAN"}))
+    assert problems == ["collection scan"]
+
+
+def test_unfiltered_listing_may_scan():
+    assert query_plan_check.check_plan(find_query({}), explain_of({"stage": "COLLSCAN"}, 50, 50)) == []
+
+
+def test_in_memory_sort_fails():
+    plan = {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}
+    assert "in-memory sort" in query_plan_check.check_plan(find_query({}), explain_of(plan))
+
+
+def test_text_score_sort_passes():
+    plan = {
+        "stage": "SORT",
+        "sortPattern": {"score": {"$meta": "textScore"}, "id": 1},
+        "inputStage": {"stage": "TEXT_MATCH", "inputStage": {"stage": "IXSCAN"}}
+    }
+    assert query_plan_check.check_plan(find_query({"$text": {"$search": "glazed"}}), explain_of(plan, 4, 4)) == []
+
+
+def test_unselective_index_fails():
+    plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}
+    problems = query_plan_check.check_plan(find_query({"store_id": "main"}), explain_of(plan, 5000, 3))
+    assert problems == ["examined 5000 docs to return 3"]
+
+
+def test_bulk_writes_are_explained_per_statement():
+    command = {"update": "customers", "updates": [{"q": {"name": "a"}}, {"q": {"name": "b"}}]}
+    statements = list(query_plan_check.split_statements("update", command))
+    assert [statement["updates"][0]["q"] for statement in statements] == [{"name": "a"}, {"name": "b"}]
+    assert query_plan_check.shape(statements[0]) == query_plan_check.shape(statements[1])
+
+
+@pytest.mark.skipif(not os.environ.get("PLAN_CHECK_MONGO_URL"), reason="needs a disposable mongod")
+def test_every_api_query_uses_an_index(monkeypatch):
+    monkeypatch.setenv("MONGO_URL", os.environ["PLAN_CHECK_MONGO_URL"])
+    results = query_plan_check.run_check()
+    failures = {
+        f"{result['route']} {result['command_name']} {result['collection']}": result["problems"]
+        for result in results
+        if result["problems"]
+    }
+    assert results
+    assert not failures
@@ -0,0 +1,66 @@
+"""Cold-start checks for the API worker.
+
+Autoscaled workers must be importable quickly and must not pull in the
+heavy analytics stack until a request actually needs it.
+"""
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+COLD_START_BUDGET = float(os.environ.get("COLD_START_BUDGET", "1.0"))
+HEAVY_MODULES = ["numpy", "pandas", "boto3", "motor"]
+STARTUP_PHASES = {"connect", "indexes", "warm_caches"}
+
+sys.path.insert(0, str(BACKEND_DIR))
+
+import server  # noqa: E402
+
+IMPORT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import server
+print(json.dumps({"seconds": time.perf_counter() - started, "modules": sorted(sys.modules)}))
+"""
+
+
+def import_server_cold():
+    # A fresh interpreter, so nothing is already cached in sys.modules
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_import_within_cold_start_budget():
+    report = import_server_cold()
+    assert report["seconds"] < COLD_START_BUDGET, (
+        f"Importing server took {report['seconds']:.3f}s, budget is {COLD_START_BUDGET}s"
+    )
+
+
+def test_heavy_dependencies_are_lazy():
+    modules = set(import_server_cold()["modules"])
+    loaded = [name for name in HEAVY_MODULES if name in modules]
+    assert not loaded, f"Imported eagerly at startup: {loaded}"
+
+
+def test_lifespan_reports_ready_with_phase_timings(monkeypatch):
+    monkeypatch.setenv("STORAGE_BACKEND", "memory")
+    monkeypatch.setenv("DB_NAME", "startup_tests")
+    monkeypatch.setenv("SCHEDULER_ENABLED", "false")
+    with TestClient(server.app) as client:
+        report = client.get("/api/health/startup").json()
+    assert report["ready"] is True
+    assert set(report["phases_ms"]) == STARTUP_PHASES
+    assert all(duration >= 0 for duration in report["phases_ms"].values())
+    assert report["total_ms"] >= max(report["phases_ms"].values())
+    assert server.startup_report["ready"] is False